@@ -0,0 +1,385 @@
+"""Offline benchmark of the bot handlers against a synthetic dataset.
+
+Run it with ``python -m benchmarks.handlers --help``. No Telegram connection is
+needed: updates are stand-in objects and replies are recorded by a fake bot.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Callable, Dict, List, NamedTuple
+
+# never touch the real bot.db when bot is imported
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from sqlalchemy import event, insert  # noqa: E402
+
+import bot  # noqa: E402
+import database  # noqa: E402
+import migrations  # noqa: E402
+from models import Account, ChatUser, Service, Usage, UsageTotal  # noqa: E402
+
+ADMIN_ID = 1
+USER_ID = 2
+# accounts in every file sent to /import_accounts
+IMPORT_ROWS = 20
+
+
+class RecordingBot:
+    first_name = "EasySharingBot"
+
+    def __init__(self):
+        self.sent = []
+        self.files = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+    async def send_document(self, chat_id, document, filename=None, **kwargs):
+        content = document if isinstance(document, bytes) else document.read()
+        self.sent.append((chat_id, filename, len(content)))
+
+    async def get_file(self, file_id, **kwargs):
+        # new usernames on every download, so every import creates its accounts
+        self.files += 1
+        rows = "".join(f"import{self.files}_{n},secret\n" for n in range(IMPORT_ROWS))
+        content = f"username,password\n{rows}".encode()
+
+        async def download_as_bytearray():
+            return bytearray(content)
+
+        return SimpleNamespace(download_as_bytearray=download_as_bytearray)
+
+    async def get_chat_member(self, chat_id, user_id, **kwargs):
+        status = "creator" if user_id == ADMIN_ID else "member"
+        return SimpleNamespace(status=status, user=SimpleNamespace(id=user_id))
+
+    async def get_chat_administrators(self, chat_id, **kwargs):
+        return [SimpleNamespace(user=SimpleNamespace(id=ADMIN_ID, username="admin"))]
+
+
+async def _answer(*args, **kwargs) -> None:
+    pass
+
+
+def make_update(text: str, chat_id: int, username: str, user_id: int = USER_ID):
+    """Stand-in update that serves as a command, a page button press (``text`` is
+    the callback data), an inline query or a membership change."""
+    chat = SimpleNamespace(id=chat_id)
+    document = None
+    if text.startswith("/import_accounts"):
+        document = SimpleNamespace(
+            file_id="accounts", file_name="accounts.csv", file_size=None
+        )
+    message = SimpleNamespace(
+        text=text,
+        caption=None,
+        chat_id=chat_id,
+        document=document,
+        reply_to_message=None,
+    )
+    user = SimpleNamespace(id=user_id, username=username)
+    return SimpleNamespace(
+        effective_chat=chat,
+        effective_message=message,
+        effective_user=user,
+        callback_query=SimpleNamespace(
+            data=text, answer=_answer, edit_message_text=_answer
+        ),
+        inline_query=SimpleNamespace(query=text, from_user=user, answer=_answer),
+        chat_member=SimpleNamespace(
+            chat=chat, new_chat_member=SimpleNamespace(user=user, status="member")
+        ),
+    )
+
+
+class Dataset(NamedTuple):
+    chats: int
+    services: int
+    accounts: int
+    usages: int
+
+
+class Result(NamedTuple):
+    command: str
+    calls: int
+    p50_ms: float
+    p99_ms: float
+    throughput: float
+    statements: float
+
+
+def seed(engine, dataset: Dataset, seed_value: int = 0) -> None:
+    """Insert chats x services x accounts and spread the usage history over them.
+    The benchmark user is a member of every chat."""
+    rnd = random.Random(seed_value)
+    now = datetime.now()
+    services, accounts = [], []
+    for chat_id in range(1, dataset.chats + 1):
+        for s in range(dataset.services):
+            service_id = len(services) + 1
+            services.append(
+                dict(
+                    service_id=service_id,
+                    chat_id=chat_id,
+                    name=f"service{s}",
+                    created_by="admin",
+                    created_at=now,
+                )
+            )
+            for a in range(dataset.accounts):
+                accounts.append(
+                    dict(
+                        account_id=len(accounts) + 1,
+                        service_id=service_id,
+                        username=f"account{a}",
+                        password="secret",
+                        created_by="admin",
+                        created_at=now,
+                    )
+                )
+    usages, totals = [], {}
+    for _ in range(dataset.usages if accounts else 0):
+        account = rnd.choice(accounts)
+        user = f"user{rnd.randrange(50)}"
+        started_at = now - timedelta(minutes=rnd.randrange(1, 60 * 24 * 90))
+        finished_at = started_at + timedelta(minutes=rnd.randrange(1, 240))
+        usages.append(
+            dict(
+                account_id=account["account_id"],
+                performed_by=user,
+                started_at=started_at,
+                finished_at=finished_at,
+            )
+        )
+        key = (account["service_id"], user)
+        totals[key] = totals.get(key, 0) + (finished_at - started_at).total_seconds()
+    members = [
+        dict(chat_id=chat_id, user_id=USER_ID, seen_at=now)
+        for chat_id in range(1, dataset.chats + 1)
+    ]
+    with engine.begin() as connection:
+        for model, rows in [
+            (Service, services),
+            (Account, accounts),
+            (Usage, usages),
+            (ChatUser, members),
+        ]:
+            if rows:
+                connection.execute(insert(model), rows)
+        if totals:
+            connection.execute(
+                insert(UsageTotal),
+                [
+                    dict(service_id=service_id, performed_by=user, seconds=seconds)
+                    for (service_id, user), seconds in totals.items()
+                ],
+            )
+
+
+# handlers registered next to the command router, timed under these names
+OTHER_HANDLERS = ("page", "inline", "chat_member")
+
+
+def _commands(dataset: Dataset) -> List[tuple]:
+    """(command, handler, text factory, admin) in the order they are run: every
+    entry of bot.COMMANDS and OTHER_HANDLERS."""
+
+    def service(i):
+        return f"service{i % dataset.services}"
+
+    def service_id(i):
+        # ids as inserted by seed, for the chat run() sends call i to
+        chat_id = i % dataset.chats + 1
+        return (chat_id - 1) * dataset.services + i % dataset.services + 1
+
+    def account(i):
+        return f"account{(i // dataset.services) % dataset.accounts}"
+
+    return [
+        ("start", bot.start_handler, lambda i: "/start", False),
+        ("help", bot.help_handler, lambda i: "/help", False),
+        ("services", bot.services_handler, lambda i: "/services", False),
+        ("status", bot.status_handler, lambda i: f"/status {service(i)}", False),
+        ("accounts", bot.accounts_handler, lambda i: f"/accounts {service(i)}", False),
+        ("use", bot.use_handler, lambda i: f"/use {service(i)} {account(i)}", False),
+        ("status_me", bot.status_me_handler, lambda i: "/status_me", False),
+        ("check", bot.check_handler, lambda i: f"/check {service(i)}", False),
+        ("ranking", bot.ranking_handler, lambda i: f"/ranking {service(i)}", False),
+        (
+            "page",
+            bot.page_callback_handler,
+            lambda i: f"accounts:next:{service_id(i)}:0",
+            False,
+        ),
+        ("inline", bot.inline_query_handler, lambda i: service(i)[:4], False),
+        (
+            "release",
+            bot.release_handler,
+            lambda i: f"/release {service(i)} {account(i)}",
+            False,
+        ),
+        (
+            "report_broken",
+            bot.report_broken_handler,
+            lambda i: f"/report_broken {service(i)} {account(i)}",
+            False,
+        ),
+        ("chat_member", bot.chat_member_handler, lambda i: "", False),
+        ("stats", bot.stats_handler, lambda i: "/stats", True),
+        ("export", bot.export_handler, lambda i: f"/export {service(i)}", True),
+        (
+            "auto_release",
+            bot.auto_release_handler,
+            lambda i: f"/auto_release {service(i)} 2",
+            True,
+        ),
+        (
+            "create_service",
+            bot.create_service_handler,
+            lambda i: f"/create_service bench{i}",
+            True,
+        ),
+        (
+            "update_service",
+            bot.update_service_handler,
+            lambda i: f"/update_service bench{i} renamed{i}",
+            True,
+        ),
+        (
+            "create_account",
+            bot.create_account_handler,
+            lambda i: f"/create_account renamed{i} bench secret",
+            True,
+        ),
+        (
+            "import_accounts",
+            bot.import_accounts_handler,
+            lambda i: f"/import_accounts renamed{i}",
+            True,
+        ),
+        (
+            "update_account",
+            bot.update_account_handler,
+            lambda i: f"/update_account renamed{i} bench new_secret",
+            True,
+        ),
+        (
+            "delete_account",
+            bot.delete_account_handler,
+            lambda i: f"/delete_account renamed{i} bench",
+            True,
+        ),
+        (
+            "delete_service",
+            bot.delete_service_handler,
+            lambda i: f"/delete_service renamed{i}",
+            True,
+        ),
+    ]
+
+
+def _percentile(values: List[float], percentile: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, round(percentile / 100 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+async def _run_command(
+    handler: Callable,
+    texts: List[str],
+    chat_ids: List[int],
+    admin: bool,
+    users: List[str],
+) -> List[float]:
+    context = SimpleNamespace(bot=RecordingBot())
+    latencies = []
+    for text, chat_id, username in zip(texts, chat_ids, users):
+        update = make_update(
+            text, chat_id, username, user_id=ADMIN_ID if admin else USER_ID
+        )
+        started = time.perf_counter()
+        await handler(update, context)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def run(dataset: Dataset, iterations: int, commands: List[str] = None) -> List[Result]:
+    """Seed a temporary database and time ``iterations`` calls of every command."""
+    with tempfile.TemporaryDirectory() as directory:
+        engine = database.build_engine(f"sqlite:///{directory}/bench.db")
+        migrations.upgrade(engine)
+        seed(engine, dataset)
+        database.Session.configure(bind=engine)
+        statements: Dict[str, int] = {"count": 0}
+
+        def _count(conn, cursor, statement, parameters, context, executemany):
+            statements["count"] += 1
+
+        event.listen(engine, "before_cursor_execute", _count)
+        results = []
+        try:
+            for command, handler, text, admin in _commands(dataset):
+                if commands and command not in commands:
+                    continue
+                texts = [text(i) for i in range(iterations)]
+                chat_ids = [i % dataset.chats + 1 for i in range(iterations)]
+                users = [f"bench_user{i}" for i in range(iterations)]
+                statements["count"] = 0
+                started = time.perf_counter()
+                latencies = asyncio.run(
+                    _run_command(handler, texts, chat_ids, admin, users)
+                )
+                elapsed = time.perf_counter() - started
+                results.append(
+                    Result(
+                        command=command,
+                        calls=iterations,
+                        p50_ms=statistics.median(latencies) * 1000,
+                        p99_ms=_percentile(latencies, 99) * 1000,
+                        throughput=iterations / elapsed,
+                        statements=statements["count"] / iterations,
+                    )
+                )
+        finally:
+            event.remove(engine, "before_cursor_execute", _count)
+            database.Session.configure(bind=None)
+            database.shutdown_executor()
+            engine.dispose()
+    return results
+
+
+def format_results(results: List[Result]) -> str:
+    lines = [
+        f"{'command':<16}{'calls':>8}{'p50 ms':>10}{'p99 ms':>10}{'ops/s':>10}{'sql/call':>10}"
+    ]
+    for r in results:
+        lines.append(
+            f"{r.command:<16}{r.calls:>8}{r.p50_ms:>10.3f}{r.p99_ms:>10.3f}"
+            f"{r.throughput:>10.0f}{r.statements:>10.2f}"
+        )
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--services", type=int, default=5)
+    parser.add_argument("--accounts", type=int, default=20)
+    parser.add_argument("--usages", type=int, default=100_000)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument(
+        "--command", action="append", dest="commands", help="only run this command"
+    )
+    args = parser.parse_args()
+    dataset = Dataset(args.chats, args.services, args.accounts, args.usages)
+    print(format_results(run(dataset, args.iterations, args.commands)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Throughput of the chat-sharded worker pool for 1 to N workers.
+
+Run it with ``python -m benchmarks.sharding --help``. Updates come from a fake
+source and the Bot API is answered locally, so no Telegram connection is needed.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import List, NamedTuple
+
+from telegram.request import BaseRequest
+
+
+class LocalBotAPI(BaseRequest):
+    """Answers the Bot API calls a worker makes without any network."""
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        if endpoint == "getMe":
+            result = {
+                "id": 1,
+                "is_bot": True,
+                "first_name": "EasySharingBot",
+                "username": "easy_sharing_bot",
+            }
+        elif endpoint == "sendMessage":
+            parameters = request_data.parameters
+            result = {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": parameters["chat_id"], "type": "group"},
+                "text": parameters["text"],
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class Result(NamedTuple):
+    workers: int
+    updates: int
+    seconds: float
+    throughput: float
+    speedup: float
+
+
+def fake_updates(count: int, chats: int, services: int) -> List[dict]:
+    """Read commands spread round robin over the chats, as the Bot API sends them."""
+    commands = [
+        "/services",
+        "/check service{}",
+        "/status service{}",
+        "/ranking service{}",
+    ]
+    updates = []
+    for i in range(count):
+        text = commands[i % len(commands)].format(i // chats % services)
+        chat_id = -(1000 + i % chats)
+        updates.append(
+            {
+                "update_id": i + 1,
+                "message": {
+                    "message_id": i + 1,
+                    "date": int(time.time()),
+                    "text": text,
+                    "entities": [
+                        {
+                            "type": "bot_command",
+                            "offset": 0,
+                            "length": len(text.split()[0]),
+                        }
+                    ],
+                    "chat": {"id": chat_id, "type": "group", "title": "chat"},
+                    "from": {
+                        "id": 2,
+                        "is_bot": False,
+                        "first_name": "user",
+                        "username": "user",
+                    },
+                },
+            }
+        )
+    return updates
+
+
+def measure(workers: int, updates: List[dict]) -> float:
+    """Seconds the pool needs to handle ``updates``, excluding process start up."""
+    import sharding
+
+    pool = sharding.WorkerPool(workers, request_class=LocalBotAPI)
+    pool.start()
+    started = time.perf_counter()
+    for update in updates:
+        pool.queues[sharding.shard_for(update["message"]["chat"]["id"], workers)].put(
+            update
+        )
+    processed = pool.stop()
+    elapsed = time.perf_counter() - started
+    assert sum(processed) == len(updates), processed
+    return elapsed
+
+
+@contextmanager
+def _environment(**values: str):
+    previous = {name: os.environ.get(name) for name in values}
+    os.environ.update(values)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def run(
+    max_workers: int, updates: int, chats: int, services: int, accounts: int
+) -> List[Result]:
+    with tempfile.TemporaryDirectory() as directory, _environment(
+        # the workers are spawned, they read their settings from the environment
+        DATABASE_URL=f"sqlite:///{directory}/bench.db",
+        BOT_TOKEN=os.getenv("BOT_TOKEN") or "123:BENCH",
+        # replies must not be throttled by the outbox while measuring
+        OUTBOX_GLOBAL_RATE="1000000",
+        OUTBOX_CHAT_RATE="1000000",
+        OUTBOX_CHAT_BURST="1000000",
+    ):
+        from benchmarks import handlers
+        import database
+        import migrations
+
+        engine = database.build_engine()
+        migrations.upgrade(engine)
+        chat_ids = [-(1000 + i) for i in range(chats)]
+        handlers.seed(engine, handlers.Dataset(chats, services, accounts, 0))
+        with engine.begin() as connection:
+            # seed() numbers chats from 1, give them group chat ids instead
+            for number, chat_id in enumerate(chat_ids, start=1):
+                connection.exec_driver_sql(
+                    "UPDATE service SET chat_id = ? WHERE chat_id = ?",
+                    (chat_id, number),
+                )
+        engine.dispose()
+
+        batch = fake_updates(updates, chats, services)
+        results = []
+        for workers in range(1, max_workers + 1):
+            seconds = measure(workers, batch)
+            baseline = results[0].seconds if results else seconds
+            results.append(
+                Result(workers, updates, seconds, updates / seconds, baseline / seconds)
+            )
+    return results
+
+
+def format_results(results: List[Result]) -> str:
+    lines = [
+        f"{'workers':>8}{'updates':>10}{'seconds':>10}{'updates/s':>12}{'speedup':>10}"
+    ]
+    for r in results:
+        lines.append(
+            f"{r.workers:>8}{r.updates:>10}{r.seconds:>10.2f}"
+            f"{r.throughput:>12.0f}{r.speedup:>10.2f}"
+        )
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--chats", type=int, default=64)
+    parser.add_argument("--services", type=int, default=5)
+    parser.add_argument("--accounts", type=int, default=20)
+    args = parser.parse_args()
+    print(
+        format_results(
+            run(args.workers, args.updates, args.chats, args.services, args.accounts)
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Cold start of the bot: import time and time to the first reply.
+
+Run it with ``python -m benchmarks.startup --help``. Every run is a fresh
+interpreter, timed against a new database (schema created) and an existing one
+(schema version checked only). The Bot API is answered locally.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, NamedTuple
+
+from benchmarks.sharding import LocalBotAPI, fake_updates
+
+# time to the first reply on an existing database that the command enforces
+BUDGET_MS = 1500
+
+
+class FirstReplyAPI(LocalBotAPI):
+    def __init__(self):
+        self.replied = asyncio.Event()
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        response = await super().do_request(url, method, request_data, **kwargs)
+        if url.endswith("/sendMessage"):
+            self.replied.set()
+        return response
+
+
+class Result(NamedTuple):
+    database: str
+    runs: int
+    import_ms: float
+    first_reply_ms: float
+
+
+def _child() -> None:
+    started = time.perf_counter()
+    import bot
+    from telegram import Update
+
+    imported = time.perf_counter()
+
+    async def first_reply() -> float:
+        api = FirstReplyAPI()
+        application = bot.application_builder().token("123:TEST").request(api).build()
+        bot.register_handlers(application)
+        async with application:
+            await application.start()
+            [data] = fake_updates(1, chats=1, services=1)
+            await application.update_queue.put(Update.de_json(data, application.bot))
+            await api.replied.wait()
+            replied = time.perf_counter()
+            await application.stop()
+        return replied
+
+    replied = asyncio.run(first_reply())
+    bot.shutdown_executor()
+    print(
+        json.dumps(
+            {
+                "import_ms": (imported - started) * 1000,
+                "first_reply_ms": (replied - started) * 1000,
+            }
+        )
+    )
+
+
+def _measure_once(database_url: str) -> Dict[str, float]:
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.startup", "--child"],
+        env=dict(os.environ, DATABASE_URL=database_url),
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run(runs: int) -> List[Result]:
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "startup.db")
+        for database in ("new", "existing"):
+            samples = []
+            for _ in range(runs):
+                if database == "new" and os.path.exists(path):
+                    os.remove(path)
+                samples.append(_measure_once(f"sqlite:///{path}"))
+            results.append(
+                Result(
+                    database=database,
+                    runs=runs,
+                    import_ms=statistics.median(s["import_ms"] for s in samples),
+                    first_reply_ms=statistics.median(
+                        s["first_reply_ms"] for s in samples
+                    ),
+                )
+            )
+    return results
+
+
+def format_results(results: List[Result]) -> str:
+    lines = [f"{'database':<10}{'runs':>6}{'import ms':>12}{'first reply ms':>16}"]
+    for r in results:
+        lines.append(
+            f"{r.database:<10}{r.runs:>6}{r.import_ms:>12.0f}{r.first_reply_ms:>16.0f}"
+        )
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=BUDGET_MS,
+        help="exit with an error when the first reply on an existing database is slower",
+    )
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        _child()
+        return
+    results = run(args.runs)
+    print(format_results(results))
+    existing = results[-1].first_reply_ms
+    if existing > args.budget_ms:
+        sys.exit(
+            f"First reply took {existing:.0f} ms, over the {args.budget_ms:.0f} ms budget"
+        )
+
+
+if __name__ == "__main__":
+    main()
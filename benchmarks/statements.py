@@ -0,0 +1,197 @@
+"""Python overhead of building queries per call versus prebuilt statements.
+
+Run it with ``python -m benchmarks.statements --help``. Every operation runs the
+statement the handlers used to assemble on each call (``session.query`` chains
+and inline ``update()``) and the module level statement they execute now,
+against the same in-memory database, and prints the microseconds per call.
+"""
+import argparse
+import os
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, NamedTuple
+
+# never touch the real bot.db when bot is imported
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from sqlalchemy import or_, select, update  # noqa: E402
+from sqlalchemy.orm import selectinload  # noqa: E402
+
+import bot  # noqa: E402
+import database  # noqa: E402
+from models import Account, AccountView, Base, Service  # noqa: E402
+
+CHAT_ID = 1
+SERVICE = "service"
+USERNAME = "user0"
+CURRENT_USER = "alice"
+
+
+class Result(NamedTuple):
+    operation: str
+    calls: int
+    legacy_us: float
+    prebuilt_us: float
+
+    @property
+    def saved_us(self) -> float:
+        return self.legacy_us - self.prebuilt_us
+
+
+def _legacy_grab(session, now):
+    service_id = (
+        select(Service.service_id)
+        .where(Service.chat_id == CHAT_ID)
+        .where(Service.name == SERVICE)
+        .scalar_subquery()
+    )
+    return session.execute(
+        update(Account)
+        .where(Account.service_id == service_id)
+        .where(Account.username == USERNAME)
+        .where(or_(Account.grabbed_at.is_(None), Account.released_at.is_not(None)))
+        .values(grabbed_at=now, released_at=None, grabbed_by=CURRENT_USER)
+        .returning(Account.account_id)
+        .execution_options(synchronize_session=False)
+    ).scalar_one_or_none()
+
+
+def _prebuilt_grab(session, now):
+    return session.execute(
+        bot._GRAB,
+        dict(
+            chat_id=CHAT_ID,
+            service=SERVICE,
+            account_username=USERNAME,
+            user=CURRENT_USER,
+            now=now,
+        ),
+    ).scalar_one_or_none()
+
+
+def _legacy_account(session, now):
+    return (
+        session.query(Account)
+        .join(Service)
+        .filter(Account.username == USERNAME)
+        .filter(Service.name == SERVICE)
+        .filter(Service.chat_id == CHAT_ID)
+        .one_or_none()
+    )
+
+
+def _prebuilt_account(session, now):
+    return session.scalars(
+        bot._ACCOUNT_BY_NAME,
+        dict(chat_id=CHAT_ID, service=SERVICE, username=USERNAME),
+    ).one_or_none()
+
+
+def _legacy_chat_view(session, now):
+    services = (
+        session.query(Service)
+        .options(selectinload(Service.accounts))
+        .filter(Service.chat_id == CHAT_ID)
+        .order_by(Service.name)
+        .all()
+    )
+    return {
+        service.name: [
+            AccountView(
+                service=service.name,
+                username=account.username,
+                password=account.password,
+                grabbed_at=account.grabbed_at,
+                grabbed_by=account.grabbed_by,
+                released_at=account.released_at,
+            )
+            for account in sorted(service.accounts, key=lambda a: a.username)
+        ]
+        for service in services
+    }
+
+
+def _prebuilt_chat_view(session, now):
+    # opens its own session, which is counted against it
+    return bot._load_chat_view(CHAT_ID)
+
+
+OPERATIONS: Dict[str, tuple] = {
+    "use": (_legacy_grab, _prebuilt_grab),
+    "update_account": (_legacy_account, _prebuilt_account),
+    "chat view": (_legacy_chat_view, _prebuilt_chat_view),
+}
+
+
+def _seed(accounts: int) -> None:
+    with database.Session() as session:
+        now = datetime.now()
+        service = Service(
+            chat_id=CHAT_ID, name=SERVICE, created_by=CURRENT_USER, created_at=now
+        )
+        session.add(service)
+        session.flush()
+        session.add_all(
+            Account(
+                service_id=service.service_id,
+                username=f"user{i}",
+                password="pw",
+                created_by=CURRENT_USER,
+                created_at=now,
+            )
+            for i in range(accounts)
+        )
+        session.commit()
+
+
+def _time(operation: Callable, calls: int) -> float:
+    now = datetime.now()
+    with database.Session() as session:
+        # warm both the compiled cache and the connection before measuring
+        operation(session, now)
+        session.rollback()
+        started = time.perf_counter()
+        for _ in range(calls):
+            operation(session, now)
+            # writes are undone so every call sees the same rows
+            session.rollback()
+        return (time.perf_counter() - started) / calls * 1_000_000
+
+
+def run(calls: int, accounts: int = 20) -> List[Result]:
+    engine = database.build_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    database.Session.configure(bind=engine)
+    try:
+        _seed(accounts)
+        return [
+            Result(operation, calls, _time(legacy, calls), _time(prebuilt, calls))
+            for operation, (legacy, prebuilt) in OPERATIONS.items()
+        ]
+    finally:
+        database.Session.configure(bind=None)
+        engine.dispose()
+
+
+def format_results(results: List[Result]) -> str:
+    lines = [
+        f"{'operation':<18}{'calls':>7}{'legacy us':>11}{'prebuilt us':>13}{'saved us':>10}"
+    ]
+    for r in results:
+        lines.append(
+            f"{r.operation:<18}{r.calls:>7}{r.legacy_us:>11.0f}"
+            f"{r.prebuilt_us:>13.0f}{r.saved_us:>10.0f}"
+        )
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--accounts", type=int, default=20)
+    args = parser.parse_args()
+    print(format_results(run(args.calls, args.accounts)))
+
+
+if __name__ == "__main__":
+    main()
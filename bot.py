@@ -1,25 +1,71 @@
-from datetime import datetime
-from typing import List
+import csv
+import io
+import json
+import math
+import tempfile
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    IO,
+    FrozenSet,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
 from functools import wraps
 
-from sqlalchemy import create_engine, or_
-from sqlalchemy.sql import text as text_sa
-from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import sessionmaker, selectinload
-
-from models import Service, Base, Account, Usage
+from sqlalchemy import bindparam, case, delete, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from cache import TTLCache
+import maintenance
+import metrics
+from database import Session, run_sync, shutdown_executor, warm_up
+from journal import WriteBehindJournal
+from locks import KeyedLock
+from outbox import MAX_MESSAGE_LENGTH, Outbox
+from models import (
+    Account,
+    AccountView,
+    ChatUser,
+    Service,
+    Usage,
+    UsageDaily,
+    UsageTotal,
+)
 
-from telegram import Update
-from telegram.ext import ContextTypes
+from telegram import (
+    ChatMember,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+    Update,
+)
+from telegram.ext import (
+    CallbackQueryHandler,
+    ChatMemberHandler,
+    ContextTypes,
+    InlineQueryHandler,
+)
 
 import os
 
 from dotenv import load_dotenv
 import logging
 
-from telegram.ext import ApplicationBuilder, CommandHandler
+from telegram.ext import Application, ApplicationBuilder, BaseHandler
 
-load_dotenv()
+if __name__ == "__main__":
+    # only when run as the bot, ahead of the settings read below: importers
+    # (tests, benchmarks, the sharding workers) keep the environment they have
+    load_dotenv()
 
 _PERMISSION_DENIED_MESSAGE = "This command is only available for admins."
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -27,17 +73,116 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
+logger = logging.getLogger(__name__)
+
+# (chat_id, user_id) -> whether the user may run admin commands in that chat
+_admin_cache = TTLCache(
+    maxsize=int(os.getenv("ADMIN_CACHE_SIZE", "4096")),
+    ttl=float(os.getenv("ADMIN_CACHE_TTL", "300")),
+)
+# chat_id -> usernames of the chat administrators
+_admin_roster_cache = TTLCache(
+    maxsize=int(os.getenv("ADMIN_ROSTER_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("ADMIN_ROSTER_CACHE_TTL", "600")),
+)
+# (chat_id, service, username) -> first reporter of a broken account within the window
+_broken_reports = TTLCache(
+    maxsize=int(os.getenv("REPORT_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("REPORT_COALESCE_WINDOW", "300")),
+)
+# grabs older than this many seconds are released, unless the service sets its own
+_GRAB_TTL = float(os.getenv("GRAB_TTL_HOURS", "0")) * 3600
+# accounts per /status and /accounts reply, more are reached with the buttons
+_PAGE_SIZE = int(os.getenv("ACCOUNTS_PAGE_SIZE", "20"))
+_IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(1024 * 1024)))
+_IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "500"))
+# chat_id -> lock held by the commands that change the chat, in arrival order
+_chat_locks = KeyedLock()
+# set while the application runs, replies are sent through it
+_outbox: Optional[Outbox] = None
+
+# chat_id -> {service name: accounts}, invalidated by every mutator of that chat
+_chat_views = TTLCache(
+    maxsize=int(os.getenv("CHAT_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("CHAT_CACHE_TTL", "3600")),
+)
+# chat_id -> [loads in flight, invalidations since the first of them started], so a
+# view loaded before a write is never cached; dropped when the last load ends
+_chat_loads: Dict[int, List[int]] = {}
+_chat_views_lock = threading.Lock()
+
+metrics.registry.register_cache("admin_checks", _admin_cache)
+metrics.registry.register_cache("admin_rosters", _admin_roster_cache)
+metrics.registry.register_cache("chat_views", _chat_views)
+
+# chat_id -> (chat view, {lowercase prefix: service names}) for inline queries
+_prefix_indexes = TTLCache(
+    maxsize=int(os.getenv("CHAT_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("CHAT_CACHE_TTL", "3600")),
+)
+# (chat_id, user_id) pairs already stored in chat_user
+_seen_chat_users = TTLCache(
+    maxsize=int(os.getenv("CHAT_USER_CACHE_SIZE", "65536")),
+    ttl=float(os.getenv("CHAT_USER_CACHE_TTL", "86400")),
+)
+# user_id -> chat ids the user was seen in
+_user_chats = TTLCache(
+    maxsize=int(os.getenv("CHAT_USER_CACHE_SIZE", "65536")),
+    ttl=float(os.getenv("USER_CHATS_CACHE_TTL", "300")),
+)
+_INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "10"))
+# Telegram accepts at most 50 results per inline query answer
+_INLINE_MAX_RESULTS = 50
+metrics.registry.register_cache("prefix_indexes", _prefix_indexes)
+metrics.registry.register_cache("user_chats", _user_chats)
+metrics.registry.register_gauge("chat_locks", lambda: len(_chat_locks))
+metrics.registry.register_gauge(
+    "outbox_depth", lambda: _outbox.depth if _outbox is not None else 0
+)
 
-engine = create_engine("sqlite:///bot.db")
-Base.metadata.create_all(engine)
-Session = sessionmaker(engine)
+
+async def _send_message(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    text: str,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+) -> None:
+    if _outbox is not None:
+        _outbox.send(chat_id, text, reply_markup=reply_markup)
+    elif reply_markup is not None:
+        await context.bot.send_message(
+            chat_id=chat_id, text=text, reply_markup=reply_markup
+        )
+    else:
+        await context.bot.send_message(chat_id=chat_id, text=text)
+
+
+async def _send_document(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    document: Union[bytes, IO[bytes]],
+    filename: str,
+) -> None:
+    # through the outbox, so it arrives after the messages queued before it; files
+    # are closed once sent
+    if _outbox is not None:
+        _outbox.send_document(chat_id, document, filename)
+        return
+    try:
+        await context.bot.send_document(
+            chat_id=chat_id, document=document, filename=filename
+        )
+    finally:
+        if not isinstance(document, bytes):
+            document.close()
 
 
 def only_admins_or_creators(func):
     @wraps(func)
     async def wrapped(update, context, *args, **kwargs):
-        if not _is_admin_or_creator(update, context):
-            await context.bot.send_message(
+        if not await _is_admin_or_creator(update, context):
+            await _send_message(
+                context,
                 chat_id=update.effective_chat.id,
                 text="Only admins can use this command.",
             )
@@ -48,141 +193,115 @@ def only_admins_or_creators(func):
 
 
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id, text="Hi pal! I'm a bot, please talk to me!"
+    await _send_message(
+        context,
+        chat_id=update.effective_chat.id,
+        text="Hi pal! I'm a bot, please talk to me!",
     )
 
 
 async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    commands = "".join(
+        f"\n  /{name}  {'  '.join(command.usage.split())}".rstrip()
+        for name, command in COMMANDS.items()
+        if name not in ("start", "help")
+    )
     msg = f"""Hi {update.effective_user.username}.
             \nMy name is {context.bot.first_name} and I'm here to help you share accounts/services with your friends.
             \nHere is the list of the available commands:
-            \n-------------------------------------------------------
-            \n  /services
-            \n  /status  <service_name>
-            \n  /create_service  <service_name>
-            \n  /update_service  <service_name>  <new_service_name>
-            \n  /delete_service  <service_name>
-            \n  /accounts
-            \n  /create_account  <service_name>  <username>  <password>
-            \n  /update_account  <service_name>  <username>  <new_username>  [new_password]
-            \n  /delete_account  <service_name>  <username>
-            \n  /use  <service_name>  <username>
-            \n  /release  <service_name> <username>
-            \n  /check  <service_name>
-            \n  /report_broken  <service_name>  <username>
-            \n  /ranking  [service_name]
-            \n  /status_me"""
-
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
+            \n-------------------------------------------------------{commands}"""
+
+    await _send_message(context, chat_id=update.effective_chat.id, text=msg)
 
 
 async def status_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text: str = update.effective_message.text
     chat_id: int = update.effective_chat.id
-    if not _check_args(text, [str]):
-        usage = """Usage: /status <service_name>"""
-        await context.bot.send_message(chat_id=chat_id, text=usage)
-        return
     args: List[str] = text.split()
     service_name: str = args[1]
-    with Session() as session:
-        accounts_list: List[Account] = Account.find_by__chat_id__and__service_name(
-            session=session, chat_id=chat_id, service=service_name
-        )
+    page = await run_sync(
+        _load_account_page, chat_id=chat_id, service_name=service_name
+    )
+    await _send_message(
+        context,
+        chat_id=chat_id,
+        text=_format_status_page(service_name, page),
+        reply_markup=_page_keyboard("status", page),
+    )
+
+
+def _format_status_page(service_name: str, page: "AccountPage") -> str:
     msg = [f"This is the list of accounts for service {service_name}."]
-    for account in accounts_list:
+    for account in page.accounts:
         msg.append(f"\n  *  {account}")
-    await context.bot.send_message(chat_id=chat_id, text="".join(msg))
+    return "".join(msg)
 
 
 async def status_me_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id: int = update.effective_message.chat_id
     current_user: str = update.effective_user.username
-    with Session() as session:
-        accounts_used_by_me = (
-            session.query(Account)
-            .options(selectinload(Account.service))
-            .join(Service)
-            .filter(Account.service_id == Service.service_id)
-            .filter(Service.chat_id == chat_id)
-            .filter(Account.grabbed_by == current_user)
-            .filter(Account.released_at.is_(None))
-            .order_by(Service.name)
-            .order_by(Account.username)
-            .all()
-        )
+    view = await _get_chat_view(chat_id)
+    accounts_used_by_me: List[AccountView] = [
+        account
+        for accounts in view.values()
+        for account in accounts
+        if account.grabbed_by == current_user and account.released_at is None
+    ]
 
     if len(accounts_used_by_me) > 0:
         msg = [f"You are currently using {len(accounts_used_by_me)} account(s):"]
         for account in accounts_used_by_me:
             msg.append(
-                f"\nService: {account.service.name}; Username: {account.grabbed_by}; Password: {account.password};"
+                f"\nService: {account.service}; Username: {account.username}; Password: {account.password};"
             )
         msg = "".join(msg)
     else:
         msg = "You are not using any account currently."
-    await context.bot.send_message(chat_id=chat_id, text=msg)
+    await _send_message(context, chat_id=chat_id, text=msg)
 
 
 async def ranking_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text: str = update.effective_message.text
     chat_id: int = update.effective_chat.id
-    if not _check_args(text, [str]):
-        usage = "Usage: /ranking <service_name>"
-        await context.bot.send_message(chat_id=chat_id, text=usage)
-        return
-
     args = text.split()
     service_name = args[1]
 
-    with Session() as session:
-        try:
-            ranking_sql = text_sa(
-                """SELECT Usage.performed_by, SUM(ROUND((JULIANDAY(CASE WHEN Usage.finished_at IS NULL THEN CURRENT_TIMESTAMP ELSE Usage.finished_at END) - JULIANDAY(Usage.started_at)) * 86400)) AS duration
-                                                                  FROM Usage, Account, Service
-                                                                  WHERE Usage.account_id = Account.account_id
-                                                                  AND Account.service_id = Service.service_id
-                                                                  AND Service.name = :service_name
-                                                                  GROUP BY Usage.performed_by"""
-            )
-            ranking = session.execute(
-                ranking_sql, {"service_name": service_name}
-            ).fetchall()
-            if len(ranking) > 0:
-                msg = [
-                    f"Usage ranking for {service_name}:\n----------------------------------------------"
-                ]
-                for r in ranking:
-                    msg.append(f"\n{r[0]}\t\t | {r[1]}s")
-                msg = "".join(msg)
-            else:
-                msg = f"There is no usage for service {service_name}."
-            await context.bot.send_message(chat_id=chat_id, text=msg)
-
-        except SQLAlchemyError as e:
-            await context.bot.send_message(
-                chat_id=chat_id, text="Sorry, some error occurred."
-            )
-            raise e
+    try:
+        ranking = await run_sync(_ranking, chat_id=chat_id, service_name=service_name)
+    except SQLAlchemyError as e:
+        await _send_message(
+            context, chat_id=chat_id, text="Sorry, some error occurred."
+        )
+        raise e
+
+    if len(ranking) > 0:
+        msg = [
+            f"Usage ranking for {service_name}:\n----------------------------------------------"
+        ]
+        for r in ranking:
+            msg.append(f"\n{r[0]}\t\t | {round(r[1])}s")
+        msg = "".join(msg)
+    else:
+        msg = f"There is no usage for service {service_name}."
+    await _send_message(context, chat_id=chat_id, text=msg)
 
 
 async def services_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id: int = update.effective_chat.id
     try:
-        with Session() as session:
-            services = Service.find_by__chat_id(session=session, chat_id=chat_id)
-            if len(services) <= 0:
-                msg = """No services available.\nCreate a new service using:\n/create_service <service_name>"""
-            else:
-                f_services = "\n  *  ".join([service.name for service in services])
-                msg = f"These are the services available: \n  *  {f_services}"
-            await context.bot.send_message(chat_id=chat_id, text=msg)
+        services: List[str] = list(await _get_chat_view(chat_id))
     except SQLAlchemyError as err:
         print(f"{err}")
-        await context.bot.send_message(
-            chat_id=chat_id, text="An error occurred while retrieving services"
+        await _send_message(
+            context, chat_id=chat_id, text="An error occurred while retrieving services"
         )
+        return
+    if len(services) <= 0:
+        msg = """No services available.\nCreate a new service using:\n/create_service <service_name>"""
+    else:
+        f_services = "\n  *  ".join(services)
+        msg = f"These are the services available: \n  *  {f_services}"
+    await _send_message(context, chat_id=chat_id, text=msg)
 
 
 @only_admins_or_creators
@@ -191,18 +310,17 @@ async def create_service_handler(
 ) -> None:
     text: str = update.effective_message.text
     chat_id: int = update.effective_chat.id
-    if not _check_args(text, [str]):
-        usage = "Usage: /create_service <service_name>"
-        await context.bot.send_message(chat_id=chat_id, text=usage)
-        return
-
     args: List[str] = text.split()
     service_name: str = args[1]
     username: str = update.effective_user.username
-    _create_service(chat_id=chat_id, service=service_name, username=username)
-    msg = f"""Service {service_name} created successfully.
+    if await run_sync(
+        _create_service, chat_id=chat_id, service=service_name, username=username
+    ):
+        msg = f"""Service {service_name} created successfully.
             \nNow add an account for this service using:\n/create_account {service_name} <username> <password>"""
-    await context.bot.send_message(chat_id=chat_id, text=msg)
+    else:
+        msg = f"Service {service_name} already exists"
+    await _send_message(context, chat_id=chat_id, text=msg)
 
 
 @only_admins_or_creators
@@ -211,100 +329,160 @@ async def update_service_handler(
 ) -> None:
     text: str = update.effective_message.text
     chat_id: int = update.effective_message.chat_id
-    if not _check_args(text, [str, str]):
-        usage = "Usage: /update_service <service_name> <new_service_name>"
-        await context.bot.send_message(chat_id=chat_id, text=usage)
-        return
-
     args = text.split()
     service_name = args[1]
     new_service_name = args[2]
-    if _update_service(
-        chat_id=chat_id, service=service_name, new_service=new_service_name
+    if await run_sync(
+        _update_service,
+        chat_id=chat_id,
+        service=service_name,
+        new_service=new_service_name,
     ):
         msg = "Service updated successfully"
     else:
-        msg = "Service not found"
-    await context.bot.send_message(chat_id=chat_id, text=msg)
+        msg = "Service not found or new service name already in use"
+    await _send_message(context, chat_id=chat_id, text=msg)
 
 
 @only_admins_or_creators
-async def delete_service_handler(
+async def auto_release_handler(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     text: str = update.effective_message.text
     chat_id: int = update.effective_message.chat_id
-    if not _check_args(text, [str]):
-        usage = "Usage: /delete_service <service_name>"
-        await context.bot.send_message(chat_id=chat_id, text=usage)
+    args = text.split()
+    service_name = args[1]
+    try:
+        hours = float(args[2]) if len(args) > 2 else None
+    except ValueError:
+        hours = -1
+    # nan and inf parse as floats; under half a second rounds to 0, releasing
+    # every grab at the next sweep
+    if hours is not None and not (math.isfinite(hours) and round(hours * 3600) >= 1):
+        await _send_message(
+            context, chat_id=chat_id, text="The hours must be a positive number"
+        )
         return
+    grab_ttl = round(hours * 3600) if hours is not None else None
+    if not await run_sync(
+        _set_grab_ttl, chat_id=chat_id, service=service_name, grab_ttl=grab_ttl
+    ):
+        msg = "Service not found"
+    elif hours is not None:
+        msg = f"Accounts of service {service_name} will be released automatically after {hours:g} hour(s) of use."
+    elif _GRAB_TTL:
+        msg = f"Accounts of service {service_name} will be released automatically after {_GRAB_TTL / 3600:g} hour(s) of use."
+    else:
+        msg = f"Accounts of service {service_name} will not be released automatically."
+    await _send_message(context, chat_id=chat_id, text=msg)
 
+
+@only_admins_or_creators
+async def delete_service_handler(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    text: str = update.effective_message.text
+    chat_id: int = update.effective_message.chat_id
     args: List[str] = text.split()
     service_name = args[1]
-    if _delete_service(chat_id=chat_id, service=service_name):
+    if await run_sync(_delete_service, chat_id=chat_id, service=service_name):
         msg = """Service deleted successfully"""
     else:
         msg = "Service not found"
-    await context.bot.send_message(chat_id=chat_id, text=msg)
+    await _send_message(context, chat_id=chat_id, text=msg)
 
 
 async def check_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text: str = update.effective_message.text
     chat_id: int = update.effective_message.chat_id
-    if not _check_args(text, [str]):
-        usage = "Usage: /check <service_name>"
-        await context.bot.send_message(chat_id=chat_id, text=usage)
-        return
-
     args = text.split()
     service_name = args[1]
-    with Session() as session:
-        using_accounts = (
-            session.query(Account)
-            .join(Service)
-            .filter(Account.service_id == Service.service_id)
-            .filter(Service.name == service_name)
-            .filter(Account.grabbed_at.is_not(None))
-            .filter(Account.released_at.is_(None))
-            .all()
-        )
-
-        if len(using_accounts) > 0:
-            msg = [
-                f"Hi there. Are you still using the following account(s) for service {service_name}?\n"
-            ]
-            for account in using_accounts:
-                msg.append(f"\nUsername: {account.username}  (@{account.grabbed_by})")
-            msg = "".join(msg)
-        else:
-            msg = "Service not found or no account is being used now"
-    await context.bot.send_message(chat_id=chat_id, text=msg)
+    view = await _get_chat_view(chat_id)
+    using_accounts: List[AccountView] = [
+        account
+        for account in view.get(service_name, [])
+        if account.grabbed_at is not None and account.released_at is None
+    ]
+
+    if len(using_accounts) > 0:
+        msg = [
+            f"Hi there. Are you still using the following account(s) for service {service_name}?\n"
+        ]
+        for account in using_accounts:
+            msg.append(f"\nUsername: {account.username}  (@{account.grabbed_by})")
+        msg = "".join(msg)
+    else:
+        msg = "Service not found or no account is being used now"
+    await _send_message(context, chat_id=chat_id, text=msg)
 
 
 async def accounts_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text: str = update.effective_message.text
     chat_id: int = update.effective_chat.id
-    if not _check_args(text, [str]):
-        usage = """Usage: /accounts <service_name>"""
-        await context.bot.send_message(chat_id=chat_id, text=usage)
-        return
-
     args = text.split()
     service_name: str = args[1]
-    with Session() as session:
-        accounts = Account.find_by__chat_id__and__service_name(
-            session=session, chat_id=chat_id, service=service_name
-        )
-    if len(accounts) <= 0:
-        msg = f"""No accounts available for service {service_name}"""
-    else:
-        f_accounts = """\n *  """.join(
-            [f"{account.username}\t{account.password}" for account in accounts]
+    page = await run_sync(
+        _load_account_page, chat_id=chat_id, service_name=service_name
+    )
+    await _send_message(
+        context,
+        chat_id=chat_id,
+        text=_format_accounts_page(service_name, page),
+        reply_markup=_page_keyboard("accounts", page),
+    )
+
+
+def _format_accounts_page(service_name: str, page: "AccountPage") -> str:
+    if len(page.accounts) <= 0:
+        return f"""No accounts available for service {service_name}"""
+    f_accounts = """\n *  """.join(
+        [f"{account.username}\t{account.password}" for account in page.accounts]
+    )
+    return f"""These are the accounts for service {service_name} \n *  {f_accounts}"""
+
+
+_PAGE_FORMATTERS = {"status": _format_status_page, "accounts": _format_accounts_page}
+
+
+def _page_keyboard(kind: str, page: "AccountPage") -> Optional[InlineKeyboardMarkup]:
+    # callback data is limited to 64 bytes, so the cursor is an account id
+    buttons = []
+    if page.has_previous:
+        buttons.append(
+            InlineKeyboardButton(
+                "« Previous",
+                callback_data=f"{kind}:prev:{page.service_id}:{page.first_id}",
+            )
         )
-        msg = (
-            f"""These are the accounts for service {service_name} \n *  {f_accounts}"""
+    if page.has_next:
+        buttons.append(
+            InlineKeyboardButton(
+                "Next »", callback_data=f"{kind}:next:{page.service_id}:{page.last_id}"
+            )
         )
-    await context.bot.send_message(chat_id=chat_id, text=msg)
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+async def page_callback_handler(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    query = update.callback_query
+    kind, direction, service_id, account_id = query.data.split(":")
+    cursor = {"after_id" if direction == "next" else "before_id": int(account_id)}
+    page = await run_sync(
+        _load_account_page,
+        chat_id=update.effective_chat.id,
+        service_id=int(service_id),
+        **cursor,
+    )
+    if not page.accounts:
+        await query.answer("This list has changed, please send the command again.")
+        return
+    await query.answer()
+    await query.edit_message_text(
+        _PAGE_FORMATTERS[kind](page.service_name, page),
+        reply_markup=_page_keyboard(kind, page),
+    )
 
 
 @only_admins_or_creators
@@ -313,31 +491,29 @@ async def create_account_handler(
 ) -> None:
     text: str = update.effective_message.text
     chat_id: int = update.effective_chat.id
-    if not _check_args(text, [str, str, str]):
-        usage = """Usage: /create_account <service_name> <username> <password>"""
-        await context.bot.send_message(chat_id=chat_id, text=usage)
-        return
-
     args: List[str] = text.split()
     service_name: str = args[1]
     username: str = args[2]
     password: str = args[3]
     created_by: str = update.effective_user.username
-    _create_account(
+    if await run_sync(
+        _create_account,
         chat_id=chat_id,
         service_name=service_name,
         username=username,
         password=password,
         created_by=created_by,
-    )
-    msg = f"""Account {username} successfully created for service {service_name}
+    ):
+        msg = f"""Account {username} successfully created for service {service_name}
              \nTo tell everyone that you are using this account, enter the following command:
              \n  /use {service_name} {username}
              \n
              \nWhen you are not using this account anymore, just enter the following command:
              \n  /release {service_name} {username}
             """
-    await context.bot.send_message(chat_id=chat_id, text=msg)
+    else:
+        msg = "Service not found or account already exists"
+    await _send_message(context, chat_id=chat_id, text=msg)
 
 
 @only_admins_or_creators
@@ -346,25 +522,23 @@ async def update_account_handler(
 ) -> None:
     text: str = update.effective_message.text
     chat_id: int = update.effective_message.chat_id
-    if not _check_args(text, [str, str, str]):
-        usage = "Usage: /update_account [service_name] [username] [new_password]"
-        await context.bot.send_message(chat_id=chat_id, text=usage)
-
     args = text.split()
     service_name = args[1]
     username = args[2]
     new_password = args[3]
 
-    if _update_account(
+    updated = await run_sync(
+        _update_account,
         chat_id=chat_id,
         service=service_name,
         username=username,
         new_password=new_password,
-    ):
+    )
+    if updated:
         msg = "Account updated successfully"
     else:
         msg = "Service or Account not found"
-    await context.bot.send_message(chat_id=chat_id, text=msg)
+    await _send_message(context, chat_id=chat_id, text=msg)
 
 
 @only_admins_or_creators
@@ -373,91 +547,379 @@ async def delete_account_handler(
 ) -> None:
     text: str = update.effective_message.text
     chat_id: int = update.effective_message.chat_id
-    if not _check_args(text, [str, str]):
-        usage = "Usage: /delete_account <service_name> <username>"
-        await context.bot.send_message(chat_id=chat_id, text=usage)
-        return
-
     args: List[str] = text.split()
     service_name: str = args[1]
     username: str = args[2]
-    if _delete_account(chat_id=chat_id, service=service_name, username=username):
+    deleted = await run_sync(
+        _delete_account, chat_id=chat_id, service=service_name, username=username
+    )
+    if deleted:
         msg = "Account deleted successfully"
     else:
         msg = "Account not found"
-    await context.bot.send_message(chat_id=chat_id, text=msg)
+    await _send_message(context, chat_id=chat_id, text=msg)
 
 
-async def report_broken_handler(
+@only_admins_or_creators
+async def import_accounts_handler(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
+    message = update.effective_message
+    chat_id: int = update.effective_chat.id
+    service_name: str = (message.text or message.caption).split()[1]
+    document = message.document or (
+        message.reply_to_message and message.reply_to_message.document
+    )
+    if document is None:
+        msg = f"""Send a CSV or JSON file with username and password columns and the caption:
+            \n/import_accounts {service_name}
+            \nor reply to that file with the command."""
+        await _send_message(context, chat_id=chat_id, text=msg)
+        return
+    if document.file_size and document.file_size > _IMPORT_MAX_BYTES:
+        msg = f"File too large, the limit is {_IMPORT_MAX_BYTES} bytes"
+        await _send_message(context, chat_id=chat_id, text=msg)
+        return
+
+    file = await context.bot.get_file(document.file_id)
+    content = bytes(await file.download_as_bytearray())
+    try:
+        rows = _parse_accounts_document(content, document.file_name or "")
+    except ValueError as err:
+        msg = f"Could not read {document.file_name}: {err}"
+        await _send_message(context, chat_id=chat_id, text=msg)
+        return
+
+    results = await run_sync(
+        _import_accounts,
+        chat_id=chat_id,
+        service=service_name,
+        rows=rows,
+        created_by=update.effective_user.username,
+    )
+    if results is None:
+        await _send_message(context, chat_id=chat_id, text="Service not found")
+        return
+    created = sum(1 for _, _, result in results if result == "created")
+    msg = f"Imported {created} of {len(results)} account(s) for service {service_name}."
+    await _send_message(context, chat_id=chat_id, text=msg)
+
+    report = io.StringIO()
+    writer = csv.writer(report)
+    writer.writerow(["row", "username", "result"])
+    writer.writerows(results)
+    await _send_document(
+        context,
+        chat_id=chat_id,
+        document=report.getvalue().encode(),
+        filename=f"import_{service_name}_report.csv",
+    )
+
+
+@only_admins_or_creators
+async def export_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text: str = update.effective_message.text
     chat_id: int = update.effective_chat.id
-    if not _check_args(text, [str, str]):
-        usage = "Usage: /report_broken <service_name> <username>"
-        await context.bot.send_message(chat_id=chat_id, text=usage)
+    args: List[str] = text.split()
+    service_name: Optional[str] = args[1] if len(args) > 1 else None
+
+    document = await run_sync(_export_accounts, chat_id=chat_id, service=service_name)
+    if document is None:
+        msg = "Service not found" if service_name else "No services available."
+        await _send_message(context, chat_id=chat_id, text=msg)
         return
+    await _send_document(
+        context,
+        chat_id=chat_id,
+        document=document,
+        filename=f"{service_name or 'services'}.csv",
+    )
+
 
+async def report_broken_handler(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    text: str = update.effective_message.text
+    chat_id: int = update.effective_chat.id
     args = text.split()
     service_name = args[1]
     username = args[2]
     reporter = update.effective_user.username
-    admins = await context.bot.get_chat_administrators(chat_id=chat_id)
-    cite_admins = ", ".join([f"@{admin.user.username}" for admin in admins])
+    if _broken_reports.get((chat_id, service_name, username)) is not None:
+        # the admins were already pinged and the chat told, stay quiet
+        return
+
+    admins = await _get_admin_usernames(chat_id, context)
+    cite_admins = ", ".join([f"@{admin}" for admin in admins])
     msg = f"""Hi {cite_admins}.\n@{reporter} reported service {service_name} username {username} broken."""
-    await context.bot.send_message(chat_id=chat_id, text=msg)
+    await _send_message(context, chat_id=chat_id, text=msg)
+    # only once the ping is on its way, so a failure lets the next report retry;
+    # reports of a chat run one at a time under its lock
+    _broken_reports.set((chat_id, service_name, username), reporter)
+
+
+@only_admins_or_creators
+async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await _send_message(
+        context, chat_id=update.effective_chat.id, text=metrics.registry.summary()
+    )
 
 
 # actions handlers
 async def use_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text: str = update.effective_message.text
     chat_id: int = update.effective_message.chat_id
-    if not _check_args(text, [str, str]):
-        usage = "Usage: /use <service_name> <username>"
-        await context.bot.send_message(chat_id=chat_id, text=usage)
-        return
-
     args = text.split()
     service_name = args[1]
-    username = args[2]
     current_user = update.effective_user.username
-    if _use(
+    if len(args) < 3:
+        # no account named: claim the least recently used free one
+        account = await run_sync(
+            _use_any, chat_id=chat_id, service=service_name, current_user=current_user
+        )
+        if account is not None:
+            username, password = account
+            msg = f"You are now using service {service_name} with account {username}\nPassword: {password}"
+        else:
+            msg = f"No free account for service {service_name}, or the service does not exist"
+        await _send_message(context, chat_id=chat_id, text=msg)
+        return
+    username = args[2]
+    used = await run_sync(
+        _use,
         chat_id=chat_id,
         service=service_name,
         username=username,
         current_user=current_user,
-    ):
+    )
+    if used:
         msg = f"You are now using service {service_name} with account {username}"
     else:
         msg = "Account not found or the account is already being used"
-    await context.bot.send_message(chat_id=chat_id, text=msg)
+    await _send_message(context, chat_id=chat_id, text=msg)
 
 
 async def release_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text: str = update.effective_message.text
     chat_id: int = update.effective_message.chat_id
-    if not _check_args(text, [str, str]):
-        usage = "Usage: /release <service_name> <username>"
-        await context.bot.send_message(chat_id=chat_id, text=usage)
-        return
-
     args = text.split()
     service_name = args[1]
     username = args[2]
     current_user = update.effective_user.username
-    if _release(
+    released = await run_sync(
+        _release,
         chat_id=chat_id,
         service=service_name,
         username=username,
         current_user=current_user,
-    ):
+    )
+    if released:
         msg = "Account released successfully"
     else:
         msg = "Account not found or not being used by you"
-    await context.bot.send_message(chat_id=chat_id, text=msg)
+    await _send_message(context, chat_id=chat_id, text=msg)
+
+
+async def _get_chat_view(chat_id: int) -> Dict[str, List[AccountView]]:
+    with _chat_views_lock:
+        view = _chat_views.get(chat_id)
+        if view is not None:
+            return view
+        loads = _chat_loads.setdefault(chat_id, [0, 0])
+        loads[0] += 1
+        generation = loads[1]
+    try:
+        view = await run_sync(_load_chat_view, chat_id=chat_id)
+        with _chat_views_lock:
+            if generation == loads[1]:
+                _chat_views.set(chat_id, view)
+    finally:
+        with _chat_views_lock:
+            loads[0] -= 1
+            if not loads[0]:
+                del _chat_loads[chat_id]
+    return view
+
+
+def disable_chat_caches() -> None:
+    """Load chat views and the chats of inline users from the database every time.
+    For processes that share the database with others whose writes would never
+    invalidate their copy."""
+    for cache in (_chat_views, _prefix_indexes, _user_chats):
+        cache.maxsize = 0
+        cache.clear()
+
+
+def _invalidate_chat(chat_id: int) -> None:
+    with _chat_views_lock:
+        loads = _chat_loads.get(chat_id)
+        if loads is not None:
+            loads[1] += 1
+        _chat_views.pop(chat_id)
+
+
+def _load_chat_view(chat_id: int) -> Dict[str, List[AccountView]]:
+    # plain column rows, no ORM objects are built or kept in the identity map
+    view: Dict[str, List[AccountView]] = {}
+    with Session() as session:
+        for row in session.execute(_CHAT_VIEW_ROWS, dict(chat_id=chat_id)):
+            accounts = view.setdefault(row.name, [])
+            # a service without accounts comes back as one row of NULL columns
+            if row.username is not None:
+                accounts.append(AccountView._make(row))
+    return view
+
+
+class AccountPage(NamedTuple):
+    service_id: Optional[int]
+    service_name: Optional[str]
+    accounts: List[AccountView]
+    first_id: Optional[int]
+    last_id: Optional[int]
+    has_previous: bool
+    has_next: bool
+
+
+def _load_account_page(
+    chat_id: int,
+    service_name: Optional[str] = None,
+    service_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    page_size: Optional[int] = None,
+) -> AccountPage:
+    """Accounts of a service ordered by username, starting after (or ending before)
+    the username of the given account. One query using the (service_id, username)
+    index, fetching a single row more than the page to know if there is another."""
+    page_size = page_size or _PAGE_SIZE
+    statement = (
+        select(
+            Account.account_id,
+            Account.service_id,
+            Service.name,
+            Account.username,
+            Account.password,
+            Account.grabbed_at,
+            Account.grabbed_by,
+            Account.released_at,
+        )
+        .join(Service, Account.service_id == Service.service_id)
+        .where(Service.chat_id == chat_id)
+        .limit(page_size + 1)
+    )
+    if service_id is not None:
+        statement = statement.where(Account.service_id == service_id)
+    else:
+        statement = statement.where(Service.name == service_name)
+    cursor_id = before_id if before_id is not None else after_id
+    if cursor_id is not None:
+        cursor = (
+            select(Account.username)
+            .where(Account.account_id == cursor_id)
+            .scalar_subquery()
+        )
+    if before_id is not None:
+        statement = statement.where(Account.username < cursor).order_by(
+            Account.username.desc()
+        )
+    elif after_id is not None:
+        statement = statement.where(Account.username > cursor).order_by(
+            Account.username
+        )
+    else:
+        statement = statement.order_by(Account.username)
+
+    with Session() as session:
+        rows = session.execute(statement).all()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if before_id is not None:
+        rows.reverse()
+    return AccountPage(
+        service_id=rows[0].service_id if rows else service_id,
+        service_name=rows[0].name if rows else service_name,
+        accounts=[
+            AccountView(
+                service=row.name,
+                username=row.username,
+                password=row.password,
+                grabbed_at=row.grabbed_at,
+                grabbed_by=row.grabbed_by,
+                released_at=row.released_at,
+            )
+            for row in rows
+        ],
+        first_id=rows[0].account_id if rows else None,
+        last_id=rows[-1].account_id if rows else None,
+        has_previous=has_more if before_id is not None else after_id is not None,
+        has_next=has_more if before_id is None else True,
+    )
 
 
-def _create_service(chat_id: int, service: str, username: str) -> None:
+def _ranking(chat_id: int, service_name: str) -> List[Tuple[str, float]]:
+    with Session() as session:
+        service_id = session.execute(
+            select(Service.service_id)
+            .where(Service.chat_id == chat_id)
+            .where(Service.name == service_name)
+        ).scalar_one_or_none()
+        if service_id is None:
+            return []
+        durations = dict(
+            session.execute(
+                select(UsageTotal.performed_by, UsageTotal.seconds).where(
+                    UsageTotal.service_id == service_id
+                )
+            ).all()
+        )
+        # sessions still open are not in usage_total yet
+        open_usages = session.execute(
+            select(Usage.performed_by, Usage.started_at)
+            .join(Account, Usage.account_id == Account.account_id)
+            .where(Account.service_id == service_id)
+            .where(Usage.finished_at.is_(None))
+        ).all()
+    now = datetime.now()
+    for performed_by, started_at in open_usages:
+        durations[performed_by] = (
+            durations.get(performed_by, 0) + (now - started_at).total_seconds()
+        )
+    return sorted(durations.items(), key=lambda r: r[1], reverse=True)
+
+
+# the select skips services deleted meanwhile, e.g. between a /release and the
+# journal writing its usage
+_INSERT_USAGE_TOTAL = insert(UsageTotal).from_select(
+    [UsageTotal.service_id, UsageTotal.performed_by, UsageTotal.seconds],
+    select(
+        Service.service_id,
+        bindparam("b_performed_by", type_=UsageTotal.performed_by.type),
+        bindparam("b_seconds", type_=UsageTotal.seconds.type),
+    ).where(Service.service_id == bindparam("b_service_id")),
+)
+
+
+def _add_usage_seconds(
+    session, service_id: int, performed_by: str, seconds: float
+) -> None:
+    updated = session.execute(
+        update(UsageTotal)
+        .where(UsageTotal.service_id == service_id)
+        .where(UsageTotal.performed_by == performed_by)
+        .values(seconds=UsageTotal.seconds + seconds)
+        .execution_options(synchronize_session=False)
+    )
+    if updated.rowcount == 0:
+        session.connection().execute(
+            _INSERT_USAGE_TOTAL,
+            dict(
+                b_service_id=service_id, b_performed_by=performed_by, b_seconds=seconds
+            ),
+        )
+
+
+def _create_service(chat_id: int, service: str, username: str) -> bool:
+    result = False
     with Session() as session:
         service = Service(
             chat_id=chat_id,
@@ -466,49 +928,200 @@ def _create_service(chat_id: int, service: str, username: str) -> None:
             created_at=datetime.now(),
         )
         session.add(service)
-        session.commit()
+        try:
+            session.commit()
+            result = True
+            _invalidate_chat(chat_id)
+        except IntegrityError:
+            session.rollback()
+    return result
 
 
 def _update_service(chat_id: int, service: str, new_service: str) -> bool:
     result = False
     with Session() as session:
-        service = (
-            session.query(Service)
-            .filter(Service.name == service)
-            .filter(Service.chat_id == chat_id)
-            .one_or_none()
-        )
+        service = session.scalars(
+            _SERVICE_BY_NAME, dict(chat_id=chat_id, service=service)
+        ).one_or_none()
         if service:
             service.name = new_service
-            session.commit()
-            result = True
+            try:
+                session.commit()
+                result = True
+                _invalidate_chat(chat_id)
+            except IntegrityError:
+                session.rollback()
     return result
 
 
+def _set_grab_ttl(chat_id: int, service: str, grab_ttl: Optional[int]) -> bool:
+    with Session() as session:
+        updated = session.execute(
+            update(Service)
+            .where(Service.chat_id == chat_id)
+            .where(Service.name == service)
+            .values(grab_ttl=grab_ttl)
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+    return updated.rowcount > 0
+
+
+class ExpiredGrab(NamedTuple):
+    chat_id: int
+    service: str
+    username: str
+    grabbed_by: str
+    grabbed_at: datetime
+
+
+def _release_expired(global_ttl: Optional[float] = None) -> List[ExpiredGrab]:
+    """Release every grab older than its service TTL (or ``global_ttl`` seconds).
+
+    Costs the same handful of statements however many accounts expire: one
+    UPDATE on account, one on usage, and bulk statements for the usage totals.
+    """
+    now = datetime.now()
+    with Session() as session:
+        overrides = session.execute(
+            select(Service.service_id, Service.grab_ttl).where(
+                Service.grab_ttl.is_not(None)
+            )
+        ).all()
+        global_cutoff = now - timedelta(seconds=global_ttl) if global_ttl else None
+        if not overrides and global_cutoff is None:
+            return []
+        cutoff = (
+            case(
+                {
+                    service_id: now - timedelta(seconds=grab_ttl)
+                    for service_id, grab_ttl in overrides
+                },
+                value=Account.service_id,
+                else_=global_cutoff,
+            )
+            if overrides
+            else global_cutoff
+        )
+        released = session.execute(
+            update(Account)
+            # accounts of deleted services are left with no service to notify
+            .where(Account.service_id.is_not(None))
+            .where(Account.released_at.is_(None))
+            .where(Account.grabbed_at.is_not(None))
+            .where(Account.grabbed_at < cutoff)
+            .values(released_at=now)
+            .returning(
+                Account.account_id,
+                Account.service_id,
+                Account.username,
+                Account.grabbed_by,
+                Account.grabbed_at,
+            )
+            .execution_options(synchronize_session=False)
+        ).all()
+        if not released:
+            return []
+        service_ids = {account.account_id: account.service_id for account in released}
+        closed = session.execute(
+            update(Usage)
+            .where(Usage.account_id.in_(service_ids))
+            .where(Usage.finished_at.is_(None))
+            .values(finished_at=now)
+            .returning(Usage.account_id, Usage.performed_by, Usage.started_at)
+            .execution_options(synchronize_session=False)
+        ).all()
+        totals = defaultdict(float)
+        for account_id, performed_by, started_at in closed:
+            totals[(service_ids[account_id], performed_by)] += (
+                now - started_at
+            ).total_seconds()
+        _add_usage_totals(session, totals)
+        services = dict(
+            (service_id, (chat_id, name))
+            for service_id, chat_id, name in session.execute(
+                select(Service.service_id, Service.chat_id, Service.name).where(
+                    Service.service_id.in_(set(service_ids.values()))
+                )
+            )
+        )
+        session.commit()
+    expired = [
+        ExpiredGrab(
+            chat_id=services[account.service_id][0],
+            service=services[account.service_id][1],
+            username=account.username,
+            grabbed_by=account.grabbed_by,
+            grabbed_at=account.grabbed_at,
+        )
+        for account in released
+    ]
+    for chat_id in {grab.chat_id for grab in expired}:
+        _invalidate_chat(chat_id)
+    return expired
+
+
+def _add_usage_totals(session, totals: Dict[Tuple[int, str], float]) -> None:
+    """Bulk version of _add_usage_seconds: one SELECT, one UPDATE and one INSERT."""
+    if not totals:
+        return
+    existing = set(
+        session.execute(
+            select(UsageTotal.service_id, UsageTotal.performed_by)
+            .where(UsageTotal.service_id.in_({key[0] for key in totals}))
+            .where(UsageTotal.performed_by.in_({key[1] for key in totals}))
+        ).all()
+    )
+    updates = [
+        dict(b_service_id=service_id, b_performed_by=performed_by, b_seconds=seconds)
+        for (service_id, performed_by), seconds in totals.items()
+        if (service_id, performed_by) in existing
+    ]
+    inserts = [
+        dict(b_service_id=service_id, b_performed_by=performed_by, b_seconds=seconds)
+        for (service_id, performed_by), seconds in totals.items()
+        if (service_id, performed_by) not in existing
+    ]
+    if updates:
+        session.connection().execute(
+            update(UsageTotal)
+            .where(UsageTotal.service_id == bindparam("b_service_id"))
+            .where(UsageTotal.performed_by == bindparam("b_performed_by"))
+            .values(seconds=UsageTotal.seconds + bindparam("b_seconds")),
+            updates,
+        )
+    if inserts:
+        session.connection().execute(_INSERT_USAGE_TOTAL, inserts)
+
+
 def _delete_service(chat_id: int, service: str) -> bool:
     result = False
+    # usage totals still queued would outlive the service
+    _usage_journal.flush()
     with Session() as session:
-        service = (
-            session.query(Service)
-            .filter(Service.chat_id == chat_id, Service.name == service)
-            .one_or_none()
-        )
+        service = session.scalars(
+            _SERVICE_BY_NAME, dict(chat_id=chat_id, service=service)
+        ).one_or_none()
         if service:
+            for model in (UsageTotal, UsageDaily):
+                session.execute(
+                    delete(model).where(model.service_id == service.service_id)
+                )
             session.delete(service)
             session.commit()
             result = True
+            _invalidate_chat(chat_id)
     return result
 
 
 def _create_account(
     chat_id: int, service_name: str, username: str, password: str, created_by: str
-) -> None:
+) -> bool:
+    result = False
     with Session() as session:
-        service = (
-            session.query(Service)
-            .filter_by(chat_id=chat_id, name=service_name)
-            .one_or_none()
-        )
+        service = session.scalars(
+            _SERVICE_BY_NAME, dict(chat_id=chat_id, service=service_name)
+        ).one_or_none()
         if service:
             account = Account(
                 service=service,
@@ -518,109 +1131,490 @@ def _create_account(
                 created_at=datetime.now(),
             )
             session.add(account)
-            session.commit()
+            try:
+                session.commit()
+                result = True
+                _invalidate_chat(chat_id)
+            except IntegrityError:
+                session.rollback()
+    return result
 
 
 def _update_account(
     chat_id: int, service: str, username: str, new_password: str
 ) -> bool:
-    result = False
     with Session() as session:
-        account = (
-            session.query(Account)
-            .join(Service)
-            .filter(Service.service_id == Account.service_id)
-            .filter(Service.chat_id == chat_id)
-            .filter(Service.name == service)
-            .filter(Account.username == username)
-            .one_or_none()
+        updated = session.execute(
+            _UPDATE_PASSWORD,
+            dict(
+                chat_id=chat_id,
+                service=service,
+                account_username=username,
+                new_password=new_password,
+            ),
         )
-        if account:
-            account.password = new_password
-            session.commit()
-            result = True
-    return result
+        session.commit()
+    if updated.rowcount == 0:
+        return False
+    _invalidate_chat(chat_id)
+    return True
 
 
 def _delete_account(chat_id: int, service: str, username: str) -> bool:
     result = False
+    _usage_journal.flush()
     with Session() as session:
-        account = (
-            session.query(Account)
-            .join(Service)
-            .filter(Account.username == username)
-            .filter(Service.name == service)
-            .filter(Service.chat_id == chat_id)
-            .one_or_none()
-        )
+        account = session.scalars(
+            _ACCOUNT_BY_NAME,
+            dict(chat_id=chat_id, service=service, username=username),
+        ).one_or_none()
         if account:
             session.delete(account)
             session.commit()
             result = True
+            _invalidate_chat(chat_id)
     return result
 
 
+def _import_accounts(
+    chat_id: int, service: str, rows: List[Tuple[str, str]], created_by: str
+) -> Optional[List[Tuple[int, str, str]]]:
+    """Insert the rows in batches, returning (row, username, result) for each one."""
+    results = []
+    pending = []
+    seen = set()
+    for row, (username, password) in enumerate(rows, start=1):
+        if not username or not password:
+            results.append((row, username, "missing username or password"))
+        elif username in seen:
+            results.append((row, username, "duplicated in file"))
+        else:
+            seen.add(username)
+            pending.append((row, username, password))
+
+    now = datetime.now()
+    with Session() as session:
+        service_id = session.execute(
+            select(Service.service_id)
+            .where(Service.chat_id == chat_id)
+            .where(Service.name == service)
+        ).scalar_one_or_none()
+        if service_id is None:
+            return None
+        for start in range(0, len(pending), _IMPORT_BATCH_SIZE):
+            batch = pending[start : start + _IMPORT_BATCH_SIZE]
+            existing = set(
+                session.scalars(
+                    select(Account.username)
+                    .where(Account.service_id == service_id)
+                    .where(Account.username.in_([username for _, username, _ in batch]))
+                )
+            )
+            new_accounts = [
+                (row, username, password)
+                for row, username, password in batch
+                if username not in existing
+            ]
+            try:
+                if new_accounts:
+                    session.execute(
+                        insert(Account),
+                        [
+                            dict(
+                                service_id=service_id,
+                                username=username,
+                                password=password,
+                                created_by=created_by,
+                                created_at=now,
+                            )
+                            for _, username, password in new_accounts
+                        ],
+                    )
+                session.commit()
+                created = "created"
+            except IntegrityError:
+                # someone created one of these accounts meanwhile, skip the batch
+                session.rollback()
+                created = "not created, please retry"
+            results.extend(
+                (row, username, "already exists" if username in existing else created)
+                for row, username, _ in batch
+            )
+    _invalidate_chat(chat_id)
+    return sorted(results)
+
+
+def _export_accounts(chat_id: int, service: Optional[str] = None):
+    """Write the chat's services and accounts as CSV to a spooled temporary file."""
+    statement = (
+        select(Service.name, Account.username, Account.password)
+        .outerjoin(Account, Account.service_id == Service.service_id)
+        .where(Service.chat_id == chat_id)
+        .order_by(Service.name, Account.username)
+        .execution_options(yield_per=500)
+    )
+    if service is not None:
+        statement = statement.where(Service.name == service)
+
+    document = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    writer_stream = io.TextIOWrapper(document, encoding="utf-8", newline="")
+    writer = csv.writer(writer_stream)
+    writer.writerow(["service", "username", "password"])
+    rows = 0
+    with Session() as session:
+        for partition in session.execute(statement).partitions():
+            writer.writerows(partition)
+            rows += len(partition)
+    writer_stream.flush()
+    writer_stream.detach()
+    if rows == 0:
+        document.close()
+        return None
+    document.seek(0)
+    return document
+
+
+# Statements of the command helpers, built once like the finders in models.
+_SERVICE_ID = (
+    select(Service.service_id)
+    .where(Service.chat_id == bindparam("chat_id"))
+    .where(Service.name == bindparam("service"))
+    .scalar_subquery()
+)
+_SERVICE_BY_NAME = (
+    select(Service)
+    .where(Service.chat_id == bindparam("chat_id"))
+    .where(Service.name == bindparam("service"))
+)
+_ACCOUNT_BY_NAME = (
+    select(Account)
+    .join(Service, Account.service_id == Service.service_id)
+    .where(Service.chat_id == bindparam("chat_id"))
+    .where(Service.name == bindparam("service"))
+    .where(Account.username == bindparam("username"))
+)
+# columns in the order of the AccountView fields
+_CHAT_VIEW_ROWS = (
+    select(
+        Service.name,
+        Account.username,
+        Account.password,
+        Account.grabbed_at,
+        Account.grabbed_by,
+        Account.released_at,
+    )
+    .outerjoin(Account, Account.service_id == Service.service_id)
+    .where(Service.chat_id == bindparam("chat_id"))
+    .order_by(Service.name, Account.username)
+)
+_AVAILABLE = or_(Account.grabbed_at.is_(None), Account.released_at.is_not(None))
+_UPDATE_PASSWORD = (
+    update(Account)
+    .where(Account.service_id == _SERVICE_ID)
+    .where(Account.username == bindparam("account_username"))
+    .values(password=bindparam("new_password"))
+    .execution_options(synchronize_session=False)
+)
+# grabs the account only if it is still available, in a single statement
+_GRAB = (
+    update(Account)
+    .where(Account.service_id == _SERVICE_ID)
+    .where(Account.username == bindparam("account_username"))
+    .where(_AVAILABLE)
+    .values(grabbed_at=bindparam("now"), released_at=None, grabbed_by=bindparam("user"))
+    .returning(Account.account_id)
+    .execution_options(synchronize_session=False)
+)
+_GRAB_LEAST_RECENTLY_USED = (
+    update(Account)
+    .where(
+        Account.account_id
+        == select(Account.account_id)
+        .where(Account.service_id == _SERVICE_ID)
+        .where(_AVAILABLE)
+        .order_by(Account.grabbed_at.asc().nulls_first(), Account.account_id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    # the availability is checked again, a concurrent grab makes it miss
+    .where(_AVAILABLE)
+    .values(grabbed_at=bindparam("now"), released_at=None, grabbed_by=bindparam("user"))
+    .returning(Account.account_id, Account.username, Account.password)
+    .execution_options(synchronize_session=False)
+)
+_ANY_AVAILABLE = (
+    select(Account.account_id)
+    .where(Account.service_id == _SERVICE_ID)
+    .where(_AVAILABLE)
+    .limit(1)
+)
+_RELEASE = (
+    update(Account)
+    .where(Account.service_id == _SERVICE_ID)
+    .where(Account.username == bindparam("account_username"))
+    .where(Account.grabbed_by == bindparam("user"))
+    .where(Account.released_at.is_(None))
+    .values(released_at=bindparam("now"))
+    .returning(Account.account_id, Account.service_id, Account.grabbed_at)
+    .execution_options(synchronize_session=False)
+)
+# executemany statements of the usage journal, the select drops the sessions of
+# accounts deleted before the group was written
+_OPEN_USAGES = insert(Usage).from_select(
+    [Usage.account_id, Usage.performed_by, Usage.started_at],
+    select(
+        Account.account_id,
+        bindparam("b_performed_by", type_=Usage.performed_by.type),
+        bindparam("b_started_at", type_=Usage.started_at.type),
+    ).where(Account.account_id == bindparam("b_account_id")),
+)
+_CLOSE_USAGES = (
+    update(Usage)
+    .where(Usage.account_id == bindparam("b_account_id"))
+    .where(Usage.performed_by == bindparam("b_performed_by"))
+    .where(Usage.finished_at.is_(None))
+    # a later grab by the same user may be in the same group
+    .where(Usage.started_at <= bindparam("b_finished_at"))
+    .values(finished_at=bindparam("b_finished_at"))
+)
+
+
+class UsageOpened(NamedTuple):
+    account_id: int
+    performed_by: str
+    started_at: datetime
+
+
+class UsageClosed(NamedTuple):
+    account_id: int
+    service_id: int
+    performed_by: str
+    started_at: datetime
+    finished_at: datetime
+
+
+def _write_usage(session, events: List) -> None:
+    opens = [
+        dict(
+            b_account_id=e.account_id,
+            b_performed_by=e.performed_by,
+            b_started_at=e.started_at,
+        )
+        for e in events
+        if isinstance(e, UsageOpened)
+    ]
+    closes = [e for e in events if isinstance(e, UsageClosed)]
+    if opens:
+        session.connection().execute(_OPEN_USAGES, opens)
+    if not closes:
+        return
+    session.connection().execute(
+        _CLOSE_USAGES,
+        [
+            dict(
+                b_account_id=e.account_id,
+                b_performed_by=e.performed_by,
+                b_finished_at=e.finished_at,
+            )
+            for e in closes
+        ],
+    )
+    totals = defaultdict(float)
+    for e in closes:
+        totals[(e.service_id, e.performed_by)] += (
+            e.finished_at - e.started_at
+        ).total_seconds()
+    if len(totals) == 1:
+        [((service_id, performed_by), seconds)] = totals.items()
+        _add_usage_seconds(session, service_id, performed_by, seconds)
+    else:
+        _add_usage_totals(session, totals)
+
+
+# Usage rows are written behind the account changes, grouped into one transaction
+# per interval (see BotApplication). Availability lives in the account rows, which
+# are always committed before the command replies.
+_usage_journal = WriteBehindJournal(
+    _write_usage,
+    interval=float(os.getenv("USAGE_JOURNAL_INTERVAL_MS", "5")) / 1000,
+    max_events=int(os.getenv("USAGE_JOURNAL_MAX_EVENTS", "100")),
+)
+metrics.registry.register_gauge("usage_journal_depth", lambda: _usage_journal.depth)
+metrics.registry.register_gauge("usage_journal_dropped", lambda: _usage_journal.dropped)
+
+
 def _use(chat_id: int, service: str, username: str, current_user: str) -> bool:
-    result = False
+    now = datetime.now()
     with Session() as session:
-        available_account = (
-            session.query(Account)
-            .join(Service)
-            .filter(Account.service_id == Service.service_id)
-            .filter(Service.chat_id == chat_id)
-            .filter(Service.name == service)
-            .filter(Account.username == username)
-            .filter(or_(Account.grabbed_at.is_(None), Account.released_at.is_not(None)))
-        ).one_or_none()
-        if available_account:
-            available_account.grabbed_at = datetime.now()
-            available_account.released_at = None
-            available_account.grabbed_by = current_user
-
-            usage = Usage(
-                account_id=available_account.account_id,
-                performed_by=current_user,
-                started_at=datetime.now(),
+        account_id = session.execute(
+            _GRAB,
+            dict(
+                chat_id=chat_id,
+                service=service,
+                account_username=username,
+                user=current_user,
+                now=now,
+            ),
+        ).scalar_one_or_none()
+        if account_id is None:
+            return False
+        _usage_journal.commit(session, [UsageOpened(account_id, current_user, now)])
+    _invalidate_chat(chat_id)
+    return True
+
+
+def _use_any(
+    chat_id: int, service: str, current_user: str, attempts: int = 3
+) -> Optional[Tuple[str, str]]:
+    """Grab the least recently used free account of the service, returning its
+    username and password."""
+    for _ in range(attempts):
+        now = datetime.now()
+        with Session() as session:
+            account = session.execute(
+                _GRAB_LEAST_RECENTLY_USED,
+                dict(chat_id=chat_id, service=service, user=current_user, now=now),
+            ).one_or_none()
+            if account is None:
+                if (
+                    session.execute(
+                        _ANY_AVAILABLE, dict(chat_id=chat_id, service=service)
+                    ).first()
+                    is None
+                ):
+                    return None
+                continue
+            _usage_journal.commit(
+                session, [UsageOpened(account.account_id, current_user, now)]
             )
-            session.add(usage)
-            session.commit()
-            result = True
-    return result
+        _invalidate_chat(chat_id)
+        return account.username, account.password
+    return None
 
 
 def _release(chat_id: int, service: str, username: str, current_user: str) -> bool:
-    result = False
+    now = datetime.now()
     with Session() as session:
         try:
-            account = (
-                session.query(Account)
-                .join(Service)
-                .filter(Account.service_id == Service.service_id)
-                .filter(Service.chat_id == chat_id)
-                .filter(Service.name == service)
-                .filter(Account.username == username)
-                .filter(Account.grabbed_by == current_user)
-                .filter(Account.released_at.is_(None))
-                .one_or_none()
+            account = session.execute(
+                _RELEASE,
+                dict(
+                    chat_id=chat_id,
+                    service=service,
+                    account_username=username,
+                    user=current_user,
+                    now=now,
+                ),
+            ).one_or_none()
+            if account is None:
+                return False
+            account_id, service_id, grabbed_at = account
+            _usage_journal.commit(
+                session,
+                [UsageClosed(account_id, service_id, current_user, grabbed_at, now)],
             )
-            if account:
-                account.released_at = datetime.now()
-                usages = (
-                    session.query(Usage)
-                    .filter(Usage.account_id == account.account_id)
-                    .filter(Usage.performed_by == current_user)
-                    .filter(Usage.finished_at.is_(None))
-                    .all()
-                )
-                now = datetime.now()
-                for usage in usages:
-                    usage.finished_at = now
-                session.commit()
-                result = True
         except Exception as e:
             session.rollback()
             print(e)
-    return result
+            return False
+    _invalidate_chat(chat_id)
+    return True
+
+
+def _recover_usage() -> Tuple[int, int]:
+    """Repair the usage rows a crash left behind the account rows, returning how
+    many were closed and opened.
+
+    Usage still open for an account released or grabbed again since then is closed
+    at that time; an account in use without an open usage row gets one. A session
+    opened and closed within the last unwritten group is lost.
+    """
+    with Session() as session:
+        finished_at = case(
+            (Account.released_at.is_not(None), Account.released_at),
+            else_=Account.grabbed_at,
+        )
+        stale = session.execute(
+            select(
+                Usage.usage_id,
+                Account.service_id,
+                Usage.performed_by,
+                Usage.started_at,
+                finished_at.label("finished_at"),
+            )
+            .join(Account, Usage.account_id == Account.account_id)
+            .where(Usage.finished_at.is_(None))
+            .where(
+                or_(
+                    Account.released_at.is_not(None),
+                    Account.grabbed_by != Usage.performed_by,
+                    Account.grabbed_at > Usage.started_at,
+                )
+            )
+        ).all()
+        if stale:
+            session.connection().execute(
+                update(Usage)
+                .where(Usage.usage_id == bindparam("b_usage_id"))
+                .values(finished_at=bindparam("b_finished_at")),
+                [
+                    dict(b_usage_id=row.usage_id, b_finished_at=row.finished_at)
+                    for row in stale
+                ],
+            )
+            totals = defaultdict(float)
+            for row in stale:
+                totals[(row.service_id, row.performed_by)] += max(
+                    (row.finished_at - row.started_at).total_seconds(), 0
+                )
+            _add_usage_totals(session, totals)
+        opened = session.execute(
+            insert(Usage).from_select(
+                [Usage.account_id, Usage.performed_by, Usage.started_at],
+                select(Account.account_id, Account.grabbed_by, Account.grabbed_at)
+                .where(Account.grabbed_at.is_not(None))
+                .where(Account.released_at.is_(None))
+                .where(
+                    ~select(Usage.usage_id)
+                    .where(Usage.account_id == Account.account_id)
+                    .where(Usage.performed_by == Account.grabbed_by)
+                    .where(Usage.finished_at.is_(None))
+                    .exists()
+                ),
+            )
+        ).rowcount
+        session.commit()
+    return len(stale), opened
+
+
+def _parse_accounts_document(content: bytes, file_name: str) -> List[Tuple[str, str]]:
+    """Read (username, password) pairs from a JSON list of objects or a CSV file
+    with a header row."""
+    try:
+        text = content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise ValueError("the file is not UTF-8 encoded")
+    if file_name.lower().endswith(".json") or text.lstrip().startswith("["):
+        try:
+            records = json.loads(text)
+        except json.JSONDecodeError as err:
+            raise ValueError(f"invalid JSON ({err})")
+        if not isinstance(records, list) or not all(
+            isinstance(record, dict) for record in records
+        ):
+            raise ValueError("expected a list of objects")
+    else:
+        records = list(csv.DictReader(io.StringIO(text)))
+        if records and not {"username", "password"} <= set(records[0]):
+            raise ValueError("expected username and password columns")
+    return [
+        (
+            str(record.get("username") or "").strip(),
+            str(record.get("password") or "").strip(),
+        )
+        for record in records
+    ]
 
 
 def _check_args(args: str, expected_args: list) -> bool:
@@ -630,104 +1624,460 @@ def _check_args(args: str, expected_args: list) -> bool:
 async def _is_admin_or_creator(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> bool:
-    chat_member = await context.bot.get_chat_member(
-        chat_id=update.effective_chat.id, user_id=update.effective_user.id
+    key = (update.effective_chat.id, update.effective_user.id)
+    is_admin = _admin_cache.get(key)
+    if is_admin is None:
+        chat_member = await context.bot.get_chat_member(
+            chat_id=update.effective_chat.id, user_id=update.effective_user.id
+        )
+        is_admin = chat_member.status in [ChatMember.ADMINISTRATOR, ChatMember.OWNER]
+        _admin_cache.set(key, is_admin)
+    return is_admin
+
+
+async def _get_admin_usernames(
+    chat_id: int, context: ContextTypes.DEFAULT_TYPE
+) -> List[str]:
+    admins = _admin_roster_cache.get(chat_id)
+    if admins is None:
+        chat_administrators = await context.bot.get_chat_administrators(chat_id=chat_id)
+        admins = [
+            admin.user.username for admin in chat_administrators if admin.user.username
+        ]
+        _admin_roster_cache.set(chat_id, admins)
+    return admins
+
+
+async def inline_query_handler(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    query = update.inline_query
+    words = query.query.split()
+    prefix = words[0].lower() if words else ""
+    results = []
+    for chat_id in await _get_user_chats(query.from_user.id):
+        view = await _get_chat_view(chat_id)
+        for name in _get_prefix_index(chat_id, view).get(prefix, ()):
+            accounts = view[name]
+            free = sum(1 for account in accounts if account.available)
+            status = [f"Accounts of service {name}:"]
+            # the result may be posted in any chat, so no passwords
+            status.extend(
+                f"\n  *  {account.username}  ({account.available_display})"
+                for account in accounts
+            )
+            results.append(
+                InlineQueryResultArticle(
+                    id=f"{chat_id}:{len(results)}",
+                    title=name,
+                    description=f"{free} of {len(accounts)} account(s) available",
+                    input_message_content=InputTextMessageContent(
+                        "".join(status)[:MAX_MESSAGE_LENGTH]
+                    ),
+                )
+            )
+            if len(results) == _INLINE_MAX_RESULTS:
+                break
+        if len(results) == _INLINE_MAX_RESULTS:
+            break
+    kwargs = {}
+    if not results and not await _get_user_chats(query.from_user.id):
+        # the bot can only tell the user's chats once they used a command there
+        kwargs = dict(
+            switch_pm_text="Send a command in your group first",
+            switch_pm_parameter="inline",
+        )
+    await query.answer(
+        results, cache_time=_INLINE_CACHE_TIME, is_personal=True, **kwargs
     )
-    return chat_member.status in ["admin", "creator"]
 
 
-class RestrictedCommandHandler(CommandHandler):
-    def __init__(self, *args, **kwargs):
-        self.allowed_ids = kwargs.pop("allowed_ids", None)
-        super().__init__(*args, **kwargs)
+def _get_prefix_index(
+    chat_id: int, view: Dict[str, List[AccountView]]
+) -> Dict[str, List[str]]:
+    entry = _prefix_indexes.get(chat_id)
+    # a new view object means the chat changed since the index was built
+    if entry is None or entry[0] is not view:
+        index = defaultdict(list)
+        for name in view:
+            lowered = name.lower()
+            for length in range(len(lowered) + 1):
+                index[lowered[:length]].append(name)
+        entry = (view, dict(index))
+        _prefix_indexes.set(chat_id, entry)
+    return entry[1]
 
-    def check_update(self, update: Update):
-        if update.message is None or (
-            self.allowed_ids and f"{update.effective_chat.id}" not in self.allowed_ids
-        ):
-            return False
-        return super().check_update(update)
 
+async def _get_user_chats(user_id: int) -> Tuple[int, ...]:
+    chat_ids = _user_chats.get(user_id)
+    if chat_ids is None:
+        chat_ids = await run_sync(_load_user_chats, user_id=user_id)
+        _user_chats.set(user_id, chat_ids)
+    return chat_ids
 
-if __name__ == "__main__":
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
-    allowed_ids = os.getenv("ALLOWED_CHAT_IDS", None)
-    if allowed_ids:
-        allowed_ids = allowed_ids.split(",")
 
-    # generic handlers
-    application.add_handler(
-        RestrictedCommandHandler("start", start_handler, allowed_ids=allowed_ids)
-    )
-    application.add_handler(
-        RestrictedCommandHandler("help", help_handler, allowed_ids=allowed_ids)
-    )
-    application.add_handler(
-        RestrictedCommandHandler("status", status_handler, allowed_ids=allowed_ids)
-    )
-    application.add_handler(
-        RestrictedCommandHandler(
-            "status_me", status_me_handler, allowed_ids=allowed_ids
+def _load_user_chats(user_id: int) -> Tuple[int, ...]:
+    with Session() as session:
+        return tuple(
+            session.scalars(
+                select(ChatUser.chat_id)
+                .where(ChatUser.user_id == user_id)
+                .order_by(ChatUser.seen_at.desc())
+            )
         )
-    )
-    application.add_handler(
-        RestrictedCommandHandler("ranking", ranking_handler, allowed_ids=allowed_ids)
-    )
 
-    # service handlers
-    application.add_handler(
-        RestrictedCommandHandler("services", services_handler, allowed_ids=allowed_ids)
-    )
-    application.add_handler(
-        RestrictedCommandHandler(
-            "create_service", create_service_handler, allowed_ids=allowed_ids
+
+async def _remember_chat_user(chat_id: int, user_id: int) -> None:
+    if (chat_id, user_id) in _seen_chat_users:
+        return
+    await run_sync(_store_chat_user, chat_id=chat_id, user_id=user_id)
+    _seen_chat_users.set((chat_id, user_id), True)
+    _user_chats.pop(user_id)
+
+
+def _store_chat_user(chat_id: int, user_id: int) -> None:
+    with Session() as session:
+        updated = session.execute(
+            update(ChatUser)
+            .where(ChatUser.chat_id == chat_id)
+            .where(ChatUser.user_id == user_id)
+            .values(seen_at=datetime.now())
+            .execution_options(synchronize_session=False)
         )
+        if updated.rowcount == 0:
+            session.execute(
+                insert(ChatUser).values(
+                    chat_id=chat_id, user_id=user_id, seen_at=datetime.now()
+                )
+            )
+        try:
+            session.commit()
+        except IntegrityError:
+            # stored meanwhile by a concurrent update of the same user
+            session.rollback()
+
+
+async def chat_member_handler(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    member_update = update.chat_member
+    chat_id = member_update.chat.id
+    member = member_update.new_chat_member
+    _admin_cache.pop((chat_id, member.user.id))
+    _admin_roster_cache.pop(chat_id)
+    if member.status in (ChatMember.LEFT, ChatMember.BANNED):
+        # inline queries must stop showing the chat to a former member
+        await run_sync(_forget_chat_user, chat_id=chat_id, user_id=member.user.id)
+        _seen_chat_users.pop((chat_id, member.user.id))
+        _user_chats.pop(member.user.id)
+
+
+def _forget_chat_user(chat_id: int, user_id: int) -> None:
+    with Session() as session:
+        session.execute(
+            delete(ChatUser)
+            .where(ChatUser.chat_id == chat_id)
+            .where(ChatUser.user_id == user_id)
+        )
+        session.commit()
+
+
+class Command(NamedTuple):
+    callback: Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]
+    # arguments as shown by /help, optional ones between brackets
+    usage: str = ""
+    # changes the chat: runs after the changes sent before it in the same chat
+    writes: bool = False
+    # also sent as the caption of a file, where the handler reads it from
+    captions: bool = False
+
+
+COMMANDS: Dict[str, Command] = {
+    "start": Command(start_handler),
+    "help": Command(help_handler),
+    # service commands
+    "services": Command(services_handler),
+    "status": Command(status_handler, "<service_name>"),
+    "create_service": Command(create_service_handler, "<service_name>", writes=True),
+    "update_service": Command(
+        update_service_handler, "<service_name> <new_service_name>", writes=True
+    ),
+    "delete_service": Command(delete_service_handler, "<service_name>", writes=True),
+    "auto_release": Command(
+        auto_release_handler, "<service_name> [hours]", writes=True
+    ),
+    # account commands
+    "accounts": Command(accounts_handler, "<service_name>"),
+    "create_account": Command(
+        create_account_handler, "<service_name> <username> <password>", writes=True
+    ),
+    "update_account": Command(
+        update_account_handler, "<service_name> <username> <new_password>", writes=True
+    ),
+    "delete_account": Command(
+        delete_account_handler, "<service_name> <username>", writes=True
+    ),
+    "import_accounts": Command(
+        import_accounts_handler, "<service_name>", writes=True, captions=True
+    ),
+    "export": Command(export_handler, "[service_name]"),
+    # usage commands
+    "use": Command(use_handler, "<service_name> [username]", writes=True),
+    "release": Command(release_handler, "<service_name> <username>", writes=True),
+    "check": Command(check_handler, "<service_name>"),
+    "report_broken": Command(
+        report_broken_handler, "<service_name> <username>", writes=True
+    ),
+    "ranking": Command(ranking_handler, "<service_name>"),
+    "status_me": Command(status_me_handler),
+    "stats": Command(stats_handler),
+}
+
+
+class _Route(NamedTuple):
+    callback: Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]
+    min_args: int
+    max_args: int
+    usage: str
+    writes: bool
+    captions: bool
+
+
+class CommandRouter(BaseHandler):
+    """Single handler for every command: checks the allowed chats once and finds
+    the command with a dict lookup instead of trying one handler per command."""
+
+    def __init__(
+        self, commands: Dict[str, Command], allowed_ids: FrozenSet[int] = frozenset()
+    ):
+        # handle_update is overridden, so the callback is never called directly
+        super().__init__(self.handle_update)
+        self.allowed_ids = allowed_ids
+        self.routes: Dict[str, _Route] = {}
+        for name, command in commands.items():
+            args = command.usage.split()
+            self.routes[name] = _Route(
+                callback=metrics.track(name, command.callback),
+                min_args=sum(1 for arg in args if not arg.startswith("[")),
+                max_args=len(args),
+                usage=f"Usage: /{name} {command.usage}".rstrip(),
+                writes=command.writes,
+                captions=command.captions,
+            )
+
+    def check_update(self, update: object) -> Optional[Tuple[_Route, int]]:
+        if not isinstance(update, Update) or update.message is None:
+            return None
+        text = update.message.text
+        # commands sent along with a file come as its caption
+        from_caption = text is None
+        if from_caption:
+            text = update.message.caption
+        if not text or text[0] != "/":
+            return None
+        if self.allowed_ids and update.effective_chat.id not in self.allowed_ids:
+            return None
+        args = text.split()
+        command, _, bot_username = args[0][1:].partition("@")
+        if (
+            bot_username
+            and bot_username.lower() != update.message.get_bot().username.lower()
+        ):
+            return None
+        route = self.routes.get(command.lower())
+        if route is None or (from_caption and not route.captions):
+            return None
+        return route, len(args) - 1
+
+    async def handle_update(
+        self,
+        update: Update,
+        application: Application,
+        check_result: Tuple[_Route, int],
+        context: ContextTypes.DEFAULT_TYPE,
+    ) -> None:
+        route, args_count = check_result
+        if route.writes:
+            # taken before the first await, so the changes to a chat keep the
+            # order of their updates while reads run in parallel
+            async with _chat_locks(update.effective_chat.id):
+                await self._handle(update, route, args_count, context)
+        else:
+            await self._handle(update, route, args_count, context)
+
+    async def _handle(
+        self,
+        update: Update,
+        route: _Route,
+        args_count: int,
+        context: ContextTypes.DEFAULT_TYPE,
+    ) -> None:
+        if update.effective_user is not None:
+            await _remember_chat_user(
+                update.effective_chat.id, update.effective_user.id
+            )
+        if not route.min_args <= args_count <= route.max_args:
+            await _send_message(
+                context, chat_id=update.effective_chat.id, text=route.usage
+            )
+            return
+        await route.callback(update, context)
+
+
+def _parse_allowed_ids(value: Optional[str]) -> FrozenSet[int]:
+    return frozenset(
+        int(chat_id) for chat_id in (value or "").split(",") if chat_id.strip()
     )
-    application.add_handler(
-        RestrictedCommandHandler(
-            "update_service", update_service_handler, allowed_ids=allowed_ids
+
+
+class BotApplication(Application):
+    """Application that sends replies through the rate limited outbox, groups the
+    usage writes and, when METRICS_PORT is set, serves Prometheus metrics."""
+
+    _metrics_server = None
+    # only the process that starts first may repair the usage rows
+    recovers_usage = True
+    # processes sending with the same token, which split the global rate limit
+    outbox_processes = 1
+
+    async def start(self) -> None:
+        global _outbox
+        await run_sync(warm_up)
+        if self.recovers_usage:
+            closed, opened = await run_sync(_recover_usage)
+            if closed or opened:
+                logger.warning(
+                    "Recovered usage journal: closed %s and opened %s usage(s)",
+                    closed,
+                    opened,
+                )
+        await super().start()
+        _usage_journal.start()
+        if os.getenv("METRICS_PORT"):
+            self._metrics_server = await metrics.start_server(
+                os.getenv("METRICS_HOST", "127.0.0.1"), int(os.getenv("METRICS_PORT"))
+            )
+        _outbox = Outbox(
+            self.bot,
+            global_rate=float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))
+            / self.outbox_processes,
+            chat_rate=float(os.getenv("OUTBOX_CHAT_RATE", "1")),
+            chat_burst=float(os.getenv("OUTBOX_CHAT_BURST", "3")),
         )
+        _outbox.start()
+
+    async def stop(self) -> None:
+        global _outbox
+        if _outbox is not None:
+            # flush pending replies while the bot can still reach Telegram
+            await _outbox.stop()
+            _outbox = None
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+            await self._metrics_server.wait_closed()
+        await super().stop()
+        # after the last handler ran, so nothing is left behind
+        await _usage_journal.stop()
+
+
+def application_builder() -> ApplicationBuilder:
+    """Builder for the bot, handling up to CONCURRENT_UPDATES updates at a time."""
+    return (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .application_class(BotApplication)
+        .concurrent_updates(int(os.getenv("CONCURRENT_UPDATES", "16")))
     )
+
+
+def register_handlers(
+    application: Application, allowed_ids: FrozenSet[int] = frozenset()
+) -> None:
+    application.add_handler(CommandRouter(COMMANDS, allowed_ids=allowed_ids))
+    # next/previous buttons of the paginated /status and /accounts replies
     application.add_handler(
-        RestrictedCommandHandler(
-            "delete_service", delete_service_handler, allowed_ids=allowed_ids
+        CallbackQueryHandler(
+            metrics.track("page", page_callback_handler),
+            pattern=r"^(status|accounts):(prev|next):\d+:\d+$",
         )
     )
     application.add_handler(
-        RestrictedCommandHandler("check", check_handler, allowed_ids=allowed_ids)
+        InlineQueryHandler(metrics.track("inline", inline_query_handler))
     )
-
-    # account handlers
+    # membership changes (promotions, demotions) invalidate cached admin data
     application.add_handler(
-        RestrictedCommandHandler("accounts", accounts_handler, allowed_ids=allowed_ids)
+        ChatMemberHandler(chat_member_handler, ChatMemberHandler.CHAT_MEMBER)
     )
-    application.add_handler(
-        RestrictedCommandHandler(
-            "create_account", create_account_handler, allowed_ids=allowed_ids
-        )
+
+
+async def rollup_usage_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    horizon = timedelta(days=float(os.getenv("USAGE_RETENTION_DAYS", "90")))
+    await run_sync(
+        maintenance.rollup_usage,
+        older_than=datetime.now() - horizon,
+        archive_path=os.getenv("USAGE_ARCHIVE_PATH") or None,
     )
-    application.add_handler(
-        RestrictedCommandHandler(
-            "update_account", update_account_handler, allowed_ids=allowed_ids
+
+
+async def release_expired_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # the sweep closes the open usage rows of the accounts it releases
+    await run_sync(_usage_journal.flush)
+    expired = await run_sync(_release_expired, global_ttl=_GRAB_TTL)
+    notices = defaultdict(list)
+    for grab in expired:
+        notices[grab.chat_id].append(
+            f"\n@{grab.grabbed_by}: {grab.service} {grab.username}"
+            f" (in use since {grab.grabbed_at:%Y-%m-%d %H:%M})"
         )
+    for chat_id, lines in notices.items():
+        msg = "These accounts were released automatically:" + "".join(lines)
+        await _send_message(context, chat_id=chat_id, text=msg)
+
+
+def register_jobs(application: Application) -> None:
+    if application.job_queue is None:
+        return
+    application.job_queue.run_repeating(
+        release_expired_job,
+        interval=float(os.getenv("GRAB_SWEEP_INTERVAL", "300")),
+        first=30,
+        name="release_expired",
     )
-    application.add_handler(
-        RestrictedCommandHandler(
-            "delete_account", delete_account_handler, allowed_ids=allowed_ids
-        )
+    application.job_queue.run_repeating(
+        rollup_usage_job,
+        interval=float(os.getenv("USAGE_ROLLUP_INTERVAL", "3600")),
+        first=60,
+        name="rollup_usage",
     )
-    application.add_handler(
-        RestrictedCommandHandler(
-            "report_broken", report_broken_handler, allowed_ids=allowed_ids
+
+
+def run(application: Application) -> None:
+    """Serve updates through a webhook when WEBHOOK_URL is set, else long polling."""
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if webhook_url:
+        application.run_webhook(
+            listen=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+            port=int(os.getenv("WEBHOOK_PORT", "8443")),
+            url_path=os.getenv("WEBHOOK_PATH", ""),
+            webhook_url=webhook_url,
+            secret_token=os.getenv("WEBHOOK_SECRET_TOKEN") or None,
+            allowed_updates=Update.ALL_TYPES,
         )
-    )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
-    # usage handlers
-    application.add_handler(
-        RestrictedCommandHandler("use", use_handler, allowed_ids=allowed_ids)
-    )
-    application.add_handler(
-        RestrictedCommandHandler("release", release_handler, allowed_ids=allowed_ids)
+
+def create_application() -> Application:
+    """Build the bot. The database is only opened when the application starts."""
+    application = application_builder().build()
+    register_handlers(
+        application, allowed_ids=_parse_allowed_ids(os.getenv("ALLOWED_CHAT_IDS"))
     )
+    register_jobs(application)
+    return application
+
 
-    application.run_polling()
+if __name__ == "__main__":
+    application = create_application()
+    run(application)
+    shutdown_executor()
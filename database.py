@@ -0,0 +1,132 @@
+import asyncio
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Optional, TypeVar
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import metrics
+import migrations
+
+T = TypeVar("T")
+
+DEFAULT_DATABASE_URL = "sqlite:///bot.db"
+
+
+def _sqlite_pragmas() -> dict:
+    return {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+        "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024))),
+        # negative values are KiB instead of pages
+        "cache_size": -int(os.getenv("SQLITE_CACHE_SIZE_KB", "16384")),
+    }
+
+
+def build_engine(url: Optional[str] = None) -> Engine:
+    """Create the engine described by DATABASE_URL and the DB_POOL_* settings."""
+    url = make_url(url or os.getenv("DATABASE_URL") or DEFAULT_DATABASE_URL)
+    is_sqlite = url.get_backend_name() == "sqlite"
+    in_memory = is_sqlite and url.database in (None, "", ":memory:")
+
+    kwargs = {}
+    if in_memory:
+        # one shared connection, otherwise every executor thread sees its own
+        # empty database
+        kwargs.update(poolclass=StaticPool, connect_args={"check_same_thread": False})
+    else:
+        kwargs.update(
+            pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+            max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+            pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+            pool_pre_ping=not is_sqlite,
+        )
+    new_engine = create_engine(url, **kwargs)
+
+    if is_sqlite:
+        pragmas = _sqlite_pragmas()
+        if in_memory:
+            # WAL is not available for in-memory databases
+            pragmas.pop("journal_mode")
+            pragmas.pop("mmap_size")
+
+        @event.listens_for(new_engine, "connect")
+        def _set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma, value in pragmas.items():
+                cursor.execute(f"PRAGMA {pragma}={value}")
+            cursor.close()
+
+    metrics.instrument(new_engine)
+    return new_engine
+
+
+# created by get_engine() on first use, importing this module touches no database
+engine: Optional[Engine] = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> Engine:
+    """The application engine, built and checked against the schema version once."""
+    global engine
+    if engine is None:
+        with _engine_lock:
+            if engine is None:
+                new_engine = build_engine()
+                migrations.ensure_schema(new_engine)
+                engine = new_engine
+    return engine
+
+
+class _LazySessionmaker(sessionmaker):
+    def __call__(self, **local_kw):
+        if self.kw.get("bind") is None and "bind" not in local_kw:
+            self.configure(bind=get_engine())
+        return super().__call__(**local_kw)
+
+
+# binds to get_engine() on the first session unless configured with another bind
+Session = _LazySessionmaker()
+
+
+def warm_up() -> None:
+    """Open a pooled connection (building the engine if needed) ahead of the first
+    update, so the first reply does not pay for it."""
+    with Session() as session:
+        session.connection()
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("DB_WORKERS", "4")), thread_name_prefix="db"
+        )
+    return _executor
+
+
+async def run_sync(func: Callable[..., T], *args, **kwargs) -> T:
+    """Run a blocking database helper on the db executor so the event loop stays free."""
+    loop = asyncio.get_running_loop()
+    # carry context variables (e.g. the command being measured) into the thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        _get_executor(), partial(context.run, func, *args, **kwargs)
+    )
+
+
+def shutdown_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
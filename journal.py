@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Callable, Deque, Generic, List, Optional, Sequence, TypeVar
+
+from database import Session, run_sync
+
+logger = logging.getLogger(__name__)
+
+E = TypeVar("E")
+
+
+class WriteBehindJournal(Generic[E]):
+    """Writes events in groups: one transaction every ``interval`` seconds or every
+    ``max_events`` events, whichever comes first.
+
+    Until ``start`` is called (and again after ``stop``) events are written in the
+    transaction of the caller instead. ``write(session, events)`` must not commit.
+
+    A group that fails is retried on its own, ahead of newer events. After
+    ``max_attempts`` failures its events are written one by one and those that
+    still fail are logged and kept in ``dead_letters``.
+    """
+
+    def __init__(
+        self,
+        write: Callable[[object, List[E]], None],
+        interval: float = 0.005,
+        max_events: int = 100,
+        max_attempts: int = 3,
+    ):
+        self._write = write
+        self.interval = interval
+        self.max_events = max_events
+        self.max_attempts = max_attempts
+        self._pending: List[E] = []
+        # the group that failed last, with how many times it did
+        self._retry: List[E] = []
+        self._attempts = 0
+        self.dead_letters: Deque[E] = deque(maxlen=1000)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._running = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.written = 0
+        self.dropped = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self._retry) + len(self._pending)
+
+    def commit(self, session, events: Sequence[E]) -> None:
+        """Commit ``session`` and record ``events``: in the same transaction when the
+        journal is stopped, otherwise right after it, for the next group commit."""
+        with self._lock:
+            running = self._running
+        if not running:
+            if events:
+                self._write(session, list(events))
+            session.commit()
+            return
+        # the caller's changes (e.g. the account being grabbed) are durable
+        # before the events are queued
+        session.commit()
+        if not events:
+            return
+        with self._lock:
+            self._pending.extend(events)
+            running = self._running
+            wake = (
+                len(self._pending) == len(events)
+                or len(self._pending) >= self.max_events
+            )
+        if not running:
+            # stopped meanwhile, the final flush may already be over
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Writing %s journal event(s) failed", self.depth)
+        elif wake:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def flush(self) -> int:
+        """Write the pending events in one transaction, returning how many."""
+        # one group at a time, so groups are written in the order they were taken
+        with self._flush_lock:
+            if self._retry:
+                events = self._retry
+            else:
+                with self._lock:
+                    events, self._pending = self._pending, []
+            if not events:
+                return 0
+            try:
+                self._write_group(events)
+            except Exception:
+                self._retry = events
+                self._attempts += 1
+                if self._attempts < self.max_attempts:
+                    raise
+                logger.exception(
+                    "Writing %s journal event(s) failed %s times, writing them one by one",
+                    len(events),
+                    self._attempts,
+                )
+                written = self._write_each(events)
+            else:
+                written = len(events)
+            self._retry = []
+            self._attempts = 0
+            self.flushes += 1
+            self.written += written
+            return written
+
+    def _write_group(self, events: List[E]) -> None:
+        with Session() as session:
+            self._write(session, events)
+            session.commit()
+
+    def _write_each(self, events: List[E]) -> int:
+        written = 0
+        for event in events:
+            try:
+                self._write_group([event])
+            except Exception:
+                logger.exception("Dropping journal event %r", event)
+                self.dead_letters.append(event)
+                self.dropped += 1
+            else:
+                written += 1
+        return written
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        with self._lock:
+            self._running = True
+            if self._pending:
+                self._wake.set()
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop grouping and write everything still pending."""
+        if self._worker is None:
+            return
+        with self._lock:
+            self._running = False
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        # ends: every failure brings a group closer to being written one by one
+        while self.depth:
+            try:
+                await run_sync(self.flush)
+            except Exception:
+                logger.exception("Writing %s journal event(s) failed", self.depth)
+
+    async def _run(self) -> None:
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            # give other events a chance to join the group, stopping early only
+            # when it is full
+            deadline = self._loop.time() + self.interval
+            while self.depth < self.max_events:
+                remaining = deadline - self._loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._wake.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                self._wake.clear()
+            try:
+                await run_sync(self.flush)
+            except Exception:
+                logger.exception("Writing %s journal event(s) failed", self.depth)
+                await asyncio.sleep(self.interval * self._attempts)
+            if self.depth:
+                self._wake.set()
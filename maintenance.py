@@ -0,0 +1,163 @@
+import argparse
+import csv
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, insert, select, update
+
+from database import Session
+from models import Account, Service, Usage, UsageDaily
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_COLUMNS = [
+    "usage_id",
+    "chat_id",
+    "service_id",
+    "account_id",
+    "performed_by",
+    "started_at",
+    "finished_at",
+]
+
+
+def rollup_usage(
+    older_than: datetime, archive_path: Optional[str] = None, batch_size: int = 1000
+) -> int:
+    """Fold usages finished before ``older_than`` into usage_daily and delete them,
+    returning how many rows were rolled up.
+
+    usage_total already holds every finished session, so the ranking does not
+    change. With ``archive_path`` the raw rows are appended to that CSV file first.
+    """
+    rolled_up = 0
+    while True:
+        with Session() as session:
+            rows = session.execute(
+                select(
+                    Usage.usage_id,
+                    Service.chat_id,
+                    Account.service_id,
+                    Usage.account_id,
+                    Usage.performed_by,
+                    Usage.started_at,
+                    Usage.finished_at,
+                )
+                .outerjoin(Account, Usage.account_id == Account.account_id)
+                .outerjoin(Service, Account.service_id == Service.service_id)
+                .where(Usage.finished_at < older_than)
+                .order_by(Usage.usage_id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            _add_daily_totals(session, _daily_totals(rows))
+            if archive_path:
+                # written before the delete commits, a failed batch is archived
+                # again on the next run rather than lost
+                _archive(archive_path, rows)
+            session.execute(
+                delete(Usage).where(Usage.usage_id.in_([row.usage_id for row in rows]))
+            )
+            session.commit()
+        rolled_up += len(rows)
+        if len(rows) < batch_size:
+            break
+    if rolled_up:
+        logger.info("Rolled up %s usage row(s) older than %s", rolled_up, older_than)
+    return rolled_up
+
+
+def _daily_totals(rows) -> Dict[tuple, Tuple[int, int, float]]:
+    totals = {}
+    for row in rows:
+        if row.service_id is None:
+            # the account was deleted, its seconds only live in usage_total
+            continue
+        key = (row.service_id, row.performed_by, row.started_at.date())
+        chat_id, sessions, seconds = totals.get(key, (row.chat_id, 0, 0.0))
+        totals[key] = (
+            chat_id,
+            sessions + 1,
+            seconds + (row.finished_at - row.started_at).total_seconds(),
+        )
+    return totals
+
+
+def _add_daily_totals(session, totals: Dict[tuple, Tuple[int, int, float]]) -> None:
+    if not totals:
+        return
+    existing = {
+        (daily.service_id, daily.performed_by, daily.day): daily
+        for daily in session.execute(
+            select(
+                UsageDaily.service_id,
+                UsageDaily.performed_by,
+                UsageDaily.day,
+                UsageDaily.sessions,
+                UsageDaily.seconds,
+            )
+            .where(UsageDaily.service_id.in_({key[0] for key in totals}))
+            .where(UsageDaily.day.in_({key[2] for key in totals}))
+        )
+    }
+    updates: List[dict] = []
+    inserts: List[dict] = []
+    for (service_id, performed_by, day), (chat_id, sessions, seconds) in totals.items():
+        key = dict(service_id=service_id, performed_by=performed_by, day=day)
+        current = existing.get((service_id, performed_by, day))
+        if current is None:
+            inserts.append(
+                dict(key, chat_id=chat_id, sessions=sessions, seconds=seconds)
+            )
+        else:
+            updates.append(
+                dict(
+                    key,
+                    sessions=current.sessions + sessions,
+                    seconds=current.seconds + seconds,
+                )
+            )
+    if updates:
+        session.execute(update(UsageDaily), updates)
+    if inserts:
+        session.execute(insert(UsageDaily), inserts)
+
+
+def _archive(path: str, rows) -> None:
+    new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+    with open(path, "a", newline="") as archive:
+        writer = csv.writer(archive)
+        if new_file:
+            writer.writerow(ARCHIVE_COLUMNS)
+        writer.writerows(rows)
+        archive.flush()
+        os.fsync(archive.fileno())
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Roll finished usage history up into daily totals."
+    )
+    parser.add_argument(
+        "--days",
+        type=float,
+        default=float(os.getenv("USAGE_RETENTION_DAYS", "90")),
+        help="keep raw usage rows finished within this many days",
+    )
+    parser.add_argument(
+        "--archive",
+        default=os.getenv("USAGE_ARCHIVE_PATH") or None,
+        help="CSV file the rolled up rows are appended to",
+    )
+    args = parser.parse_args(argv)
+    rolled_up = rollup_usage(
+        datetime.now() - timedelta(days=args.days), archive_path=args.archive
+    )
+    print(f"Rolled up {rolled_up} usage row(s)")
+
+
+if __name__ == "__main__":
+    main()
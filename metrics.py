@@ -0,0 +1,251 @@
+import asyncio
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# command being handled by the current task, copied into the db executor threads
+current_command: ContextVar[str] = ContextVar("current_command", default="other")
+
+LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the ``q`` quantile."""
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class CommandStats:
+    def __init__(self):
+        self.calls = 0
+        self.latency = Histogram()
+        self.statements = 0
+        self.db_time = 0.0
+        # as reported by the driver: INSERT, UPDATE and DELETE only, not fetched rows
+        self.rows_affected = 0
+        self.errors = 0
+
+
+class Registry:
+    """Per-command handler and SQL statistics plus cache and gauge readings."""
+
+    def __init__(self):
+        self.commands: Dict[str, CommandStats] = {}
+        self._caches: Dict[str, object] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+        self._lock = threading.Lock()
+
+    def _stats(self, command: str) -> CommandStats:
+        stats = self.commands.get(command)
+        if stats is None:
+            stats = self.commands[command] = CommandStats()
+        return stats
+
+    def observe_call(self, command: str, seconds: float) -> None:
+        with self._lock:
+            stats = self._stats(command)
+            stats.calls += 1
+            stats.latency.observe(seconds)
+
+    def observe_statement(
+        self, command: str, seconds: float, rows_affected: int, failed: bool = False
+    ) -> None:
+        with self._lock:
+            stats = self._stats(command)
+            stats.statements += 1
+            stats.db_time += seconds
+            stats.rows_affected += max(rows_affected, 0)
+            stats.errors += failed
+
+    def register_cache(self, name: str, cache) -> None:
+        """Report the ``hits``/``misses`` counters of ``cache``."""
+        self._caches[name] = cache
+
+    def register_gauge(self, name: str, read: Callable[[], float]) -> None:
+        self._gauges[name] = read
+
+    def gauges(self) -> Dict[str, float]:
+        return {name: read() for name, read in self._gauges.items()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self.commands.clear()
+
+    def summary(self, top: Optional[int] = None) -> str:
+        """Human readable report for the /stats command."""
+        with self._lock:
+            commands = sorted(
+                self.commands.items(), key=lambda item: item[1].calls, reverse=True
+            )[:top]
+            lines = [
+                "Command statistics (calls | avg ms | p95 ms | sql/call | db ms/call):"
+            ]
+            for command, stats in commands:
+                calls = stats.calls or 1
+                lines.append(
+                    f"\n/{command}: {stats.calls} | {stats.latency.sum / calls * 1000:.1f}"
+                    f" | {stats.latency.quantile(0.95) * 1000:.0f}"
+                    f" | {stats.statements / calls:.1f}"
+                    f" | {stats.db_time / calls * 1000:.1f}"
+                )
+        lines.append("\n\nCache hit rates:")
+        for name, cache in sorted(self._caches.items()):
+            lines.append(
+                f"\n{name}: {cache.hit_rate * 100:.0f}% of {cache.hits + cache.misses}"
+            )
+        gauges = self.gauges()
+        if gauges:
+            lines.append("\n")
+            for name, value in sorted(gauges.items()):
+                lines.append(f"\n{name}: {value}")
+        return "".join(lines)
+
+    def render_prometheus(self, prefix: str = "easy_sharing_bot") -> str:
+        lines: List[str] = []
+
+        def family(name: str, kind: str) -> str:
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            return f"{prefix}_{name}"
+
+        with self._lock:
+            commands = sorted(self.commands.items())
+            metric = family("command_duration_seconds", "histogram")
+            for command, stats in commands:
+                cumulative = 0
+                for bound, count in zip(stats.latency.buckets, stats.latency.counts):
+                    cumulative += count
+                    lines.append(
+                        f'{metric}_bucket{{command="{command}",le="{bound}"}} {cumulative}'
+                    )
+                lines.append(
+                    f'{metric}_bucket{{command="{command}",le="+Inf"}} {stats.latency.count}'
+                )
+                lines.append(f'{metric}_sum{{command="{command}"}} {stats.latency.sum}')
+                lines.append(
+                    f'{metric}_count{{command="{command}"}} {stats.latency.count}'
+                )
+            for name, attribute in [
+                ("sql_statements_total", "statements"),
+                ("sql_duration_seconds_total", "db_time"),
+                ("sql_rows_affected_total", "rows_affected"),
+                ("sql_errors_total", "errors"),
+            ]:
+                metric = family(name, "counter")
+                for command, stats in commands:
+                    lines.append(
+                        f'{metric}{{command="{command}"}} {getattr(stats, attribute)}'
+                    )
+        for name in ("hits", "misses"):
+            metric = family(f"cache_{name}_total", "counter")
+            for cache_name, cache in sorted(self._caches.items()):
+                lines.append(f'{metric}{{cache="{cache_name}"}} {getattr(cache, name)}')
+        for name, value in sorted(self.gauges().items()):
+            metric = family(name, "gauge")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def track(command: str, func: Callable) -> Callable:
+    """Time a handler and tag the SQL it runs with ``command``."""
+
+    @wraps(func)
+    async def wrapped(*args, **kwargs):
+        token = current_command.set(command)
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            registry.observe_call(command, time.perf_counter() - started)
+            current_command.reset(token)
+
+    return wrapped
+
+
+def instrument(engine: Engine) -> None:
+    """Record every statement run on ``engine`` against the current command."""
+
+    # the start time lives on the execution context, which goes away with the
+    # statement whether it succeeds or fails
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        context.metrics_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        # DBAPI drivers only report a row count for DML, SELECTs count as 0 (-1)
+        registry.observe_statement(
+            current_command.get(),
+            time.perf_counter() - context.metrics_started,
+            cursor.rowcount,
+        )
+
+    @event.listens_for(engine, "handle_error")
+    def _error(exception_context):
+        started = getattr(exception_context.execution_context, "metrics_started", None)
+        if started is not None:
+            registry.observe_statement(
+                current_command.get(), time.perf_counter() - started, 0, failed=True
+            )
+
+
+async def start_server(host: str, port: int) -> asyncio.AbstractServer:
+    """Serve ``registry`` in the Prometheus text format on ``GET /metrics``."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1] == b"/metrics":
+                status, body = b"200 OK", registry.render_prometheus().encode()
+            else:
+                status, body = b"404 Not Found", b"not found\n"
+            writer.write(
+                b"HTTP/1.1 %s\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: %d\r\nConnection: close\r\n\r\n%s"
+                % (status, len(body), body)
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,179 @@
+import logging
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import Index, delete, func, insert, inspect, select
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql import text as text_sa
+
+from models import (
+    Account,
+    Base,
+    ChatUser,
+    SchemaVersion,
+    Service,
+    Usage,
+    UsageTotal,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _create_index(connection: Connection, index: Index) -> None:
+    if index.unique and _has_duplicates(connection, index):
+        # Old databases may already hold duplicated rows. Keep the lookup fast
+        # but don't refuse to start: the duplicates must be cleaned up by hand.
+        logger.warning(
+            "Duplicated rows found for %s, creating it as a non-unique index",
+            index.name,
+        )
+        columns = ", ".join(column.name for column in index.columns)
+        connection.execute(
+            text_sa(
+                f"CREATE INDEX IF NOT EXISTS {index.name} ON {index.table.name} ({columns})"
+            )
+        )
+        return
+    index.create(connection, checkfirst=True)
+
+
+def _has_duplicates(connection: Connection, index: Index) -> bool:
+    columns = list(index.columns)
+    duplicates = select(*columns).group_by(*columns).having(func.count() > 1).limit(1)
+    return connection.execute(duplicates).first() is not None
+
+
+def _add_lookup_indexes(connection: Connection) -> None:
+    for model in (Service, Account, Usage):
+        for index in model.__table__.indexes:
+            _create_index(connection, index)
+
+
+def _backfill_usage_totals(connection: Connection) -> None:
+    totals = {}
+    finished_usages = connection.execute(
+        select(
+            Account.service_id, Usage.performed_by, Usage.started_at, Usage.finished_at
+        )
+        .join(Account, Usage.account_id == Account.account_id)
+        .where(Usage.finished_at.is_not(None))
+        .execution_options(yield_per=1000)
+    )
+    for service_id, performed_by, started_at, finished_at in finished_usages:
+        key = (service_id, performed_by)
+        totals[key] = totals.get(key, 0) + (finished_at - started_at).total_seconds()
+    connection.execute(delete(UsageTotal))
+    if totals:
+        connection.execute(
+            insert(UsageTotal),
+            [
+                {
+                    "service_id": service_id,
+                    "performed_by": performed_by,
+                    "seconds": seconds,
+                }
+                for (service_id, performed_by), seconds in totals.items()
+            ],
+        )
+
+
+def _add_usage_finished_at_index(connection: Connection) -> None:
+    for index in Usage.__table__.indexes:
+        if index.name == "ix_usage_finished_at":
+            _create_index(connection, index)
+
+
+def _add_grab_ttl(connection: Connection) -> None:
+    columns = {column["name"] for column in inspect(connection).get_columns("service")}
+    if "grab_ttl" not in columns:
+        connection.execute(text_sa("ALTER TABLE service ADD COLUMN grab_ttl INTEGER"))
+    for index in Account.__table__.indexes:
+        if index.name == "ix_account_released_at_grabbed_at":
+            _create_index(connection, index)
+
+
+def _add_least_recently_used_index(connection: Connection) -> None:
+    for index in Account.__table__.indexes:
+        if index.name == "ix_account_service_id_grabbed_at":
+            _create_index(connection, index)
+
+
+def _add_chat_users(connection: Connection) -> None:
+    ChatUser.__table__.create(connection, checkfirst=True)
+
+
+# (version, migration) pairs, applied in order. Never edit a released entry,
+# append a new one instead.
+MIGRATIONS: List[Tuple[int, Callable[[Connection], None]]] = [
+    (1, _add_lookup_indexes),
+    (2, _backfill_usage_totals),
+    (3, _add_usage_finished_at_index),
+    (4, _add_grab_ttl),
+    (5, _add_least_recently_used_index),
+    (6, _add_chat_users),
+]
+
+LATEST_VERSION: int = MIGRATIONS[-1][0]
+
+
+def current_version(connection: Connection) -> int:
+    return connection.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+
+
+def _lock_schema(connection: Connection) -> None:
+    dialect = connection.dialect.name
+    if dialect == "sqlite":
+        # take the write lock now instead of at the first write, so the version
+        # read below cannot be outdated by a concurrent upgrade
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+    elif dialect == "postgresql":
+        connection.execute(
+            text_sa("SELECT pg_advisory_xact_lock(:key)"), {"key": _LOCK_KEY}
+        )
+
+
+# arbitrary application-wide key of the PostgreSQL advisory lock
+_LOCK_KEY = 0x45534254
+
+
+def upgrade(engine: Engine) -> int:
+    """Create missing tables and apply pending migrations, returning the schema version.
+
+    Safe to run from several processes at once: the first one holds the write lock
+    until it is done, the others then find the schema up to date.
+    """
+    with engine.begin() as connection:
+        _lock_schema(connection)
+        Base.metadata.create_all(connection)
+        version = current_version(connection)
+        for migration_version, migration in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            logger.info(
+                "Applying schema migration %s (%s)",
+                migration_version,
+                migration.__name__,
+            )
+            migration(connection)
+            connection.execute(
+                insert(SchemaVersion).values(
+                    version=migration_version, applied_at=datetime.now()
+                )
+            )
+            version = migration_version
+    return version
+
+
+def ensure_schema(engine: Engine) -> int:
+    """Upgrade only when the stored schema version is behind: an up to date database
+    costs a single query instead of reflecting every table."""
+    try:
+        with engine.connect() as connection:
+            version = current_version(connection)
+    except DBAPIError:
+        # no schema_version table, a new or pre-versioning database
+        version = 0
+    if version >= LATEST_VERSION:
+        return version
+    return upgrade(engine)
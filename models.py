@@ -1,6 +1,16 @@
-from typing import List
-
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+from sqlalchemy import (
+    Column,
+    Date,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+)
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.ext.declarative import declarative_base
 import enum
@@ -11,10 +21,13 @@ Base = declarative_base()
 
 class Service(Base):
     __tablename__ = "service"
+    __table_args__ = (Index("ix_service_chat_id_name", "chat_id", "name", unique=True),)
     service_id = Column(Integer, primary_key=True)
     chat_id = Column(Integer, nullable=False)
     name = Column(String, nullable=False)
     url = Column(String, nullable=True)
+    # seconds after which grabbed accounts are released, None uses GRAB_TTL_HOURS
+    grab_ttl = Column(Integer, nullable=True)
     created_by = Column(String, nullable=False)
     created_at = Column(DateTime, nullable=False)
     last_modified_by = Column(String, nullable=True)
@@ -24,17 +37,15 @@ class Service(Base):
     def __repr__(self):
         return f"Service {self.name}"
 
-    @classmethod
-    def find_by__name(cls, session, chat_id: int, name: str):
-        return session.query(cls).filter_by(chat_id=chat_id, name=name).all()
-
-    @classmethod
-    def find_by__chat_id(cls, session, chat_id: int):
-        return session.query(cls).filter_by(chat_id=chat_id).order_by("name").all()
-
 
 class Account(Base):
     __tablename__ = "account"
+    __table_args__ = (
+        Index("ix_account_service_id_username", "service_id", "username", unique=True),
+        Index("ix_account_grabbed_by_released_at", "grabbed_by", "released_at"),
+        Index("ix_account_released_at_grabbed_at", "released_at", "grabbed_at"),
+        Index("ix_account_service_id_grabbed_at", "service_id", "grabbed_at"),
+    )
     account_id = Column(Integer, primary_key=True)
     service_id = Column(Integer, ForeignKey("service.service_id"))
     username = Column(String, nullable=False)
@@ -55,27 +66,34 @@ class Account(Base):
 
     @property
     def available_display(self):
-        if self.grabbed_at is None or self.released_at is not None:
-            return "Available"
-        return f"Unavailable [being used by @{self.grabbed_by}]"
-
-    @classmethod
-    def find_by__service_id(cls, session, service_id: int) -> List:
-        return session.query(cls).filter_by(service_id=service_id).all()
-
-    @classmethod
-    def find_by__chat_id__and__service_name(
-        cls, session, chat_id: int, service: str
-    ) -> List:
-        return (
-            session.query(cls)
-            .join(Service)
-            .filter(cls.service_id == Service.service_id)
-            .filter(Service.chat_id == chat_id)
-            .filter(Service.name == service)
-            .order_by(cls.username)
-            .all()
-        )
+        return _available_display(self.grabbed_at, self.grabbed_by, self.released_at)
+
+
+class AccountView(NamedTuple):
+    # detached snapshot of an Account, safe to cache and share between handlers
+    service: str
+    username: str
+    password: str
+    grabbed_at: Optional[datetime]
+    grabbed_by: Optional[str]
+    released_at: Optional[datetime]
+
+    def __str__(self):
+        return f"Account {self.username}  {self.password}  ({self.available_display})"
+
+    @property
+    def available(self) -> bool:
+        return self.grabbed_at is None or self.released_at is not None
+
+    @property
+    def available_display(self):
+        return _available_display(self.grabbed_at, self.grabbed_by, self.released_at)
+
+
+def _available_display(grabbed_at, grabbed_by, released_at) -> str:
+    if grabbed_at is None or released_at is not None:
+        return "Available"
+    return f"Unavailable [being used by @{grabbed_by}]"
 
 
 class UsageChoices(enum.Enum):
@@ -85,6 +103,15 @@ class UsageChoices(enum.Enum):
 
 class Usage(Base):
     __tablename__ = "usage"
+    __table_args__ = (
+        Index(
+            "ix_usage_account_id_performed_by_finished_at",
+            "account_id",
+            "performed_by",
+            "finished_at",
+        ),
+        Index("ix_usage_finished_at", "finished_at"),
+    )
     usage_id = Column(Integer, primary_key=True)
     account_id = Column(Integer, ForeignKey("account.account_id"))
     performed_by = Column(String, nullable=False)
@@ -93,3 +120,49 @@ class Usage(Base):
 
     def __repr__(self):
         return f'{self.performed_by} used {self.account.username} from {self.started_at} until {self.finished_at or "-"}'
+
+
+class UsageTotal(Base):
+    # seconds of finished usage per service and user, kept up to date by /release
+    __tablename__ = "usage_total"
+    service_id = Column(Integer, ForeignKey("service.service_id"), primary_key=True)
+    performed_by = Column(String, primary_key=True)
+    seconds = Column(Float, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"{self.performed_by} used service {self.service_id} for {self.seconds}s"
+
+
+class UsageDaily(Base):
+    # finished usage older than the retention horizon, rolled up by maintenance.py
+    __tablename__ = "usage_daily"
+    service_id = Column(Integer, ForeignKey("service.service_id"), primary_key=True)
+    performed_by = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)
+    chat_id = Column(Integer, nullable=False)
+    sessions = Column(Integer, nullable=False, default=0)
+    seconds = Column(Float, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"{self.performed_by} used service {self.service_id} on {self.day} for {self.seconds}s"
+
+
+class ChatUser(Base):
+    # users seen sending commands in a chat, inline queries only carry the user
+    __tablename__ = "chat_user"
+    __table_args__ = (Index("ix_chat_user_user_id", "user_id"),)
+    chat_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    seen_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"User {self.user_id} in chat {self.chat_id}"
+
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+    version = Column(Integer, primary_key=True)
+    applied_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"SchemaVersion {self.version} applied at {self.applied_at}"
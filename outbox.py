@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, NamedTuple, Optional
+
+from telegram.error import NetworkError, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+
+
+class _Message(NamedTuple):
+    text: str
+    reply_markup: Any = None
+    # bytes or a binary file, which the outbox closes once done with it
+    document: Any = None
+    filename: Optional[str] = None
+
+
+class TokenBucket:
+    """Allows ``rate`` events per second with bursts of up to ``capacity`` events."""
+
+    def __init__(
+        self, rate: float, capacity: float, timer: Callable[[], float] = time.monotonic
+    ):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._timer = timer
+        self._updated = timer()
+
+    def _refill(self) -> None:
+        now = self._timer()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def delay(self) -> float:
+        """Seconds until a token is available, 0 when one can be consumed now."""
+        self._refill()
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def consume(self) -> None:
+        self._refill()
+        self._tokens -= 1
+
+
+class Outbox:
+    """Sends queued messages within Telegram's global and per-chat rate limits.
+
+    Messages waiting for the same chat are joined into a single message of up to
+    ``MAX_MESSAGE_LENGTH`` characters, so a busy chat costs fewer API calls.
+    Messages with a ``reply_markup`` and documents are always sent on their own.
+    """
+
+    def __init__(
+        self,
+        bot,
+        global_rate: float = 30.0,
+        chat_rate: float = 1.0,
+        chat_burst: float = 3.0,
+        max_attempts: int = 3,
+        separator: str = "\n\n",
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        self._bot = bot
+        self._timer = timer
+        self._global_bucket = TokenBucket(global_rate, global_rate, timer)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        # chat_id -> when its queue emptied, oldest first
+        self._drained: "OrderedDict[int, float]" = OrderedDict()
+        self._max_attempts = max_attempts
+        self._separator = separator
+        self._pending: Dict[int, Deque[_Message]] = {}
+        self._attempts: Dict[int, int] = {}
+        self._ready: Optional[asyncio.Queue] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.dropped = 0
+
+    @property
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self._pending.values())
+
+    def start(self) -> None:
+        self._ready = asyncio.Queue()
+        self._idle = asyncio.Event()
+        if not self._pending:
+            self._idle.set()
+        for chat_id in self._pending:
+            self._ready.put_nowait(chat_id)
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Wait for the queued messages to be sent, then stop the worker."""
+        if self._worker is None:
+            return
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Outbox stopped with %s unsent message(s)", self.depth)
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+
+    def send(self, chat_id: int, text: str, reply_markup: Any = None) -> None:
+        """Queue a message for the chat, returning immediately."""
+        self._queue(chat_id).append(_Message(text, reply_markup))
+
+    def send_document(self, chat_id: int, document: Any, filename: str) -> None:
+        """Queue a document (bytes or a binary file) for the chat, after the messages
+        already queued. A file is closed once sent or dropped."""
+        self._queue(chat_id).append(_Message("", document=document, filename=filename))
+
+    def _queue(self, chat_id: int) -> Deque[_Message]:
+        queue = self._pending.get(chat_id)
+        if queue is None:
+            queue = self._pending[chat_id] = deque()
+            self._drained.pop(chat_id, None)
+            if self._ready is not None:
+                self._ready.put_nowait(chat_id)
+                self._idle.clear()
+        return queue
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(
+                self._chat_rate, self._chat_burst, self._timer
+            )
+        return bucket
+
+    def _evict_idle_buckets(self) -> None:
+        # a bucket left alone this long is full again, as good as a new one
+        horizon = self._timer() - self._chat_burst / self._chat_rate
+        while self._drained:
+            chat_id, drained_at = next(iter(self._drained.items()))
+            if drained_at > horizon:
+                break
+            del self._drained[chat_id]
+            self._chat_buckets.pop(chat_id, None)
+
+    def _coalesce(self, queue: Deque[_Message]) -> _Message:
+        message = queue.popleft()
+        if message.reply_markup is not None or message.document is not None:
+            return message
+        text = message.text
+        if len(text) > MAX_MESSAGE_LENGTH:
+            queue.appendleft(_Message(text[MAX_MESSAGE_LENGTH:]))
+            return _Message(text[:MAX_MESSAGE_LENGTH])
+        while (
+            queue
+            and queue[0].reply_markup is None
+            and queue[0].document is None
+            and len(text) + len(self._separator) + len(queue[0].text)
+            <= MAX_MESSAGE_LENGTH
+        ):
+            text = f"{text}{self._separator}{queue.popleft().text}"
+            self.coalesced += 1
+        return _Message(text)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            chat_id = await self._ready.get()
+            self._evict_idle_buckets()
+            delay = self._chat_bucket(chat_id).delay()
+            if delay > 0:
+                # let other chats go first instead of blocking on this one
+                loop.call_later(delay, self._ready.put_nowait, chat_id)
+                continue
+            delay = self._global_bucket.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._send_next(chat_id)
+            if self._pending.get(chat_id):
+                self._ready.put_nowait(chat_id)
+            else:
+                self._pending.pop(chat_id, None)
+                self._drained[chat_id] = self._timer()
+                if not self._pending:
+                    self._idle.set()
+
+    async def _send_next(self, chat_id: int) -> None:
+        queue = self._pending[chat_id]
+        message = self._coalesce(queue)
+        kwargs = {}
+        if message.reply_markup is not None:
+            kwargs["reply_markup"] = message.reply_markup
+        self._chat_bucket(chat_id).consume()
+        self._global_bucket.consume()
+        try:
+            if message.document is not None:
+                if hasattr(message.document, "seek"):
+                    # a retry reads the file from the start again
+                    message.document.seek(0)
+                await self._bot.send_document(
+                    chat_id=chat_id,
+                    document=message.document,
+                    filename=message.filename,
+                )
+            else:
+                await self._bot.send_message(
+                    chat_id=chat_id, text=message.text, **kwargs
+                )
+        except RetryAfter as err:
+            logger.warning("Flood limit reached, pausing for %ss", err.retry_after)
+            queue.appendleft(message)
+            self.retries += 1
+            await asyncio.sleep(err.retry_after)
+        except NetworkError as err:
+            attempts = self._attempts.get(chat_id, 0) + 1
+            if attempts < self._max_attempts:
+                queue.appendleft(message)
+                self._attempts[chat_id] = attempts
+                self.retries += 1
+                await asyncio.sleep(attempts)
+            else:
+                logger.error("Dropping message to chat %s: %s", chat_id, err)
+                self._attempts.pop(chat_id, None)
+                self.dropped += 1
+        except TelegramError as err:
+            logger.error("Dropping message to chat %s: %s", chat_id, err)
+            self._attempts.pop(chat_id, None)
+            self.dropped += 1
+        else:
+            self._attempts.pop(chat_id, None)
+            self.sent += 1
+        requeued = queue and queue[0] is message
+        if hasattr(message.document, "close") and not requeued:
+            message.document.close()
@@ -0,0 +1,226 @@
+"""Run the bot as one ingress process and N chat-sharded worker processes.
+
+The ingress process receives updates (polling or webhook, see ``bot.run``) and
+forwards each one to the worker that owns its chat, so the updates of a chat
+are handled in order by a single process while chats are spread across cores.
+Start it with ``python sharding.py --workers 4``.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import zlib
+from typing import List, Optional, Sequence, Type
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes, TypeHandler
+from dotenv import load_dotenv
+from telegram.request import BaseRequest
+
+if __name__ == "__main__":
+    # before bot reads its settings; the workers inherit the environment
+    load_dotenv()
+
+import bot  # noqa: E402
+from database import get_engine, shutdown_executor  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+def shard_for(key: int, workers: int) -> int:
+    # crc32 spreads sequential ids evenly and, unlike hash(), is stable across runs
+    return zlib.crc32(str(key).encode()) % workers
+
+
+def _shard_key(update: Update) -> int:
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return 0
+
+
+class ShardRouter:
+    """Forwards updates to the queue of the worker owning their chat."""
+
+    def __init__(self, queues: Sequence):
+        self.queues = queues
+        self.routed = [0] * len(queues)
+
+    def route(self, update: Update) -> int:
+        index = shard_for(_shard_key(update), len(self.queues))
+        self.queues[index].put(update.to_dict())
+        self.routed[index] += 1
+        return index
+
+    async def forward(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        self.route(update)
+
+
+def worker_main(
+    index: int,
+    workers: int,
+    updates,
+    events,
+    request_class: Optional[Type[BaseRequest]] = None,
+) -> None:
+    """Entry point of a worker process: handles updates until ``None`` arrives."""
+    processed = asyncio.run(_serve(index, workers, updates, events, request_class))
+    shutdown_executor()
+    events.put(("done", index, processed))
+
+
+async def _serve(
+    index: int,
+    workers: int,
+    updates,
+    events,
+    request_class: Optional[Type[BaseRequest]],
+) -> int:
+    if os.getenv("METRICS_PORT"):
+        # the ingress serves METRICS_PORT, worker i the port right after it + i
+        os.environ["METRICS_PORT"] = str(int(os.environ["METRICS_PORT"]) + 1 + index)
+    builder = bot.application_builder()
+    if request_class is not None:
+        builder = builder.request(request_class()).get_updates_request(request_class())
+    application = builder.build()
+    # the ingress repairs the usage rows before forwarding the first update
+    application.recovers_usage = False
+    # Telegram limits the token, not the process: the workers and the ingress
+    # share OUTBOX_GLOBAL_RATE
+    application.outbox_processes = workers + 1
+    # the jobs in the ingress and the workers of the other chats (members leaving,
+    # inline queries routed by user) change chats behind this worker's back
+    bot.disable_chat_caches()
+    bot.register_handlers(
+        application, allowed_ids=bot._parse_allowed_ids(os.getenv("ALLOWED_CHAT_IDS"))
+    )
+    loop = asyncio.get_running_loop()
+    processed = 0
+    async with application:
+        await application.start()
+        events.put(("ready", index, 0))
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+            processed += 1
+        # handles the updates still queued before stopping
+        await application.stop()
+    return processed
+
+
+class WorkerPool:
+    """Spawns the worker processes, owns their queues and replaces the workers
+    that die."""
+
+    def __init__(self, workers: int, request_class: Optional[Type[BaseRequest]] = None):
+        self._context = multiprocessing.get_context("spawn")
+        self._request_class = request_class
+        # one pair per worker: a process killed while it holds the lock of a
+        # queue (always, when waiting for an update) leaves the queue unusable
+        self.queues = [self._context.Queue() for _ in range(workers)]
+        self.events = [self._context.Queue() for _ in range(workers)]
+        self.processes = [self._spawn(index) for index in range(workers)]
+        self.restarts = 0
+
+    def _spawn(self, index: int):
+        return self._context.Process(
+            target=worker_main,
+            args=(
+                index,
+                len(self.queues),
+                self.queues[index],
+                self.events[index],
+                self._request_class,
+            ),
+            name=f"worker-{index}",
+            daemon=True,
+        )
+
+    def start(self, timeout: float = 60) -> None:
+        for process in self.processes:
+            process.start()
+        for events in self.events:
+            events.get(timeout=timeout)
+
+    def restart_dead(self) -> List[int]:
+        """Replace the workers that exited, returning their indexes. The updates
+        still queued for a dead worker are lost; the ShardRouter sharing
+        ``queues`` forwards the next ones to its replacement."""
+        dead = [
+            index
+            for index, process in enumerate(self.processes)
+            if not process.is_alive()
+        ]
+        for index in dead:
+            logger.error(
+                "Worker %s exited with code %s, restarting it",
+                index,
+                self.processes[index].exitcode,
+            )
+            self.queues[index] = self._context.Queue()
+            self.events[index] = self._context.Queue()
+            self.processes[index] = self._spawn(index)
+            self.processes[index].start()
+            self.restarts += 1
+        return dead
+
+    async def watch(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        self.restart_dead()
+
+    def stop(self, timeout: float = 60) -> List[int]:
+        """Let the workers drain their queues and return how many updates each one
+        handled."""
+        for queue in self.queues:
+            queue.put(None)
+        processed = [0] * len(self.processes)
+        for index, (process, events) in enumerate(zip(self.processes, self.events)):
+            if not process.is_alive():
+                continue
+            while True:
+                # a restarted worker may not have reported ready yet
+                event, _, count = events.get(timeout=timeout)
+                if event == "done":
+                    processed[index] = count
+                    break
+        for process in self.processes:
+            process.join(timeout)
+        return processed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--workers", type=int, default=int(os.getenv("WORKERS", os.cpu_count() or 1))
+    )
+    args = parser.parse_args()
+
+    # migrate once here rather than in every worker as it starts
+    get_engine()
+    pool = WorkerPool(args.workers)
+    pool.start()
+    logger.info("Started %s worker(s)", args.workers)
+    router = ShardRouter(pool.queues)
+    application: Application = bot.application_builder().build()
+    application.outbox_processes = args.workers + 1
+    application.add_handler(TypeHandler(Update, router.forward))
+    # jobs run once, in the ingress process
+    bot.register_jobs(application)
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(
+            pool.watch,
+            interval=float(os.getenv("WORKER_CHECK_INTERVAL", "5")),
+            name="watch_workers",
+        )
+    try:
+        bot.run(application)
+    finally:
+        logger.info("Updates handled per worker: %s", pool.stop())
+        shutdown_executor()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+import asyncio
+import json
+import os
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import event
+from telegram.request import BaseRequest
+
+# keep the suite away from the real bot.db
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+import bot  # noqa: E402
+import database  # noqa: E402
+import metrics  # noqa: E402
+import migrations
+
+
+class FakeBot:
+    first_name = "EasySharingBot"
+
+    def __init__(self):
+        self.sent = []
+        self.api_calls = []
+        # file_id -> content served by get_file
+        self.files = {}
+        self.documents = []
+        # user_id -> chat member status, everyone else is a plain member
+        self.statuses = {}
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+    async def get_file(self, file_id, **kwargs):
+        content = self.files[file_id]
+
+        async def download_as_bytearray():
+            return bytearray(content)
+
+        return SimpleNamespace(download_as_bytearray=download_as_bytearray)
+
+    async def send_document(self, chat_id, document, filename=None, **kwargs):
+        content = document if isinstance(document, bytes) else document.read()
+        self.documents.append((chat_id, filename, content))
+
+    async def get_chat_member(self, chat_id, user_id, **kwargs):
+        self.api_calls.append(("get_chat_member", chat_id, user_id))
+        return SimpleNamespace(
+            status=self.statuses.get(user_id, "member"),
+            user=SimpleNamespace(id=user_id),
+        )
+
+    async def get_chat_administrators(self, chat_id, **kwargs):
+        self.api_calls.append(("get_chat_administrators", chat_id))
+        return [
+            SimpleNamespace(
+                status=status,
+                user=SimpleNamespace(id=user_id, username=f"admin{user_id}"),
+            )
+            for user_id, status in self.statuses.items()
+            if status in ("administrator", "creator")
+        ]
+
+
+class FakeTelegramAPI(BaseRequest):
+    """Answers Bot API calls locally so a whole Application can run offline."""
+
+    def __init__(self):
+        self.replies = []
+        self.pending_updates = asyncio.Queue()
+        self._update_id = 0
+        self._message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def make_update(self, text, chat_id=1, user_id=10, username="alice"):
+        self._update_id += 1
+        command = text.split()[0]
+        return {
+            "update_id": self._update_id,
+            "message": {
+                "message_id": self._update_id,
+                "date": int(time.time()),
+                "text": text,
+                "entities": [
+                    {"type": "bot_command", "offset": 0, "length": len(command)}
+                ],
+                "chat": {"id": chat_id, "type": "group", "title": "chat"},
+                "from": {
+                    "id": user_id,
+                    "is_bot": False,
+                    "first_name": username,
+                    "username": username,
+                },
+            },
+        }
+
+    async def wait_for_replies(self, count, timeout=5):
+        deadline = time.perf_counter() + timeout
+        while len(self.replies) < count:
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f"got {len(self.replies)} of {count} replies")
+            await asyncio.sleep(0.001)
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        parameters = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = {
+                "id": 1,
+                "is_bot": True,
+                "first_name": "EasySharingBot",
+                "username": "easy_sharing_bot",
+            }
+        elif endpoint == "sendMessage":
+            self._message_id += 1
+            self.replies.append(
+                (time.perf_counter(), parameters["chat_id"], parameters["text"])
+            )
+            result = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": parameters["chat_id"], "type": "group"},
+                "text": parameters["text"],
+            }
+        elif endpoint == "getUpdates":
+            # behaves like a long poll that returns as soon as an update arrives
+            try:
+                result = [
+                    await asyncio.wait_for(self.pending_updates.get(), timeout=0.5)
+                ]
+            except asyncio.TimeoutError:
+                result = []
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+@pytest.fixture
+def telegram_api():
+    return FakeTelegramAPI()
+
+
+@pytest.fixture(autouse=True)
+def _clear_caches():
+    for cache in [
+        bot._admin_cache,
+        bot._admin_roster_cache,
+        bot._broken_reports,
+        bot._chat_views,
+        bot._prefix_indexes,
+        bot._seen_chat_users,
+        bot._user_chats,
+    ]:
+        cache.clear()
+        cache.hits = cache.misses = 0
+    metrics.registry.reset()
+
+
+@pytest.fixture
+def db(tmp_path):
+    engine = database.build_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    migrations.upgrade(engine)
+    database.Session.configure(bind=engine)
+    yield engine
+    database.Session.configure(bind=None)
+    engine.dispose()
+
+
+@pytest.fixture
+def statements(db):
+    """Records every SQL statement sent to the test database."""
+    executed = []
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    event.listen(db, "before_cursor_execute", _record)
+    yield executed
+    event.remove(db, "before_cursor_execute", _record)
+
+
+@pytest.fixture
+def seed(db):
+    """Creates ``services`` in the chat, each with accounts acc<first>, acc<first+1>..."""
+
+    def _seed(chat_id=1, services=("netflix",), accounts=2, first=1):
+        for service in services:
+            bot._create_service(chat_id=chat_id, service=service, username="admin")
+            for i in range(first, first + accounts):
+                bot._create_account(
+                    chat_id=chat_id,
+                    service_name=service,
+                    username=f"acc{i}",
+                    password="pwd",
+                    created_by="admin",
+                )
+
+    return _seed
+
+
+class FrozenDatetime(datetime):
+    current = datetime(2024, 1, 1, 12, 0, 0)
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.current
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Freezes bot.datetime.now() at 2024-01-01 12:00, move it with ``current``."""
+    monkeypatch.setattr(bot, "datetime", FrozenDatetime)
+    FrozenDatetime.current = datetime(2024, 1, 1, 12, 0, 0)
+    return FrozenDatetime
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def timer():
+    """Monotonic timer for TTLCache and the outbox that only moves when told to."""
+    return FakeTimer()
+
+
+@pytest.fixture
+def fake_bot():
+    return FakeBot()
+
+
+@pytest.fixture
+def context(fake_bot):
+    return SimpleNamespace(bot=fake_bot)
+
+
+@pytest.fixture
+def make_update():
+    def _make_update(text, chat_id=1, username="alice", user_id=10):
+        chat = SimpleNamespace(id=chat_id)
+        message = SimpleNamespace(text=text, chat_id=chat_id)
+        user = SimpleNamespace(id=user_id, username=username)
+        return SimpleNamespace(
+            effective_chat=chat,
+            effective_message=message,
+            effective_user=user,
+            message=message,
+        )
+
+    return _make_update
@@ -0,0 +1,147 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import select
+
+import bot
+import database
+from models import Service, Usage, UsageTotal
+
+
+def _grab_all(service, accounts, user="bob"):
+    for i in range(accounts):
+        bot._use(chat_id=1, service=service, username=f"acc{i}", current_user=user)
+
+
+def test__release_expired__should__honour__service__and__global__ttl(db, clock, seed):
+    seed(services=("netflix", "spotify"), first=0)
+    bot._set_grab_ttl(chat_id=1, service="spotify", grab_ttl=60)
+    _grab_all("netflix", 1)
+    _grab_all("spotify", 1)
+    clock.current += timedelta(minutes=30)
+    _grab_all("spotify", 2, user="carol")
+
+    expired = bot._release_expired(global_ttl=3600)
+
+    assert [(grab.service, grab.username, grab.grabbed_by) for grab in expired] == [
+        ("spotify", "acc0", "bob")
+    ]
+    clock.current += timedelta(minutes=31)
+    expired = bot._release_expired(global_ttl=3600)
+
+    assert sorted((grab.service, grab.username) for grab in expired) == [
+        ("netflix", "acc0"),
+        ("spotify", "acc1"),
+    ]
+    with database.Session() as session:
+        assert (
+            session.scalars(select(Usage).where(Usage.finished_at.is_(None))).all()
+            == []
+        )
+        totals = dict(
+            session.execute(
+                select(UsageTotal.performed_by, UsageTotal.seconds).where(
+                    UsageTotal.service_id == 1
+                )
+            ).all()
+        )
+    assert totals == {"bob": 61 * 60}
+
+
+def test__release_expired__should__cost__constant__statements(
+    db, clock, statements, seed
+):
+    seed(services=("netflix", "spotify"), accounts=20, first=0)
+    bot._set_grab_ttl(chat_id=1, service="spotify", grab_ttl=60)
+    _grab_all("netflix", 1)
+    clock.current += timedelta(hours=2)
+    statements.clear()
+    assert len(bot._release_expired(global_ttl=3600)) == 1
+    few = len(statements)
+
+    _grab_all("netflix", 20)
+    _grab_all("spotify", 20, user="carol")
+    bot._release(chat_id=1, service="spotify", username="acc0", current_user="carol")
+    clock.current += timedelta(hours=2)
+    statements.clear()
+
+    assert len(bot._release_expired(global_ttl=3600)) == 39
+    assert len(statements) == few
+
+
+def test__release_expired__given__no__ttl__should__not__release(db, clock, seed):
+    seed(services=("netflix", "spotify"), first=0)
+    _grab_all("netflix", 1)
+    clock.current += timedelta(days=30)
+
+    assert bot._release_expired(global_ttl=0) == []
+
+
+def test__release_expired__given__deleted__service__should__release__the__others(
+    db, clock, seed
+):
+    seed(services=("netflix", "spotify"), first=0)
+    _grab_all("netflix", 1)
+    _grab_all("spotify", 1)
+    bot._delete_service(chat_id=1, service="netflix")
+    clock.current += timedelta(hours=2)
+
+    expired = bot._release_expired(global_ttl=3600)
+
+    assert [(grab.service, grab.username) for grab in expired] == [("spotify", "acc0")]
+
+
+def test__release_expired_job__should__notify__each__chat(
+    db, clock, context, fake_bot, monkeypatch, seed
+):
+    monkeypatch.setattr(bot, "_GRAB_TTL", 3600)
+    seed(services=("netflix", "spotify"), first=0)
+    _grab_all("netflix", 2)
+    clock.current += timedelta(hours=2)
+
+    asyncio.run(bot.release_expired_job(context))
+
+    assert fake_bot.sent == [
+        (
+            1,
+            "These accounts were released automatically:"
+            "\n@bob: netflix acc0 (in use since 2024-01-01 12:00)"
+            "\n@bob: netflix acc1 (in use since 2024-01-01 12:00)",
+        )
+    ]
+
+
+def test__auto_release_handler__should__set__service__ttl(
+    db, context, fake_bot, make_update, seed
+):
+    fake_bot.statuses[10] = "administrator"
+    seed(services=("netflix", "spotify"), first=0)
+
+    asyncio.run(
+        bot.auto_release_handler(make_update("/auto_release netflix 1.5"), context)
+    )
+    asyncio.run(bot.auto_release_handler(make_update("/auto_release hbo 2"), context))
+
+    assert [text for _, text in fake_bot.sent] == [
+        "Accounts of service netflix will be released automatically after 1.5 hour(s) of use.",
+        "Service not found",
+    ]
+
+
+@pytest.mark.parametrize("hours", ["nan", "inf", "-1", "0.0001", "soon"])
+def test__auto_release_handler__given__invalid__hours__should__refuse(
+    db, context, fake_bot, make_update, hours, seed
+):
+    fake_bot.statuses[10] = "administrator"
+    seed(services=("netflix", "spotify"), first=0)
+
+    asyncio.run(
+        bot.auto_release_handler(make_update(f"/auto_release netflix {hours}"), context)
+    )
+
+    assert [text for _, text in fake_bot.sent] == [
+        "The hours must be a positive number"
+    ]
+    with database.Session() as session:
+        assert session.scalars(select(Service.grab_ttl)).all() == [None, None]
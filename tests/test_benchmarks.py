@@ -0,0 +1,22 @@
+import bot
+from benchmarks import handlers, statements
+
+
+def test__benchmark__should__drive__every__command__on__a__small__dataset():
+    dataset = handlers.Dataset(chats=2, services=2, accounts=3, usages=50)
+
+    results = {r.command: r for r in handlers.run(dataset, iterations=6)}
+
+    assert set(results) == set(bot.COMMANDS) | set(handlers.OTHER_HANDLERS)
+    assert all(r.calls == 6 and r.p99_ms >= r.p50_ms for r in results.values())
+    assert results["use"].statements == 2
+    assert results["status"].statements <= 1
+    assert "sql/call" in handlers.format_results(list(results.values()))
+
+
+def test__statements__benchmark__should__time__both__variants__of__every__operation():
+    results = statements.run(calls=5, accounts=3)
+
+    assert [r.operation for r in results] == list(statements.OPERATIONS)
+    assert all(r.legacy_us > 0 and r.prebuilt_us > 0 for r in results)
+    assert "saved us" in statements.format_results(results)
@@ -1,3 +1,9 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import NetworkError
+
 import bot
 
 
@@ -15,3 +21,108 @@ def test__check_args__given__2__args__expected__3__args__should__return__false()
     expected_result = False
     result = bot._check_args(args, expected_args)
     assert result == expected_result
+
+
+def test__only_admins_or_creators__given__member__should__deny(
+    context, fake_bot, make_update
+):
+    asyncio.run(bot.create_service_handler(make_update("/create_service x"), context))
+
+    assert fake_bot.sent == [(1, "Only admins can use this command.")]
+
+
+def test__is_admin_or_creator__should__cache__chat__member__lookups(
+    context, fake_bot, make_update
+):
+    fake_bot.statuses[10] = "administrator"
+    update = make_update("/create_service x")
+
+    async def scenario():
+        return [await bot._is_admin_or_creator(update, context) for _ in range(20)]
+
+    assert all(asyncio.run(scenario()))
+    assert len(fake_bot.api_calls) == 1
+
+
+def test__chat_member_handler__should__invalidate__cached__admin__check(
+    context, fake_bot, make_update
+):
+    fake_bot.statuses[10] = "creator"
+    update = make_update("/create_service x")
+    asyncio.run(bot._is_admin_or_creator(update, context))
+
+    fake_bot.statuses[10] = "member"
+    member_update = SimpleNamespace(
+        chat_member=SimpleNamespace(
+            chat=SimpleNamespace(id=1),
+            new_chat_member=SimpleNamespace(
+                user=SimpleNamespace(id=10), status="member"
+            ),
+        )
+    )
+    asyncio.run(bot.chat_member_handler(member_update, context))
+
+    assert not asyncio.run(bot._is_admin_or_creator(update, context))
+    assert len(fake_bot.api_calls) == 2
+
+
+def test__report_broken_handler__should__cache__admin__roster(
+    context, fake_bot, make_update
+):
+    fake_bot.statuses[99] = "administrator"
+
+    async def scenario():
+        for service in ["netflix", "spotify", "hbo"]:
+            await bot.report_broken_handler(
+                make_update(f"/report_broken {service} acc1"), context
+            )
+
+    asyncio.run(scenario())
+
+    assert len(fake_bot.api_calls) == 1
+    assert all("@admin99" in text for _, text in fake_bot.sent)
+
+
+def test__report_broken_handler__given__duplicated__reports__should__reply__once(
+    context, fake_bot, make_update
+):
+    fake_bot.statuses[99] = "administrator"
+
+    async def scenario():
+        for reporter in ["alice", "bob", "carol"]:
+            await bot.report_broken_handler(
+                make_update("/report_broken netflix acc1", username=reporter), context
+            )
+
+    asyncio.run(scenario())
+
+    [(_, ping)] = fake_bot.sent
+    assert "@admin99" in ping and "@alice reported" in ping
+    assert bot._broken_reports.get((1, "netflix", "acc1")) == "alice"
+
+
+def test__report_broken_handler__given__admins__lookup__fails__should__ping__next__time(
+    context, fake_bot, make_update, monkeypatch
+):
+    fake_bot.statuses[99] = "administrator"
+    get_chat_administrators = fake_bot.get_chat_administrators
+
+    async def failing(chat_id, **kwargs):
+        raise NetworkError("down")
+
+    monkeypatch.setattr(fake_bot, "get_chat_administrators", failing)
+    with pytest.raises(NetworkError):
+        asyncio.run(
+            bot.report_broken_handler(
+                make_update("/report_broken netflix acc1", username="alice"), context
+            )
+        )
+    monkeypatch.setattr(fake_bot, "get_chat_administrators", get_chat_administrators)
+    asyncio.run(
+        bot.report_broken_handler(
+            make_update("/report_broken netflix acc1", username="bob"), context
+        )
+    )
+
+    [(_, ping)] = fake_bot.sent
+    assert "@admin99" in ping and "@bob reported" in ping
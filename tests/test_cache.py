@@ -0,0 +1,31 @@
+from cache import TTLCache
+
+
+def test__ttl_cache__given__expired__entry__should__miss(timer):
+    cache = TTLCache(maxsize=10, ttl=5, timer=timer)
+    cache.set("a", 1)
+
+    assert cache.get("a") == 1
+    timer.now = 5
+    assert cache.get("a") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test__ttl_cache__given__full__cache__should__evict__least__recently__used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert len(cache) == 2
+
+
+def test__ttl_cache__pop__should__invalidate__entry():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", False)
+
+    assert cache.pop("a") is False
+    assert cache.get("a") is None
@@ -0,0 +1,99 @@
+import asyncio
+
+import bot
+
+
+def _run(handler, update, context):
+    asyncio.run(handler(update, context))
+
+
+def test__read__handlers__should__be__answered__from__cache(
+    db, statements, context, fake_bot, make_update, seed
+):
+    seed()
+    seed(services=("spotify",), accounts=0)
+    statements.clear()
+
+    _run(bot.services_handler, make_update("/services"), context)
+    loaded = len(statements)
+    _run(bot.check_handler, make_update("/check netflix"), context)
+    _run(bot.status_me_handler, make_update("/status_me"), context)
+
+    assert len(statements) == loaded
+    assert (bot._chat_views.hits, bot._chat_views.misses) == (2, 1)
+    assert fake_bot.sent[0][1].endswith("netflix\n  *  spotify")
+
+
+def test__mutators__should__invalidate__chat__view(
+    db, context, fake_bot, make_update, seed
+):
+    seed()
+    seed(services=("spotify",), accounts=0)
+    _run(bot.services_handler, make_update("/services"), context)
+
+    _run(bot.use_handler, make_update("/use netflix acc1", username="bob"), context)
+    _run(bot.status_me_handler, make_update("/status_me", username="bob"), context)
+
+    assert fake_bot.sent[-1][1] == (
+        "You are currently using 1 account(s):"
+        "\nService: netflix; Username: acc1; Password: pwd;"
+    )
+    assert bot._chat_views.misses == 2
+
+
+def test__chat__view__should__be__scoped__to__chat(
+    db, context, fake_bot, make_update, seed
+):
+    seed()
+    seed(services=("spotify",), accounts=0)
+
+    _run(bot.services_handler, make_update("/services", chat_id=2), context)
+
+    assert fake_bot.sent[0][1].startswith("No services available.")
+
+
+def test__get_chat_view__given__write__during__load__should__not__cache(db, seed):
+    seed()
+    seed(services=("spotify",), accounts=0)
+
+    async def scenario():
+        load = asyncio.ensure_future(bot._get_chat_view(1))
+        await asyncio.sleep(0)
+        bot._invalidate_chat(1)
+        await load
+
+    asyncio.run(scenario())
+
+    assert 1 not in bot._chat_views
+    assert bot._chat_loads == {}
+
+
+def test__invalidate_chat__given__no__load__should__not__track__the__chat(db):
+    for chat_id in range(100):
+        bot._invalidate_chat(chat_id)
+
+    assert bot._chat_loads == {}
+
+
+def test__load_chat_view__should__project__rows__in__one__statement(
+    db, statements, seed
+):
+    seed()
+    seed(services=("spotify",), accounts=0)
+    # created last, listed first
+    bot._create_account(
+        chat_id=1,
+        service_name="netflix",
+        username="acc0",
+        password="pwd",
+        created_by="admin",
+    )
+    statements.clear()
+
+    view = bot._load_chat_view(1)
+
+    assert len(statements) == 1
+    assert list(view) == ["netflix", "spotify"]
+    assert [type(a) for a in view["netflix"]] == [bot.AccountView] * 3
+    assert [a.username for a in view["netflix"]] == ["acc0", "acc1", "acc2"]
+    assert view["spotify"] == []
@@ -0,0 +1,91 @@
+import asyncio
+import threading
+import time
+
+import bot
+import database
+
+
+def test__run_sync__should__run__function__outside__event__loop__thread():
+    async def scenario():
+        return await database.run_sync(threading.get_ident)
+
+    assert asyncio.run(scenario()) != threading.get_ident()
+
+
+def test__run_sync__given__slow__call__should__keep__event__loop__responsive():
+    async def scenario():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        await database.run_sync(time.sleep, 0.2)
+        task.cancel()
+        return ticks
+
+    assert asyncio.run(scenario()) >= 5
+
+
+def test__status_handler__should__list__accounts__through__executor(
+    db, context, fake_bot, make_update
+):
+    bot._create_service(chat_id=1, service="netflix", username="alice")
+    bot._create_account(
+        chat_id=1,
+        service_name="netflix",
+        username="acc1",
+        password="pwd",
+        created_by="alice",
+    )
+
+    asyncio.run(bot.status_handler(make_update("/status netflix"), context))
+
+    assert len(fake_bot.sent) == 1
+    assert "acc1" in fake_bot.sent[0][1]
+
+
+def _pragma(engine, name):
+    with engine.connect() as connection:
+        return connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+
+
+def test__build_engine__given__sqlite__file__should__apply__pragmas(tmp_path):
+    engine = database.build_engine(f"sqlite:///{tmp_path / 'pragmas.db'}")
+
+    assert _pragma(engine, "journal_mode") == "wal"
+    assert _pragma(engine, "synchronous") == 1
+    assert _pragma(engine, "busy_timeout") == 5000
+    assert _pragma(engine, "cache_size") == -16384
+
+
+def test__build_engine__given__pool__settings__should__size__pool(
+    tmp_path, monkeypatch
+):
+    monkeypatch.setenv("DB_POOL_SIZE", "3")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "1")
+
+    engine = database.build_engine(f"sqlite:///{tmp_path / 'pool.db'}")
+
+    assert engine.pool.size() == 3
+    assert engine.pool._max_overflow == 1
+
+
+def test__build_engine__given__database__url__env__should__use__it(
+    tmp_path, monkeypatch
+):
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'env.db'}")
+
+    engine = database.build_engine()
+
+    assert engine.url.database == str(tmp_path / "env.db")
+
+
+def test__build_engine__given__in__memory__sqlite__should__connect():
+    engine = database.build_engine("sqlite://")
+
+    assert _pragma(engine, "busy_timeout") == 5000
@@ -0,0 +1,162 @@
+import asyncio
+import csv
+import io
+import json
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import func, select
+from telegram import Update
+
+import bot
+import database
+from models import Account
+
+
+@pytest.fixture
+def admin(fake_bot):
+    fake_bot.statuses[10] = "administrator"
+
+
+def _document_update(make_update, fake_bot, caption, file_name, content):
+    fake_bot.files["file-1"] = content
+    update = make_update(caption)
+    update.message.text = None
+    update.message.caption = caption
+    update.message.reply_to_message = None
+    update.message.document = SimpleNamespace(
+        file_id="file-1", file_name=file_name, file_size=len(content)
+    )
+    return update
+
+
+def _report(fake_bot):
+    _, _, content = fake_bot.documents[-1]
+    return list(csv.reader(io.StringIO(content.decode())))
+
+
+def test__parse_accounts_document__given__csv__should__read__columns():
+    content = b"password,username\npwd1,acc1\npwd2, acc2 \n"
+
+    assert bot._parse_accounts_document(content, "accounts.csv") == [
+        ("acc1", "pwd1"),
+        ("acc2", "pwd2"),
+    ]
+
+
+def test__parse_accounts_document__given__bad__input__should__raise():
+    with pytest.raises(ValueError):
+        bot._parse_accounts_document(b"user,pass\na,b\n", "accounts.csv")
+    with pytest.raises(ValueError):
+        bot._parse_accounts_document(b'{"username": "a"}', "accounts.json")
+
+
+def test__import_accounts_handler__should__report__every__row(
+    db, admin, context, fake_bot, make_update, monkeypatch
+):
+    monkeypatch.setattr(bot, "_IMPORT_BATCH_SIZE", 2)
+    bot._create_service(chat_id=1, service="netflix", username="admin")
+    bot._create_account(
+        chat_id=1,
+        service_name="netflix",
+        username="acc2",
+        password="pwd",
+        created_by="admin",
+    )
+    content = json.dumps(
+        [
+            {"username": "acc1", "password": "pwd1"},
+            {"username": "acc2", "password": "pwd2"},
+            {"username": "acc1", "password": "pwd3"},
+            {"username": "acc3"},
+            {"username": "acc4", "password": "pwd4"},
+        ]
+    ).encode()
+    update = _document_update(
+        make_update, fake_bot, "/import_accounts netflix", "accounts.json", content
+    )
+
+    asyncio.run(bot.import_accounts_handler(update, context))
+
+    assert fake_bot.sent == [(1, "Imported 2 of 5 account(s) for service netflix.")]
+    assert _report(fake_bot) == [
+        ["row", "username", "result"],
+        ["1", "acc1", "created"],
+        ["2", "acc2", "already exists"],
+        ["3", "acc1", "duplicated in file"],
+        ["4", "acc3", "missing username or password"],
+        ["5", "acc4", "created"],
+    ]
+    with database.Session() as session:
+        assert session.scalar(select(func.count(Account.account_id))) == 3
+
+
+def test__import_accounts_handler__given__unknown__service__should__not__import(
+    db, admin, context, fake_bot, make_update
+):
+    update = _document_update(
+        make_update,
+        fake_bot,
+        "/import_accounts netflix",
+        "a.csv",
+        b"username,password\na,b\n",
+    )
+
+    asyncio.run(bot.import_accounts_handler(update, context))
+
+    assert fake_bot.sent == [(1, "Service not found")]
+    assert fake_bot.documents == []
+
+
+def test__export_handler__should__stream__services__and__accounts(
+    db, admin, context, fake_bot, make_update
+):
+    bot._create_service(chat_id=1, service="spotify", username="admin")
+    bot._create_service(chat_id=1, service="netflix", username="admin")
+    bot._create_service(chat_id=2, service="hbo", username="admin")
+    for username in ["acc2", "acc1"]:
+        bot._create_account(
+            chat_id=1,
+            service_name="netflix",
+            username=username,
+            password="pwd",
+            created_by="admin",
+        )
+
+    asyncio.run(bot.export_handler(make_update("/export"), context))
+    asyncio.run(bot.export_handler(make_update("/export spotify"), context))
+
+    assert _report(fake_bot) == [
+        ["service", "username", "password"],
+        ["spotify", "", ""],
+    ]
+    chat_id, filename, content = fake_bot.documents[0]
+    assert (chat_id, filename) == (1, "services.csv")
+    assert content.decode().splitlines() == [
+        "service,username,password",
+        "netflix,acc1,pwd",
+        "netflix,acc2,pwd",
+        "spotify,,",
+    ]
+
+
+def test__router__should__accept__commands__in__captions(telegram_api):
+    data = telegram_api.make_update("/import_accounts")
+    message = data["message"]
+    message["caption"] = message.pop("text")
+    message["caption_entities"] = message.pop("entities")
+    router = bot.CommandRouter(bot.COMMANDS)
+
+    route, args_count = router.check_update(Update.de_json(data, None))
+
+    assert (route.usage, args_count) == ("Usage: /import_accounts <service_name>", 0)
+
+
+def test__router__given__caption__should__ignore__other__commands(telegram_api):
+    data = telegram_api.make_update("/use netflix acc1")
+    message = data["message"]
+    message["caption"] = message.pop("text")
+    message["caption_entities"] = message.pop("entities")
+    router = bot.CommandRouter(bot.COMMANDS)
+
+    assert router.check_update(Update.de_json(data, None)) is None
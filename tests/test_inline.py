@@ -0,0 +1,102 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram import ChatMember
+
+import bot
+
+
+@pytest.fixture
+def services(db):
+    for chat_id, service in [
+        (1, "netflix"),
+        (1, "Nebula"),
+        (1, "spotify"),
+        (2, "news"),
+    ]:
+        bot._create_service(chat_id=chat_id, service=service, username="admin")
+    for username in ["acc1", "acc2"]:
+        bot._create_account(
+            chat_id=1,
+            service_name="netflix",
+            username=username,
+            password="pwd",
+            created_by="admin",
+        )
+    bot._use(chat_id=1, service="netflix", username="acc1", current_user="bob")
+    asyncio.run(bot._remember_chat_user(chat_id=1, user_id=10))
+
+
+def _inline(text, user_id=10):
+    answers = []
+
+    async def answer(results, **kwargs):
+        answers.append((results, kwargs))
+
+    query = SimpleNamespace(
+        query=text, from_user=SimpleNamespace(id=user_id), answer=answer
+    )
+    asyncio.run(bot.inline_query_handler(SimpleNamespace(inline_query=query), None))
+    [(results, kwargs)] = answers
+    return results, kwargs
+
+
+def test__inline_query__should__prefix__match__the__user__chats(services):
+    results, kwargs = _inline("NE")
+
+    assert [(r.title, r.description) for r in results] == [
+        ("Nebula", "0 of 0 account(s) available"),
+        ("netflix", "1 of 2 account(s) available"),
+    ]
+    assert results[1].input_message_content.message_text == (
+        "Accounts of service netflix:"
+        "\n  *  acc1  (Unavailable [being used by @bob])"
+        "\n  *  acc2  (Available)"
+    )
+    assert kwargs == {"cache_time": bot._INLINE_CACHE_TIME, "is_personal": True}
+
+
+def test__inline_query__given__empty__query__should__list__all__services(services):
+    results, _ = _inline("")
+
+    assert [r.title for r in results] == ["Nebula", "netflix", "spotify"]
+
+
+def test__inline_query__should__be__answered__from__cache(services, statements):
+    _inline("net")
+    statements.clear()
+
+    _inline("spo")
+    assert statements == []
+    bot._create_service(chat_id=1, service="netbox", username="admin")
+    statements.clear()
+    results, _ = _inline("net")
+
+    assert [r.title for r in results] == ["netbox", "netflix"]
+    assert len(statements) == 1  # the chat view was reloaded once
+
+
+def test__inline_query__given__unknown__user__should__offer__private__chat(services):
+    results, kwargs = _inline("net", user_id=99)
+
+    assert results == []
+    assert kwargs["switch_pm_parameter"] == "inline"
+
+
+def test__inline_query__given__member__left__should__hide__the__chat(services):
+    assert _inline("net")[0]
+
+    member_update = SimpleNamespace(
+        chat_member=SimpleNamespace(
+            chat=SimpleNamespace(id=1),
+            new_chat_member=SimpleNamespace(
+                user=SimpleNamespace(id=10), status=ChatMember.LEFT
+            ),
+        )
+    )
+    asyncio.run(bot.chat_member_handler(member_update, None))
+    bot._chat_views.clear()
+
+    assert _inline("net")[0] == []
+    assert bot._load_user_chats(user_id=10) == ()
@@ -0,0 +1,187 @@
+import asyncio
+import os
+import subprocess
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+from telegram import Update
+
+import bot
+import database
+from journal import WriteBehindJournal
+from models import Account, Usage, UsageTotal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_CRASH = """
+import asyncio, os
+import bot
+from database import run_sync
+
+async def main():
+    bot._usage_journal.interval = 60
+    bot._usage_journal.start()
+    await run_sync(bot._use, 1, "netflix", "acc1", "alice")
+    await run_sync(bot._usage_journal.flush)
+    await run_sync(bot._release, 1, "netflix", "acc1", "alice")
+    await run_sync(bot._use, 1, "netflix", "acc2", "bob")
+    os._exit(0)
+
+asyncio.run(main())
+"""
+
+
+def _usages():
+    with database.Session() as session:
+        return session.execute(
+            select(Account.username, Usage.performed_by, Usage.finished_at)
+            .join(Account, Usage.account_id == Account.account_id)
+            .order_by(Usage.usage_id)
+        ).all()
+
+
+def _journaled(monkeypatch, scenario, interval=60, max_events=100):
+    monkeypatch.setattr(bot._usage_journal, "interval", interval)
+    monkeypatch.setattr(bot._usage_journal, "max_events", max_events)
+
+    async def run():
+        bot._usage_journal.start()
+        try:
+            return await scenario()
+        finally:
+            await bot._usage_journal.stop()
+
+    return asyncio.run(run())
+
+
+def test__journal__should__group__usage__writes__into__one__transaction(
+    db, statements, monkeypatch, seed
+):
+    seed(accounts=5)
+    statements.clear()
+
+    async def scenario():
+        for i in range(1, 6):
+            assert await database.run_sync(bot._use, 1, "netflix", f"acc{i}", "bob")
+        await database.run_sync(bot._release, 1, "netflix", "acc1", "bob")
+        return _usages()
+
+    assert _journaled(monkeypatch, scenario) == []
+    assert len(_usages()) == 5
+    assert [u.finished_at is not None for u in _usages()] == [True] + [False] * 4
+    assert len([s for s in statements if s.startswith("INSERT INTO usage ")]) == 1
+
+
+def test__journal__should__keep__availability__strongly__consistent(
+    db, monkeypatch, seed
+):
+    seed(accounts=1)
+
+    async def scenario():
+        grabbed = await database.run_sync(bot._use, 1, "netflix", "acc1", "alice")
+        again = await database.run_sync(bot._use, 1, "netflix", "acc1", "bob")
+        return grabbed, again, bot._usage_journal.depth
+
+    assert _journaled(monkeypatch, scenario) == (True, False, 1)
+
+
+def test__journal__given__max__events__should__flush__before__the__interval(
+    db, monkeypatch, seed
+):
+    seed(accounts=3)
+
+    async def scenario():
+        for i in range(1, 4):
+            await database.run_sync(bot._use, 1, "netflix", f"acc{i}", "bob")
+        for _ in range(500):
+            # written is only counted once the group committed
+            if bot._usage_journal.written >= written + 3:
+                break
+            await asyncio.sleep(0.01)
+        return len(_usages())
+
+    written = bot._usage_journal.written
+    assert _journaled(monkeypatch, scenario, max_events=3) == 3
+
+
+def test__application__stop__should__flush__the__journal(
+    db, telegram_api, monkeypatch, seed
+):
+    seed(accounts=1)
+    monkeypatch.setattr(bot._usage_journal, "interval", 60)
+
+    async def scenario():
+        application = (
+            bot.application_builder().token("123:TEST").request(telegram_api).build()
+        )
+        bot.register_handlers(application)
+        async with application:
+            await application.start()
+            data = telegram_api.make_update("/use netflix acc1")
+            await application.update_queue.put(Update.de_json(data, application.bot))
+            await telegram_api.wait_for_replies(1)
+            pending = bot._usage_journal.depth
+            await application.stop()
+        return pending
+
+    assert asyncio.run(scenario()) == 1
+    assert [u.performed_by for u in _usages()] == ["alice"]
+
+
+def test__recover_usage__given__crash__should__repair__lost__usage__rows(db, seed):
+    seed()
+    env = dict(os.environ, DATABASE_URL=str(db.url), PYTHONPATH=ROOT)
+
+    subprocess.run([sys.executable, "-c", _CRASH], env=env, check=True)
+
+    # the accounts survived the crash, the last group of usage writes did not
+    assert [tuple(u) for u in _usages()] == [("acc1", "alice", None)]
+    assert bot._recover_usage() == (1, 1)
+    with database.Session() as session:
+        acc1, acc2 = session.scalars(select(Account).order_by(Account.username))
+        usages = session.scalars(select(Usage).order_by(Usage.usage_id)).all()
+        [total] = session.scalars(select(UsageTotal)).all()
+    assert usages[0].finished_at == acc1.released_at
+    assert (usages[1].performed_by, usages[1].started_at) == ("bob", acc2.grabbed_at)
+    assert usages[1].finished_at is None
+    assert total.performed_by == "alice" and total.seconds > 0
+    assert bot._recover_usage() == (0, 0)
+
+
+def test__journal__given__failing__event__should__dead__letter__only__it(db):
+    written = []
+
+    def write(session, events):
+        if "bad" in events:
+            raise ValueError("bad event")
+        written.extend(events)
+
+    journal = WriteBehindJournal(write, max_attempts=2)
+    journal._pending = ["ok1", "bad", "ok2"]
+
+    with pytest.raises(ValueError):
+        journal.flush()
+    assert journal.flush() == 2
+
+    assert written == ["ok1", "ok2"]
+    assert list(journal.dead_letters) == ["bad"]
+    assert (journal.depth, journal.dropped) == (0, 1)
+
+
+def test__write_usage__given__deleted__service__should__not__add__totals(db, seed):
+    seed(accounts=1)
+    started = datetime.now() - timedelta(hours=1)
+    closes = [
+        bot.UsageClosed(1, 999, "bob", started, datetime.now()),
+        bot.UsageClosed(1, 999, "alice", started, datetime.now()),
+    ]
+
+    for group in (closes[:1], closes):
+        with database.Session() as session:
+            bot._write_usage(session, group)
+            session.commit()
+
+    with database.Session() as session:
+        assert session.scalars(select(UsageTotal)).all() == []
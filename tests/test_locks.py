@@ -0,0 +1,152 @@
+import asyncio
+import time
+
+from telegram import Update
+
+import bot
+from locks import KeyedLock
+
+
+def test__keyed_lock__should__serialize__same__key__only():
+    locks = KeyedLock()
+    events = []
+
+    async def task(key, name):
+        async with locks(key):
+            events.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            events.append(f"{name} end")
+
+    async def scenario():
+        await asyncio.gather(task("a", "a1"), task("a", "a2"), task("b", "b1"))
+
+    asyncio.run(scenario())
+
+    assert events.index("a1 end") < events.index("a2 start")
+    assert events.index("b1 start") < events.index("a1 end")
+    assert len(locks) == 0
+
+
+def test__keyed_lock__should__release__on__error():
+    locks = KeyedLock()
+
+    async def scenario():
+        try:
+            async with locks("a"):
+                raise ValueError
+        except ValueError:
+            pass
+        async with locks("a"):
+            return locks.locked("a")
+
+    assert asyncio.run(scenario())
+    assert len(locks) == 0
+
+
+def test__router__should__hold__the__chat__lock__for__writes__only(
+    db, telegram_api, monkeypatch
+):
+    held = []
+
+    def _use(chat_id, service, username, current_user):
+        held.append(("use", bot._chat_locks.locked(chat_id)))
+        return True
+
+    def _load_account_page(chat_id, service_name, **kwargs):
+        held.append(("accounts", bot._chat_locks.locked(chat_id)))
+        return bot.AccountPage(None, None, [], None, None, False, False)
+
+    monkeypatch.setattr(bot, "_use", _use)
+    monkeypatch.setattr(bot, "_load_account_page", _load_account_page)
+    router = bot.CommandRouter(bot.COMMANDS)
+
+    async def scenario():
+        application = (
+            bot.application_builder().token("123:TEST").request(telegram_api).build()
+        )
+        async with application:
+            for text in ["/use netflix acc1", "/accounts netflix"]:
+                update = Update.de_json(telegram_api.make_update(text), application.bot)
+                context = bot.ContextTypes.DEFAULT_TYPE.from_update(update, application)
+                await router.handle_update(
+                    update, application, router.check_update(update), context
+                )
+
+    asyncio.run(scenario())
+
+    assert held == [("use", True), ("accounts", False)]
+
+
+def test__application__should__process__updates__concurrently(
+    telegram_api, monkeypatch
+):
+    monkeypatch.setenv("CONCURRENT_UPDATES", "8")
+
+    def slow_ranking(chat_id, service_name):
+        time.sleep(0.2)
+        return []
+
+    monkeypatch.setattr(bot, "_ranking", slow_ranking)
+
+    async def scenario():
+        application = (
+            bot.application_builder()
+            .token("123:TEST")
+            .application_class(bot.Application)
+            .request(telegram_api)
+            .build()
+        )
+        bot.register_handlers(application)
+        async with application:
+            await application.start()
+            for chat_id in range(1, 5):
+                data = telegram_api.make_update("/ranking netflix", chat_id=chat_id)
+                await application.update_queue.put(
+                    Update.de_json(data, application.bot)
+                )
+            started = time.perf_counter()
+            await telegram_api.wait_for_replies(4)
+            elapsed = time.perf_counter() - started
+            await application.stop()
+        return elapsed
+
+    assert asyncio.run(scenario()) < 0.6
+
+
+def test__application__should__keep__the__order__of__changes__in__a__chat(
+    db, telegram_api, monkeypatch
+):
+    monkeypatch.setenv("CONCURRENT_UPDATES", "8")
+    create_service = bot._create_service
+
+    def slow_create_service(**kwargs):
+        time.sleep(0.2)
+        return create_service(**kwargs)
+
+    async def is_admin(update, context):
+        return True
+
+    monkeypatch.setattr(bot, "_create_service", slow_create_service)
+    monkeypatch.setattr(bot, "_is_admin_or_creator", is_admin)
+
+    async def scenario():
+        application = (
+            bot.application_builder().token("123:TEST").request(telegram_api).build()
+        )
+        bot.register_handlers(application)
+        async with application:
+            await application.start()
+            for text in ["/create_service netflix", "/create_account netflix a p"]:
+                data = telegram_api.make_update(text)
+                await application.update_queue.put(
+                    Update.de_json(data, application.bot)
+                )
+            await telegram_api.wait_for_replies(1)
+            await application.stop()
+
+    asyncio.run(scenario())
+
+    replies = "\n".join(text for _, _, text in telegram_api.replies)
+    assert "Service netflix created successfully" in replies
+    assert "Account a successfully created for service netflix" in replies
+    assert bot._load_account_page(chat_id=1, service_name="netflix").accounts
@@ -0,0 +1,76 @@
+import csv
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func, select
+
+import bot
+import database
+import maintenance
+from models import Usage, UsageDaily
+
+
+def _session(clock, username, user, seconds):
+    bot._use(chat_id=1, service="netflix", username=username, current_user=user)
+    clock.current += timedelta(seconds=seconds)
+    bot._release(chat_id=1, service="netflix", username=username, current_user=user)
+
+
+def _sessions(clock):
+    _session(clock, "acc1", "bob", 60)
+    _session(clock, "acc2", "carol", 30)
+    clock.current += timedelta(days=1)
+    _session(clock, "acc1", "bob", 90)
+    clock.current += timedelta(days=30)
+    _session(clock, "acc1", "carol", 10)
+    # still open, never rolled up
+    bot._use(chat_id=1, service="netflix", username="acc2", current_user="bob")
+
+
+def test__rollup_usage__should__keep__ranking__exact(db, clock, tmp_path, seed):
+    seed()
+    _sessions(clock)
+    ranking = bot._ranking(chat_id=1, service_name="netflix")
+    archive = tmp_path / "usage.csv"
+
+    rolled_up = maintenance.rollup_usage(
+        clock.current - timedelta(days=7), archive_path=str(archive), batch_size=2
+    )
+
+    assert rolled_up == 3
+    assert bot._ranking(chat_id=1, service_name="netflix") == ranking
+    with database.Session() as session:
+        assert session.scalar(select(func.count(Usage.usage_id))) == 2
+        daily = session.execute(
+            select(
+                UsageDaily.performed_by,
+                UsageDaily.day,
+                UsageDaily.sessions,
+                UsageDaily.seconds,
+            ).order_by(UsageDaily.day, UsageDaily.performed_by)
+        ).all()
+    assert daily == [
+        ("bob", date(2024, 1, 1), 1, 60),
+        ("carol", date(2024, 1, 1), 1, 30),
+        ("bob", date(2024, 1, 2), 1, 90),
+    ]
+    with open(archive, newline="") as archived:
+        rows = list(csv.reader(archived))
+    assert rows[0] == maintenance.ARCHIVE_COLUMNS
+    assert [row[4] for row in rows[1:]] == ["bob", "carol", "bob"]
+
+
+def test__rollup_usage__given__existing__day__should__add__to__it(db, clock, seed):
+    seed()
+    _sessions(clock)
+    maintenance.rollup_usage(datetime(2024, 1, 1, 23, 0))
+    clock.current = datetime(2024, 1, 1, 22, 0)
+    _session(clock, "acc1", "bob", 15)
+
+    assert maintenance.rollup_usage(datetime(2024, 1, 2, 23, 0)) == 2
+    with database.Session() as session:
+        daily = session.scalars(
+            select(UsageDaily)
+            .where(UsageDaily.performed_by == "bob")
+            .where(UsageDaily.day == date(2024, 1, 1))
+        ).one()
+    assert (daily.sessions, daily.seconds) == (2, 75)
@@ -0,0 +1,91 @@
+import asyncio
+
+import httpx
+
+import bot
+import metrics
+
+
+def test__histogram__quantile__should__return__bucket__upper__bound():
+    histogram = metrics.Histogram(buckets=(0.01, 0.1, 1.0))
+    for value in [0.005] * 90 + [0.5] * 10:
+        histogram.observe(value)
+
+    assert histogram.quantile(0.5) == 0.01
+    assert histogram.quantile(0.95) == 1.0
+    assert histogram.count == 100
+
+
+def test__track__should__tag__sql__with__command(db, context, make_update, seed):
+    seed(accounts=1)
+    use = metrics.track("use", bot.use_handler)
+
+    asyncio.run(use(make_update("/use netflix acc1"), context))
+
+    stats = metrics.registry.commands["use"]
+    assert (stats.calls, stats.statements) == (1, 2)
+    assert stats.rows_affected >= 1
+    assert stats.db_time > 0
+
+
+def test__instrument__given__failing__statement__should__count__the__error(db):
+    bot._create_service(chat_id=1, service="netflix", username="admin")
+    token = metrics.current_command.set("create_service")
+    try:
+        for _ in range(3):
+            assert not bot._create_service(
+                chat_id=1, service="netflix", username="admin"
+            )
+    finally:
+        metrics.current_command.reset(token)
+
+    assert metrics.registry.commands["create_service"].errors == 3
+
+
+def test__render_prometheus__should__expose__commands__caches__and__gauges(db):
+    metrics.registry.observe_call("status", 0.002)
+    metrics.registry.observe_statement("status", 0.001, 1)
+
+    text = metrics.registry.render_prometheus()
+
+    assert (
+        'easy_sharing_bot_command_duration_seconds_bucket{command="status",le="0.0025"} 1'
+        in text
+    )
+    assert 'easy_sharing_bot_sql_statements_total{command="status"} 1' in text
+    assert 'easy_sharing_bot_sql_rows_affected_total{command="status"} 1' in text
+    assert 'easy_sharing_bot_sql_errors_total{command="status"} 0' in text
+    assert 'easy_sharing_bot_cache_hits_total{cache="chat_views"} 0' in text
+    assert "easy_sharing_bot_outbox_depth 0" in text
+
+
+def test__start_server__should__serve__metrics__endpoint():
+    metrics.registry.observe_call("start", 0.001)
+
+    async def scenario():
+        server = await metrics.start_server("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with httpx.AsyncClient() as client:
+            found = await client.get(f"http://127.0.0.1:{port}/metrics")
+            missing = await client.get(f"http://127.0.0.1:{port}/other")
+        server.close()
+        await server.wait_closed()
+        return found, missing
+
+    found, missing = asyncio.run(scenario())
+
+    assert found.status_code == 200
+    assert 'command="start"' in found.text
+    assert missing.status_code == 404
+
+
+def test__stats_handler__should__reply__with__summary__to__admins(
+    context, fake_bot, make_update
+):
+    fake_bot.statuses[10] = "creator"
+    metrics.registry.observe_call("use", 0.004)
+
+    asyncio.run(bot.stats_handler(make_update("/stats"), context))
+
+    assert "/use: 1 | 4.0 | 5" in fake_bot.sent[0][1]
+    assert "chat_views: 0% of 0" in fake_bot.sent[0][1]
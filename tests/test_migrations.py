@@ -0,0 +1,113 @@
+import threading
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.sql import text as text_sa
+
+import bot
+import migrations
+
+# Schema as created by Base.metadata.create_all before any index existed.
+_LEGACY_SCHEMA = [
+    """CREATE TABLE service (
+        service_id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, name VARCHAR NOT NULL,
+        url VARCHAR, created_by VARCHAR NOT NULL, created_at DATETIME NOT NULL,
+        last_modified_by VARCHAR, last_modified_at DATETIME)""",
+    """CREATE TABLE account (
+        account_id INTEGER PRIMARY KEY, service_id INTEGER REFERENCES service (service_id),
+        username VARCHAR NOT NULL, password VARCHAR NOT NULL, created_by VARCHAR NOT NULL,
+        created_at DATETIME NOT NULL, grabbed_at DATETIME, grabbed_by VARCHAR,
+        released_at DATETIME, last_modified_by VARCHAR, last_modified_at DATETIME)""",
+    """CREATE TABLE usage (
+        usage_id INTEGER PRIMARY KEY, account_id INTEGER REFERENCES account (account_id),
+        performed_by VARCHAR NOT NULL, started_at DATETIME NOT NULL, finished_at DATETIME)""",
+]
+
+
+def _legacy_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as connection:
+        for statement in _LEGACY_SCHEMA:
+            connection.execute(text_sa(statement))
+    return engine
+
+
+def _indexes(engine, table):
+    return {index["name"]: index for index in inspect(engine).get_indexes(table)}
+
+
+def test__upgrade__given__legacy__database__should__add__indexes__and__version(
+    tmp_path,
+):
+    engine = _legacy_engine(tmp_path)
+
+    version = migrations.upgrade(engine)
+
+    assert version == migrations.LATEST_VERSION
+    assert _indexes(engine, "service")["ix_service_chat_id_name"]["unique"]
+    assert _indexes(engine, "account")["ix_account_service_id_username"]["unique"]
+    assert "ix_account_grabbed_by_released_at" in _indexes(engine, "account")
+    assert "ix_usage_account_id_performed_by_finished_at" in _indexes(engine, "usage")
+    assert "ix_usage_finished_at" in _indexes(engine, "usage")
+    assert "ix_account_released_at_grabbed_at" in _indexes(engine, "account")
+    assert "grab_ttl" in {
+        column["name"] for column in inspect(engine).get_columns("service")
+    }
+
+
+def test__upgrade__given__up__to__date__database__should__be__idempotent(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'fresh.db'}")
+    migrations.upgrade(engine)
+
+    assert migrations.upgrade(engine) == migrations.LATEST_VERSION
+    with engine.connect() as connection:
+        versions = connection.execute(
+            text_sa("SELECT COUNT(*) FROM schema_version")
+        ).scalar()
+    assert versions == len(migrations.MIGRATIONS)
+
+
+def test__upgrade__given__duplicated__services__should__create__non__unique__index(
+    tmp_path,
+):
+    engine = _legacy_engine(tmp_path)
+    with engine.begin() as connection:
+        for _ in range(2):
+            connection.execute(
+                text_sa(
+                    "INSERT INTO service (chat_id, name, created_by, created_at) "
+                    "VALUES (1, 'netflix', 'alice', CURRENT_TIMESTAMP)"
+                )
+            )
+
+    migrations.upgrade(engine)
+
+    assert not _indexes(engine, "service")["ix_service_chat_id_name"]["unique"]
+
+
+def test__create_service__given__existing__name__should__return__false(db):
+    assert bot._create_service(chat_id=1, service="netflix", username="alice")
+    assert not bot._create_service(chat_id=1, service="netflix", username="bob")
+    assert bot._create_service(chat_id=2, service="netflix", username="bob")
+
+
+def test__upgrade__given__concurrent__runs__should__migrate__once(tmp_path):
+    url = f"sqlite:///{tmp_path / 'fresh.db'}"
+    engines = [create_engine(url) for _ in range(4)]
+    errors = []
+
+    def upgrade(engine):
+        try:
+            migrations.upgrade(engine)
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=upgrade, args=(e,)) for e in engines]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    with engines[0].connect() as connection:
+        versions = connection.execute(text_sa("SELECT version FROM schema_version"))
+        assert [v for (v,) in versions] == [v for v, _ in migrations.MIGRATIONS]
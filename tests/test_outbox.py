@@ -0,0 +1,224 @@
+import asyncio
+import io
+
+from telegram.error import RetryAfter
+
+from outbox import MAX_MESSAGE_LENGTH, Outbox, TokenBucket
+
+
+class FlakyBot:
+    def __init__(self, failures=()):
+        self.sent = []
+        self.failures = list(failures)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.sent.append((chat_id, text))
+
+    async def send_document(self, chat_id, document, filename=None, **kwargs):
+        self.sent.append((chat_id, filename))
+
+
+def test__token_bucket__should__allow__burst__then__rate(timer):
+    bucket = TokenBucket(rate=2, capacity=3, timer=timer)
+    for _ in range(3):
+        assert bucket.delay() == 0
+        bucket.consume()
+
+    assert bucket.delay() == 0.5
+    timer.now = 0.5
+    assert bucket.delay() == 0
+
+
+def test__outbox__should__coalesce__pending__replies__per__chat():
+    bot = FlakyBot()
+
+    async def scenario():
+        outbox = Outbox(bot)
+        for i in range(5):
+            outbox.send(1, f"reply {i}")
+        outbox.send(2, "other chat")
+        outbox.start()
+        await outbox.stop()
+        return outbox
+
+    outbox = asyncio.run(scenario())
+
+    assert bot.sent == [
+        (1, "reply 0\n\nreply 1\n\nreply 2\n\nreply 3\n\nreply 4"),
+        (2, "other chat"),
+    ]
+    assert outbox.coalesced == 4
+
+
+def test__outbox__given__reply__markup__should__send__it__alone():
+    bot = FlakyBot()
+    keyboard = object()
+
+    async def scenario():
+        outbox = Outbox(bot)
+        outbox.send(1, "before")
+        outbox.send(1, "page", reply_markup=keyboard)
+        outbox.send(1, "after")
+        outbox.start()
+        await outbox.stop()
+
+    asyncio.run(scenario())
+
+    assert bot.sent == [(1, "before"), (1, "page"), (1, "after")]
+
+
+def test__outbox__given__document__should__send__it__after__queued__replies():
+    bot = FlakyBot()
+
+    async def scenario():
+        outbox = Outbox(bot)
+        outbox.send(1, "summary")
+        outbox.send_document(1, b"row,username,result", "report.csv")
+        outbox.send(1, "after")
+        outbox.start()
+        await outbox.stop()
+
+    asyncio.run(scenario())
+
+    assert bot.sent == [(1, "summary"), (1, "report.csv"), (1, "after")]
+
+
+def test__outbox__given__file__should__resend__it__whole__and__close__it():
+    bot = FlakyBot()
+    failures = [RetryAfter(0)]
+    read = []
+
+    async def send_document(chat_id, document, filename=None, **kwargs):
+        read.append(document.read())
+        if failures:
+            raise failures.pop(0)
+        bot.sent.append((chat_id, filename))
+
+    bot.send_document = send_document
+    document = io.BytesIO(b"service,username,password")
+
+    async def scenario():
+        outbox = Outbox(bot)
+        outbox.send(1, "before")
+        outbox.send_document(1, document, "services.csv")
+        outbox.start()
+        await outbox.stop()
+
+    asyncio.run(scenario())
+
+    assert bot.sent == [(1, "before"), (1, "services.csv")]
+    assert read == [b"service,username,password"] * 2
+    assert document.closed
+
+
+def test__outbox__should__evict__buckets__of__idle__chats(timer):
+    bot = FlakyBot()
+
+    async def scenario():
+        outbox = Outbox(bot, chat_rate=1, chat_burst=3, timer=timer)
+        outbox.start()
+        for chat_id in (1, 2):
+            outbox.send(chat_id, "reply")
+        await outbox.stop()
+        timer.now = 2
+        outbox.start()
+        outbox.send(3, "reply")
+        await outbox.stop()
+        buckets = set(outbox._chat_buckets)
+        timer.now = 4.5
+        outbox.start()
+        outbox.send(4, "reply")
+        await outbox.stop()
+        return buckets, set(outbox._chat_buckets)
+
+    # refilled after 3s, so only chats quiet for longer lose their bucket
+    assert asyncio.run(scenario()) == ({1, 2, 3}, {3, 4})
+
+
+def test__outbox__should__split__messages__over__the__limit():
+    bot = FlakyBot()
+
+    async def scenario():
+        outbox = Outbox(bot, chat_rate=1000, chat_burst=10)
+        outbox.start()
+        outbox.send(1, "x" * (MAX_MESSAGE_LENGTH + 10))
+        outbox.send(1, "y" * MAX_MESSAGE_LENGTH)
+        await outbox.stop()
+
+    asyncio.run(scenario())
+
+    assert [len(text) for _, text in bot.sent] == [MAX_MESSAGE_LENGTH, 10, 4096]
+
+
+def test__outbox__given__rate__limited__chat__should__serve__other__chats():
+    bot = FlakyBot()
+
+    async def scenario():
+        outbox = Outbox(bot, chat_rate=5, chat_burst=1)
+        outbox.start()
+        outbox.send(1, "first")
+        await asyncio.sleep(0.01)
+        outbox.send(1, "second")
+        outbox.send(2, "other chat")
+        await outbox.stop()
+
+    asyncio.run(scenario())
+
+    assert bot.sent == [(1, "first"), (2, "other chat"), (1, "second")]
+
+
+def test__outbox__given__retry__after__should__resend():
+    bot = FlakyBot(failures=[RetryAfter(0)])
+
+    async def scenario():
+        outbox = Outbox(bot)
+        outbox.start()
+        outbox.send(1, "hello")
+        await outbox.stop()
+        return outbox
+
+    outbox = asyncio.run(scenario())
+
+    assert bot.sent == [(1, "hello")]
+    assert (outbox.retries, outbox.depth) == (1, 0)
+
+
+def test__send_message__given__outbox__should__return__before__sending(
+    monkeypatch, context, fake_bot
+):
+    import bot
+
+    async def scenario():
+        outbox = Outbox(fake_bot)
+        monkeypatch.setattr(bot, "_outbox", outbox)
+        outbox.start()
+        await bot._send_message(context, chat_id=1, text="hello")
+        queued = (list(fake_bot.sent), outbox.depth)
+        await outbox.stop()
+        return queued
+
+    assert asyncio.run(scenario()) == ([], 1)
+    assert fake_bot.sent == [(1, "hello")]
+
+
+def test__bot_application__should__split__the__global__rate__between__processes(
+    db, telegram_api, monkeypatch
+):
+    import bot
+
+    monkeypatch.setenv("OUTBOX_GLOBAL_RATE", "30")
+
+    async def scenario():
+        application = (
+            bot.application_builder().token("123:TEST").request(telegram_api).build()
+        )
+        application.outbox_processes = 3
+        async with application:
+            await application.start()
+            rate = bot._outbox._global_bucket.rate
+            await application.stop()
+        return rate
+
+    assert asyncio.run(scenario()) == 10
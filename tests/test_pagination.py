@@ -0,0 +1,122 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def accounts(db):
+    bot._create_service(chat_id=1, service="netflix", username="admin")
+    for i in range(7, 0, -1):
+        bot._create_account(
+            chat_id=1,
+            service_name="netflix",
+            username=f"acc{i}",
+            password="pwd",
+            created_by="admin",
+        )
+
+
+def _usernames(page):
+    return [account.username for account in page.accounts]
+
+
+def _callback_update(data, chat_id=1):
+    answers, edits = [], []
+
+    async def answer(text=None, **kwargs):
+        answers.append(text)
+
+    async def edit_message_text(text, reply_markup=None, **kwargs):
+        edits.append((text, reply_markup))
+
+    query = SimpleNamespace(
+        data=data, answer=answer, edit_message_text=edit_message_text
+    )
+    update = SimpleNamespace(
+        callback_query=query, effective_chat=SimpleNamespace(id=chat_id)
+    )
+    return update, answers, edits
+
+
+def test__status_handler__should__list__accounts(
+    accounts, context, fake_bot, make_update
+):
+    asyncio.run(bot.status_handler(make_update("/status netflix"), context))
+
+    assert fake_bot.sent[0][1] == (
+        "This is the list of accounts for service netflix."
+        + "".join(f"\n  *  Account acc{i}  pwd  (Available)" for i in range(1, 8))
+    )
+
+
+def test__load_account_page__should__walk__pages__with__one__query__each(
+    accounts, statements
+):
+    statements.clear()
+    first = bot._load_account_page(chat_id=1, service_name="netflix", page_size=3)
+    second = bot._load_account_page(
+        chat_id=1, service_id=1, after_id=first.last_id, page_size=3
+    )
+    last = bot._load_account_page(
+        chat_id=1, service_id=1, after_id=second.last_id, page_size=3
+    )
+    back = bot._load_account_page(
+        chat_id=1, service_id=1, before_id=last.first_id, page_size=3
+    )
+
+    assert len(statements) == 4
+    assert [_usernames(page) for page in (first, second, last, back)] == [
+        ["acc1", "acc2", "acc3"],
+        ["acc4", "acc5", "acc6"],
+        ["acc7"],
+        ["acc4", "acc5", "acc6"],
+    ]
+    assert (first.has_previous, first.has_next) == (False, True)
+    assert (last.has_previous, last.has_next) == (True, False)
+    assert (back.has_previous, back.has_next) == (True, True)
+
+
+def test__load_account_page__should__be__scoped__to__chat(accounts):
+    page = bot._load_account_page(chat_id=2, service_id=1, after_id=1)
+
+    assert page.accounts == []
+
+
+def test__page__buttons__should__edit__the__reply(
+    accounts, context, fake_bot, make_update, monkeypatch
+):
+    monkeypatch.setattr(bot, "_PAGE_SIZE", 3)
+    keyboard = bot._page_keyboard(
+        "accounts", bot._load_account_page(chat_id=1, service_name="netflix")
+    )
+    [[next_button]] = keyboard.inline_keyboard
+    update, answers, edits = _callback_update(next_button.callback_data)
+
+    asyncio.run(bot.page_callback_handler(update, context))
+
+    [(text, markup)] = edits
+    assert answers == [None]
+    assert text == (
+        "These are the accounts for service netflix \n *  acc4\tpwd\n *  acc5\tpwd"
+        "\n *  acc6\tpwd"
+    )
+    assert [button.text for button in markup.inline_keyboard[0]] == [
+        "« Previous",
+        "Next »",
+    ]
+
+
+def test__page__buttons__given__deleted__cursor__should__ask__to__resend(
+    accounts, context
+):
+    page = bot._load_account_page(chat_id=1, service_name="netflix", page_size=3)
+    bot._delete_account(chat_id=1, service="netflix", username="acc3")
+    update, answers, edits = _callback_update(f"status:next:1:{page.last_id}")
+
+    asyncio.run(bot.page_callback_handler(update, context))
+
+    assert answers == ["This list has changed, please send the command again."]
+    assert edits == []
@@ -0,0 +1,109 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.sql import text as text_sa
+
+import bot
+import database
+import migrations
+from models import Account, Service, Usage, UsageTotal
+
+
+def _advance(clock, seconds):
+    clock.current = clock.current + timedelta(seconds=seconds)
+
+
+def test__release__should__accumulate__usage__totals(db, clock, seed):
+    seed()
+    for _ in range(2):
+        bot._use(chat_id=1, service="netflix", username="acc1", current_user="bob")
+        _advance(clock, 60)
+        bot._release(chat_id=1, service="netflix", username="acc1", current_user="bob")
+
+    with database.Session() as session:
+        total = session.scalars(select(UsageTotal)).one()
+    assert (total.performed_by, total.seconds) == ("bob", 120)
+
+
+def test__ranking__should__add__open__sessions__and__sort__by__duration(
+    db, clock, seed
+):
+    seed()
+    bot._use(chat_id=1, service="netflix", username="acc1", current_user="bob")
+    _advance(clock, 30)
+    bot._release(chat_id=1, service="netflix", username="acc1", current_user="bob")
+    bot._use(chat_id=1, service="netflix", username="acc2", current_user="carol")
+    _advance(clock, 90)
+
+    assert bot._ranking(chat_id=1, service_name="netflix") == [
+        ("carol", 90),
+        ("bob", 30),
+    ]
+
+
+def test__ranking__should__be__scoped__to__chat(db, clock, seed):
+    seed(chat_id=1)
+    seed(chat_id=2)
+    bot._use(chat_id=2, service="netflix", username="acc1", current_user="bob")
+    _advance(clock, 30)
+    bot._release(chat_id=2, service="netflix", username="acc1", current_user="bob")
+
+    assert bot._ranking(chat_id=1, service_name="netflix") == []
+    assert bot._ranking(chat_id=2, service_name="netflix") == [("bob", 30)]
+
+
+def test__ranking_handler__should__reply__with__rounded__seconds(
+    db, clock, context, fake_bot, make_update, seed
+):
+    seed()
+    bot._use(chat_id=1, service="netflix", username="acc1", current_user="bob")
+    _advance(clock, 42.4)
+
+    asyncio.run(bot.ranking_handler(make_update("/ranking netflix"), context))
+
+    assert fake_bot.sent[0][1].endswith("bob\t\t | 42s")
+
+
+def test__upgrade__should__backfill__usage__totals__from__history(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'history.db'}")
+    migrations.upgrade(engine)
+    started = datetime(2024, 1, 1)
+    with engine.begin() as connection:
+        connection.execute(
+            insert(Service).values(
+                service_id=1,
+                chat_id=1,
+                name="netflix",
+                created_by="a",
+                created_at=started,
+            )
+        )
+        connection.execute(
+            insert(Account).values(
+                account_id=1,
+                service_id=1,
+                username="acc1",
+                password="pwd",
+                created_by="a",
+                created_at=started,
+            )
+        )
+        for minutes in [1, 2]:
+            connection.execute(
+                insert(Usage).values(
+                    account_id=1,
+                    performed_by="bob",
+                    started_at=started,
+                    finished_at=started + timedelta(minutes=minutes),
+                )
+            )
+        connection.execute(text_sa("DELETE FROM schema_version WHERE version >= 2"))
+
+    migrations.upgrade(engine)
+
+    with engine.connect() as connection:
+        totals = connection.execute(
+            select(UsageTotal.performed_by, UsageTotal.seconds)
+        ).all()
+    assert totals == [("bob", 180)]
@@ -0,0 +1,57 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder
+
+import bot
+import metrics
+
+
+def _process(telegram_api, texts, allowed_ids=frozenset(), chat_id=1):
+    async def scenario():
+        application = (
+            ApplicationBuilder().token("123:TEST").request(telegram_api).build()
+        )
+        bot.register_handlers(application, allowed_ids=allowed_ids)
+        async with application:
+            for text in texts:
+                data = telegram_api.make_update(text, chat_id=chat_id)
+                await application.process_update(Update.de_json(data, application.bot))
+
+    asyncio.run(scenario())
+    return [text for _, _, text in telegram_api.replies]
+
+
+def test__router__should__dispatch__commands(telegram_api):
+    replies = _process(telegram_api, ["/start", "/start@easy_sharing_bot"])
+
+    assert len(replies) == 2
+    assert all(reply.startswith("Hi pal!") for reply in replies)
+
+
+def test__router__should__ignore__other__bots__and__unknown__commands(telegram_api):
+    assert _process(telegram_api, ["/start@other_bot", "/unknown", "hello"]) == []
+
+
+def test__router__given__wrong__arity__should__reply__usage(telegram_api):
+    replies = _process(telegram_api, ["/release netflix", "/status a b", "/use"])
+
+    assert replies == [
+        "Usage: /release <service_name> <username>",
+        "Usage: /status <service_name>",
+        "Usage: /use <service_name> [username]",
+    ]
+
+
+def test__router__given__allowed__ids__should__ignore__other__chats(telegram_api):
+    allowed_ids = bot._parse_allowed_ids("5, 7")
+
+    assert _process(telegram_api, ["/start"], allowed_ids, chat_id=1) == []
+    assert len(_process(telegram_api, ["/start"], allowed_ids, chat_id=7)) == 1
+    assert allowed_ids == frozenset({5, 7})
+
+
+def test__router__should__track__command__metrics(telegram_api):
+    _process(telegram_api, ["/help"])
+
+    assert metrics.registry.commands["help"].calls == 1
@@ -0,0 +1,151 @@
+import json
+import os
+import queue
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+from telegram import Update
+
+import bot
+import database
+import sharding
+from benchmarks import sharding as sharding_benchmark
+from models import Account
+
+
+class FileRecordingAPI(sharding_benchmark.LocalBotAPI):
+    """Appends the text of every sent message to the file in REPLIES_PATH."""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        if url.endswith("/sendMessage"):
+            with open(os.environ["REPLIES_PATH"], "a") as replies:
+                replies.write(json.dumps(request_data.parameters["text"]) + "\n")
+        return await super().do_request(url, method, request_data, **kwargs)
+
+
+def _command(update_id: int, text: str, chat_id: int = 1) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "text": text,
+            "entities": [
+                {"type": "bot_command", "offset": 0, "length": len(text.split()[0])}
+            ],
+            "chat": {"id": chat_id, "type": "group", "title": "chat"},
+            "from": {"id": 10, "is_bot": False, "first_name": "a", "username": "alice"},
+        },
+    }
+
+
+def _replies(path) -> list:
+    if not path.exists():
+        return []
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test__shard_for__should__be__stable__and__in__range():
+    shards = [sharding.shard_for(chat_id, 4) for chat_id in range(-1000, 1000)]
+
+    assert shards == [sharding.shard_for(chat_id, 4) for chat_id in range(-1000, 1000)]
+    assert set(shards) == {0, 1, 2, 3}
+
+
+def test__shard_router__should__keep__a__chat__on__one__worker():
+    queues = [queue.SimpleQueue() for _ in range(3)]
+    router = sharding.ShardRouter(queues)
+    updates = sharding_benchmark.fake_updates(30, chats=5, services=2)
+
+    for data in updates:
+        router.route(Update.de_json(data, None))
+
+    for index, worker_queue in enumerate(queues):
+        routed = [worker_queue.get() for _ in range(worker_queue.qsize())]
+        chats = {data["message"]["chat"]["id"] for data in routed}
+        assert all(sharding.shard_for(chat_id, 3) == index for chat_id in chats)
+        update_ids = [data["update_id"] for data in routed]
+        assert update_ids == sorted(update_ids)
+    assert sum(router.routed) == 30
+
+
+def test__benchmark__should__run__updates__on__every__pool__size():
+    results = sharding_benchmark.run(
+        max_workers=2, updates=40, chats=4, services=2, accounts=3
+    )
+
+    assert [(r.workers, r.updates) for r in results] == [(1, 40), (2, 40)]
+    assert results[0].speedup == 1
+    assert "updates/s" in sharding_benchmark.format_results(results)
+
+
+def test__workers__should__reflect__an__auto__release__by__the__ingress(db, tmp_path):
+    bot._create_service(chat_id=1, service="netflix", username="admin")
+    bot._create_account(
+        chat_id=1,
+        service_name="netflix",
+        username="acc1",
+        password="pwd",
+        created_by="admin",
+    )
+    bot._use(chat_id=1, service="netflix", username="acc1", current_user="alice")
+    with database.Session() as session:
+        session.execute(
+            update(Account).values(grabbed_at=datetime.now() - timedelta(days=2))
+        )
+        session.commit()
+    replies_path = tmp_path / "replies.jsonl"
+
+    with sharding_benchmark._environment(
+        DATABASE_URL=str(db.url),
+        BOT_TOKEN="123:TEST",
+        REPLIES_PATH=str(replies_path),
+        OUTBOX_GLOBAL_RATE="1000000",
+        OUTBOX_CHAT_RATE="1000000",
+        OUTBOX_CHAT_BURST="1000000",
+    ):
+        pool = sharding.WorkerPool(2, request_class=FileRecordingAPI)
+        pool.start()
+        try:
+            worker = pool.queues[sharding.shard_for(1, 2)]
+            worker.put(_command(1, "/check netflix"))
+            for _ in range(500):
+                if _replies(replies_path):
+                    break
+                time.sleep(0.01)
+            # the sweep runs in the ingress, not in the worker caching the chat
+            assert [
+                grab.username for grab in bot._release_expired(global_ttl=3600)
+            ] == ["acc1"]
+            worker.put(_command(2, "/check netflix"))
+            worker.put(_command(3, "/status netflix"))
+        finally:
+            pool.stop()
+
+    first, *after = _replies(replies_path)
+    assert "acc1  (@alice)" in first
+    after = "\n".join(after)
+    assert "no account is being used now" in after
+    assert "acc1  pwd  (Available)" in after
+
+
+def test__worker__pool__should__restart__a__dead__worker(db):
+    with sharding_benchmark._environment(
+        DATABASE_URL=str(db.url), BOT_TOKEN="123:TEST"
+    ):
+        pool = sharding.WorkerPool(1, request_class=sharding_benchmark.LocalBotAPI)
+        pool.start()
+        try:
+            router = sharding.ShardRouter(pool.queues)
+            assert pool.restart_dead() == []
+            pool.processes[0].kill()
+            pool.processes[0].join()
+
+            assert pool.restart_dead() == [0]
+            router.route(Update.de_json(_command(1, "/start"), None))
+        finally:
+            processed = pool.stop()
+
+    assert processed == [1]
+    assert pool.restarts == 1
@@ -0,0 +1,59 @@
+import os
+import subprocess
+import sys
+
+from sqlalchemy import create_engine, event
+
+import migrations
+from benchmarks import startup
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test__import__should__not__touch__the__database(tmp_path):
+    env = {k: v for k, v in os.environ.items() if k != "DATABASE_URL"}
+    env["PYTHONPATH"] = ROOT
+
+    subprocess.run(
+        [sys.executable, "-c", "import bot, database; assert database.engine is None"],
+        cwd=tmp_path,
+        env=env,
+        check=True,
+    )
+
+    assert not (tmp_path / "bot.db").exists()
+
+
+def test__import__should__not__load__dotenv(tmp_path):
+    (tmp_path / ".env").write_text("CHAT_CACHE_SIZE=7\n")
+    env = {k: v for k, v in os.environ.items() if k != "CHAT_CACHE_SIZE"}
+    env["PYTHONPATH"] = ROOT
+
+    subprocess.run(
+        [sys.executable, "-c", "import bot; assert bot._chat_views.maxsize == 256"],
+        cwd=tmp_path,
+        env=env,
+        check=True,
+    )
+
+
+def test__ensure_schema__given__current__version__should__run__one__query(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'schema.db'}")
+    assert migrations.ensure_schema(engine) == migrations.LATEST_VERSION
+    executed = []
+    event.listen(
+        engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: executed.append(statement),
+    )
+
+    assert migrations.ensure_schema(engine) == migrations.LATEST_VERSION
+    assert len(executed) == 1
+
+
+def test__startup__benchmark__should__time__new__and__existing__databases():
+    results = startup.run(runs=1)
+
+    assert [r.database for r in results] == ["new", "existing"]
+    assert all(0 < r.import_ms < r.first_reply_ms for r in results)
+    assert "first reply ms" in startup.format_results(results)
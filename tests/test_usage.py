@@ -0,0 +1,144 @@
+import asyncio
+from collections import Counter
+
+from sqlalchemy import select
+
+import bot
+import database
+from models import Usage
+
+
+def test__use__should__grab__and__open__usage__in__two__statements(
+    db, statements, seed
+):
+    seed(first=0, accounts=1)
+    statements.clear()
+
+    assert bot._use(chat_id=1, service="netflix", username="acc0", current_user="bob")
+
+    dml = [s for s in statements if not s.startswith(("BEGIN", "COMMIT"))]
+    assert len(dml) == 2
+    assert dml[0].startswith("UPDATE account")
+
+
+def test__use__given__grabbed__account__should__return__false(db, seed):
+    seed(first=0, accounts=1)
+    assert bot._use(chat_id=1, service="netflix", username="acc0", current_user="bob")
+
+    assert not bot._use(
+        chat_id=1, service="netflix", username="acc0", current_user="carol"
+    )
+
+
+def test__use__given__other__chat__should__return__false(db, seed):
+    seed(first=0, accounts=1)
+
+    assert not bot._use(
+        chat_id=2, service="netflix", username="acc0", current_user="bob"
+    )
+
+
+def test__release__should__close__open__usage(db, statements, seed):
+    seed(first=0, accounts=1)
+    bot._use(chat_id=1, service="netflix", username="acc0", current_user="bob")
+    statements.clear()
+
+    assert not bot._release(
+        chat_id=1, service="netflix", username="acc0", current_user="carol"
+    )
+    assert bot._release(
+        chat_id=1, service="netflix", username="acc0", current_user="bob"
+    )
+
+    # the refused release is a single UPDATE, the other one closes its usage next
+    dml = [s for s in statements if not s.startswith(("BEGIN", "COMMIT"))]
+    assert [s.split(" SET ")[0] for s in dml[:3]] == [
+        "UPDATE account",
+        "UPDATE account",
+        "UPDATE usage",
+    ]
+    with database.Session() as session:
+        usage = session.scalars(select(Usage)).one()
+    assert usage.finished_at is not None
+    assert bot._use(chat_id=1, service="netflix", username="acc0", current_user="eve")
+
+
+def test__use_handler__given__concurrent__calls__should__grant__each__account__once(
+    db, context, fake_bot, make_update, seed
+):
+    accounts, users = 20, 300
+    seed(first=0, accounts=accounts)
+
+    async def scenario():
+        await asyncio.gather(
+            *[
+                bot.use_handler(
+                    make_update(f"/use netflix acc{i % accounts}", username=f"u{i}"),
+                    context,
+                )
+                for i in range(users)
+            ]
+        )
+
+    asyncio.run(scenario())
+
+    granted = [text for _, text in fake_bot.sent if text.startswith("You are now")]
+    assert len(fake_bot.sent) == users
+    assert len(granted) == accounts
+    with database.Session() as session:
+        usages = session.scalars(select(Usage)).all()
+    assert Counter(usage.account_id for usage in usages) == Counter(
+        {account_id: 1 for account_id in range(1, accounts + 1)}
+    )
+
+
+def test__use_any__should__pick__least__recently__used__account(db, seed):
+    seed(first=0, accounts=3)
+    for username in ["acc2", "acc0"]:
+        bot._use(chat_id=1, service="netflix", username=username, current_user="bob")
+        bot._release(
+            chat_id=1, service="netflix", username=username, current_user="bob"
+        )
+
+    picks = [
+        bot._use_any(chat_id=1, service="netflix", current_user=f"u{i}")
+        for i in range(4)
+    ]
+
+    assert picks == [("acc1", "pwd"), ("acc2", "pwd"), ("acc0", "pwd"), None]
+
+
+def test__use_any__should__claim__in__one__update(db, statements, seed):
+    seed(first=0, accounts=2)
+    statements.clear()
+
+    assert bot._use_any(chat_id=1, service="netflix", current_user="bob")
+
+    dml = [s for s in statements if not s.startswith(("BEGIN", "COMMIT"))]
+    assert len(dml) == 2
+    assert dml[0].startswith("UPDATE account")
+
+
+def test__use_handler__without__username__should__reply__credentials(
+    db, context, fake_bot, make_update, seed
+):
+    seed(first=0, accounts=1)
+
+    async def scenario():
+        await asyncio.gather(
+            *[
+                bot.use_handler(make_update("/use netflix", username=f"u{i}"), context)
+                for i in range(5)
+            ]
+        )
+
+    asyncio.run(scenario())
+
+    replies = sorted(text for _, text in fake_bot.sent)
+    assert replies[0] == (
+        "No free account for service netflix, or the service does not exist"
+    )
+    assert replies[-1] == (
+        "You are now using service netflix with account acc0\nPassword: pwd"
+    )
+    assert replies.count(replies[-1]) == 1
@@ -0,0 +1,91 @@
+import asyncio
+import socket
+import statistics
+import time
+
+import httpx
+from telegram.ext import ApplicationBuilder
+
+import bot
+
+SECRET_TOKEN = "s3cret"
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _build_application(telegram_api):
+    application = (
+        ApplicationBuilder()
+        .token("123:TEST")
+        .request(telegram_api)
+        .get_updates_request(telegram_api)
+        .build()
+    )
+    bot.register_handlers(application)
+    return application
+
+
+async def _webhook_latencies(telegram_api, updates):
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}/telegram"
+    application = _build_application(telegram_api)
+    latencies = []
+    async with application:
+        await application.updater.start_webhook(
+            listen="127.0.0.1",
+            port=port,
+            url_path="telegram",
+            secret_token=SECRET_TOKEN,
+        )
+        await application.start()
+        async with httpx.AsyncClient() as client:
+            rejected = await client.post(url, json=telegram_api.make_update("/start"))
+            assert rejected.status_code == 403
+            for i in range(updates):
+                started = time.perf_counter()
+                response = await client.post(
+                    url,
+                    json=telegram_api.make_update("/start"),
+                    headers={"X-Telegram-Bot-Api-Secret-Token": SECRET_TOKEN},
+                )
+                assert response.status_code == 200
+                await telegram_api.wait_for_replies(i + 1)
+                latencies.append(telegram_api.replies[-1][0] - started)
+        await application.updater.stop()
+        await application.stop()
+    return latencies
+
+
+async def _polling_latencies(telegram_api, updates):
+    application = _build_application(telegram_api)
+    latencies = []
+    async with application:
+        await application.updater.start_polling(poll_interval=0.0)
+        await application.start()
+        for i in range(updates):
+            started = time.perf_counter()
+            await telegram_api.pending_updates.put(telegram_api.make_update("/start"))
+            await telegram_api.wait_for_replies(i + 1)
+            latencies.append(telegram_api.replies[-1][0] - started)
+        await application.updater.stop()
+        await application.stop()
+    return latencies
+
+
+def test__webhook__should__reply__to__posted__updates(telegram_api):
+    latencies = asyncio.run(_webhook_latencies(telegram_api, updates=20))
+
+    assert len(telegram_api.replies) == 20
+    assert all(text.startswith("Hi pal!") for _, _, text in telegram_api.replies)
+    print(f"\nwebhook update-to-reply p50: {statistics.median(latencies) * 1000:.2f}ms")
+
+
+def test__polling__update__to__reply__latency__baseline(telegram_api):
+    latencies = asyncio.run(_polling_latencies(telegram_api, updates=20))
+
+    assert len(telegram_api.replies) == 20
+    print(f"\npolling update-to-reply p50: {statistics.median(latencies) * 1000:.2f}ms")